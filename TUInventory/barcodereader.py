@@ -1,15 +1,18 @@
 """Allows opening a camera feed and finding barcodes in it"""
 
 from collections import Counter
-from time import sleep
+from time import monotonic, sleep
 from sys import platform, stderr
 import threading
 import queue
 
 import cv2
 import numpy as np
-from pyzbar import pyzbar
 
+from decoding import AdaptiveDecoder, DecoderPool, motion_gate
+from frames import FramePipeline, LatestFrame
+from logger import logger
+from sources import FrameSource
 from utils import parallel_print
 
 
@@ -17,14 +20,15 @@ class VideoStream(threading.Thread):
     """Class for reading barcodes of all kinds from a video feed and marking them in the image
     Be sure you can't use the LazyVideoStream instead!
     """
-    def __init__(self, target_resolution=None, camera_id=0):
+    def __init__(self, target_resolution=None, camera_id=0, source=None):
         """
         Args:
             target_resolution: Tuple of (width, height) to set the final resolution of the frames
             camera_id: The id of the camera that's to be used (if your system only has one it's zero)
+            source: FrameSource that's used instead of the camera, see sources.py
         """
         super().__init__(name=f"{self.__class__.__name__}Thread_{camera_id}")
-        self.camera = Camera(camera_id)
+        self.camera = source if source else Camera(camera_id)
         self.camera_id = camera_id
         self.barcodes = []
         self._mirror = False
@@ -33,6 +37,8 @@ class VideoStream(threading.Thread):
         self.gp_lock = threading.Lock()
         self._target_resolution = target_resolution
         self._frame = np.zeros((1, 1))
+        self.decoder = AdaptiveDecoder()
+        self.gate = motion_gate()
 
     def _set_frame(self, frame):
         with self.frame_lock:
@@ -96,18 +102,15 @@ class VideoStream(threading.Thread):
             Returns: 
                 Tuple of frame where barcodes are marked, list of all found codes in frame
         """
-        barcodes = pyzbar.decode(frame)
         found_codes = []
-        for barcode in barcodes:
-            barcode_information = (barcode.type, barcode.data.decode("utf-8"))
+        for barcode_type, data, poly in self.decoder.decode(frame):
+            barcode_information = (barcode_type, data)
             if barcode_information not in found_codes:
                 found_codes.append(barcode_information)
-            poly = barcode.polygon
-            poly = np.asarray([(point.x, point.y) for point in poly])
-            poly = poly.reshape((-1, 1, 2))
             cv2.polylines(frame, [poly], True, (0, 255, 0), 2)
-            cv2.rectangle(frame, *self.rect_transformation(*barcode.rect), (255, 0, 0), 2)
-            x, y = barcode.rect[:2]
+            rect = cv2.boundingRect(poly)
+            cv2.rectangle(frame, *self.rect_transformation(*rect), (255, 0, 0), 2)
+            x, y = rect[:2]
             cv2.putText(
                 frame, 
                 "{}({})".format(*barcode_information), 
@@ -121,8 +124,13 @@ class VideoStream(threading.Thread):
     def run(self):
         with self.camera as camera:
             while not self.abort:
-                frame = camera.read()[1]
-                marked_frame, found_codes = self.find_and_mark_barcodes(frame)
+                frame = read_frame(self.camera, camera)
+                if frame is None:
+                    break
+                if self.gate is None or self.gate.check(frame):
+                    marked_frame, found_codes = self.find_and_mark_barcodes(frame)
+                else:
+                    marked_frame, found_codes = frame, []
                 self.frame = marked_frame
                 if found_codes:
                     self.barcodes.append(found_codes)
@@ -130,35 +138,53 @@ class VideoStream(threading.Thread):
 
 class LazyVideoStream(threading.Thread):
     """Class for reading barcodes of all kinds from a video feed and marking them in the image
-    This Lazy implementation only processes frames on demand
+    This Lazy implementation only captures frames while someone subscribed to them. Every frame
+    is captured and decoded once and published to all subscribers: the display frame goes into
+    the LatestFrame display, the found codes are put into the queue of every code subscriber.
     
         Args:
             target_resolution: Tuple of (width, height) to set the final resolution of the frames
             camera_id: The id of the camera that's to be used (if your system only has one it's zero)
+            decoder_pool: DecoderPool or ProcessDecoderPool shared with the streams of other
+                cameras, a new DecoderPool with a single worker if None
+            source: FrameSource that's used instead of the camera, e.g. a video file or generated
+                frames for benchmarks, see sources.py. The stream ends once the source is exhausted.
         
         Attributes:
-            camera: Instance of Camera with for given camera_id
+            camera: Instance of Camera with for given camera_id, or the given source
             camera_id: Given camera_id
             _mirror: Set to True to mirror the frame
-            gp_lock: general purpose lock for property access
+            gp_lock: general purpose lock for property access, code_subscribers and subscribe_display
             _target_resolution: Tuple of (width, height) to set the final resolution of the frames
-            request_queue: Queue that's used to request a frame, request by putting True
-            frame_queue: Queue that answer frames get pushed into
+            display: LatestFrame holding the newest display frame, only filled once
+                subscribe_display was called, hand the frames back with release once they're displayed
+            code_subscribers: Queues the (timestamp, found codes) of every frame are put into
+            subscribed: Event that's set once there's any subscriber
+            pipeline: FramePipeline that scales and mirrors the frames into reused buffers
+            decoder_pool: DecoderPool the frames are decoded in
+            gate: MotionGate that skips decoding while the scene is static, None if it's disabled
+                in the config, reports the fraction of frames that were decoded
         
         Properties:
             mirror: gp_lock locked _mirror
             target_resolution: gp_lock locked _target_resolution
+            decoder: DecodeStatistics of this camera, reports the decode time per frame
     """
-    def __init__(self, target_resolution=None, camera_id=0):
+    def __init__(self, target_resolution=None, camera_id=0, decoder_pool=None, source=None):
         super().__init__(name=f"{self.__class__.__name__}Thread_{id(self)}")
         self.daemon = True
-        self.camera = Camera(camera_id)
+        self.camera = source if source else Camera(camera_id)
         self.camera_id = camera_id
         self._mirror = False
         self.gp_lock = threading.Lock()
         self._target_resolution = target_resolution # (width, height)
-        self.request_queue = queue.Queue()
-        self.frame_queue = queue.Queue()
+        self.pipeline = FramePipeline()
+        self.display = LatestFrame(self.pipeline.release)
+        self._display_subscribed = False
+        self.code_subscribers = []
+        self.subscribed = threading.Event()
+        self.decoder_pool = decoder_pool if decoder_pool else DecoderPool(workers=1)
+        self.gate = motion_gate()
         with self.camera:
             pass
 
@@ -181,6 +207,10 @@ class LazyVideoStream(threading.Thread):
     mirror = property(fget=_get_mirror, fset=_set_mirror)
     target_resolution = property(fget=_get_target_resolution, fset=_set_target_resolution)
 
+    @property
+    def decoder(self):
+        return self.decoder_pool.decoder(self.camera_id)
+
     @staticmethod
     def rect_transformation(x, y, width, height):
         """Transform rectangle of type "origin + size" to "two-point"
@@ -203,18 +233,14 @@ class LazyVideoStream(threading.Thread):
             Returns: 
                 Tuple of frame where barcodes are marked, list of all found codes in frame
         """
-        barcodes = pyzbar.decode(frame)
         found_codes = []
-        for barcode in barcodes:
-            barcode_information = (barcode.type, barcode.data.decode("utf-8"))
+        for barcode_type, data, poly in self.decoder_pool.decode(self.camera_id, frame):
+            barcode_information = (barcode_type, data)
             if barcode_information not in found_codes:
                 found_codes.append(barcode_information)
-            poly = barcode.polygon
-            poly = np.asarray([(point.x, point.y) for point in poly])
-            poly = poly.reshape((-1, 1, 2))
             cv2.polylines(frame, [poly], True, (0, 255, 0), 2)
-            # cv2.rectangle(frame, *self.rect_transformation(*barcode.rect), (255, 0, 0), 2)
-            x, y = barcode.rect[:2]
+            # cv2.rectangle(frame, *self.rect_transformation(*cv2.boundingRect(poly)), (255, 0, 0), 2)
+            x, y = cv2.boundingRect(poly)[:2]
             """
             cv2.putText(
                 frame, 
@@ -226,23 +252,102 @@ class LazyVideoStream(threading.Thread):
                 1)"""
         return frame, found_codes
 
-    def request(self):
-        """Convenience function to abstract the request_queue from the user"""
-        self.request_queue.put(True)
+    def subscribe_display(self):
+        """Start producing display frames
+
+            Returns:
+                The LatestFrame display, connect to its ready signal from the GUI thread
+        """
+        with self.gp_lock:
+            self._display_subscribed = True
+        self.subscribed.set()
+        return self.display
+
+    def subscribe_codes(self, maxsize=64):
+        """Get a queue that the (timestamp, found codes) of every frame are put into
+        Observations are dropped while the queue is full, the stream never waits for a subscriber
+
+            Args:
+                maxsize: Number of observations the queue holds
+
+            Returns:
+                queue.Queue of tuples of monotonic timestamp and list of (type, data) of the frame
+        """
+        codes = queue.Queue(maxsize)
+        with self.gp_lock:
+            self.code_subscribers.append(codes)
+        self.subscribed.set()
+        return codes
+
+    def unsubscribe_codes(self, codes):
+        """Stop putting observations into a queue from subscribe_codes"""
+        with self.gp_lock:
+            self.code_subscribers.remove(codes)
+
+    def release(self, frame):
+        """Hand a frame from the display back so its buffer can be reused"""
+        self.pipeline.release(frame)
+
+    def _publish(self, timestamp, marked_frame, found_codes):
+        with self.gp_lock:
+            code_subscribers = list(self.code_subscribers)
+            display = self._display_subscribed
+        for codes in code_subscribers:
+            try:
+                codes.put_nowait((timestamp, found_codes))
+            except queue.Full:
+                pass
+        if display:
+            self.display.put(self.pipeline.process(marked_frame, self.target_resolution, self.mirror))
 
     def run(self):
-        """Start connection to camera and answer requests"""
+        """Start connection to camera once there's a subscriber and publish every frame
+        Frames are captured into the same buffer every time and marked in place,
+        frames of a static scene aren't decoded
+        """
+        self.subscribed.wait()
         with self.camera as camera:
+            capture_buffer = None
             while True:
-                self.request_queue.get()
-                frame = camera.read()[1]
-                marked_frame, found_codes = self.find_and_mark_barcodes(frame)
-                if self.target_resolution:
-                    marked_frame = cv2.resize(marked_frame, (self.target_resolution[0], self.target_resolution[1]))
-                if self.mirror:
-                    marked_frame = cv2.flip(marked_frame, 1)
-                self.frame_queue.put((marked_frame, found_codes))
-                self.request_queue.task_done()
+                frame = read_frame(self.camera, camera, capture_buffer)
+                if frame is None:
+                    break
+                capture_buffer = frame
+                timestamp = monotonic()
+                if self.gate is None or self.gate.check(frame):
+                    marked_frame, found_codes = self.find_and_mark_barcodes(frame)
+                else:
+                    marked_frame, found_codes = frame, []
+                self._publish(timestamp, marked_frame, found_codes)
+
+
+def read_frame(device, capture, image=None, retry_delay=0.01):
+    """Read the next frame of an opened Camera or FrameSource
+    A camera fails to deliver a frame every now and then, failed reads of a camera are logged
+    and retried. Only a FrameSource ends, once it's exhausted.
+
+        Args:
+            device: The Camera or FrameSource
+            capture: What entering device returned
+            image: Frame of a previous read that may be overwritten
+            retry_delay: Seconds to wait before a failed read of a camera is retried
+
+        Returns:
+            The frame, None once a FrameSource is exhausted
+    """
+    failures = 0
+    while True:
+        success, frame = capture.read(image)
+        if success:
+            if failures:
+                logger.info(f"Camera {device.camera_id} delivers frames again after {failures} failed reads")
+            return frame
+        if isinstance(device, FrameSource):
+            return None
+        if not failures:
+            logger.warning(f"Failed to read a frame from camera {device.camera_id}, retrying")
+        failures += 1
+        sleep(retry_delay)
 
 
 class Camera():
@@ -267,16 +372,24 @@ class Camera():
 
 if __name__ == "__main__":
     lazy_feed = LazyVideoStream()
+    display = lazy_feed.subscribe_display()
+    code_stream = lazy_feed.subscribe_codes()
     lazy_feed.start()
     window = "window"
     cv2.namedWindow(window)
     
     while True:
-        lazy_feed.request_queue.put(True)
-        frame, codes = lazy_feed.frame_queue.get()
-        lazy_feed.frame_queue.task_done()
-        cv2.imshow(window, frame)
+        frame = display.take()
+        if frame is not None:
+            cv2.imshow(window, frame)
+            lazy_feed.release(frame)
         cv2.waitKey(1)
+        try:
+            timestamp, codes = code_stream.get_nowait()
+        except queue.Empty:
+            codes = []
         if codes:
-            parallel_print(codes)
+            parallel_print(f"{codes} decoded in {lazy_feed.decoder.last_duration:.1f} ms")
+            if lazy_feed.gate:
+                parallel_print(f"{lazy_feed.gate.decoded_fraction:.0%} of the frames were decoded")
     
\ No newline at end of file
@@ -0,0 +1,379 @@
+"""Benchmarks for the performance critical parts of TUInventory
+Run a benchmark by its name, e.g.: python benchmark.py engine
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+import pathlib
+import queue
+import random
+import tempfile
+from threading import Thread
+from time import monotonic, perf_counter
+import tracemalloc
+
+import cv2
+import numpy as np
+from PyQt5.QtGui import QGuiApplication, QImage, QPixmap
+import qrcode
+
+import barcodereader
+import classes
+import decoding
+import frames
+import migrations
+import passwords
+import slots
+import sources
+
+
+def bench_confirmation(frame_rates=(5, 10, 15, 30, 60), hit_rate=0.8, runs=200):
+    """Compare the time from a code showing up to its confirmation at different frame rates
+    between the former count of more than ten hits and classes.CodeVoter
+    """
+    rng = random.Random(0)
+    print(f"{'fps':>5}|{'count ms':>10}|{'window ms':>11}")
+    print("-"*28)
+    for fps in frame_rates:
+        counted, voted = [], []
+        for run in range(runs):
+            hits = 0
+            voter = classes.CodeVoter(**{key: classes.config["recognition", key] for key in classes.voter_keys})
+            count_time = vote_time = None
+            for i in range(10 * fps):
+                found = ["code"] if rng.random() < hit_rate else []
+                hits += len(found)
+                if count_time is None and hits > 10:
+                    count_time = i / fps
+                if vote_time is None and voter.observe(i / fps, found):
+                    vote_time = i / fps
+                if count_time is not None and vote_time is not None:
+                    break
+            counted.append(count_time)
+            voted.append(vote_time)
+        print(f"{fps:>5}|{sum(counted) / runs * 1000:>10.0f}|{sum(voted) / runs * 1000:>11.0f}")
+
+
+def bench_decode(count=100, capture=(1920, 1080), sides=(120, 300, 600)):
+    """Compare the decode time per frame of pyzbar on the full colour frame with
+    decoding.AdaptiveDecoder for QR codes of different sizes, needs the zbar library
+    """
+    qr = qrcode.QRCode()
+    qr.add_data("1234")
+    code = np.where(qr.get_matrix(), 0, 255).astype(np.uint8)
+    print(f"{'code px':>8}|{'full ms':>9}|{'adaptive ms':>13}|{'scale':>7}|{'full scans':>12}")
+    print("-"*53)
+    for side in sides:
+        frame = np.full((capture[1], capture[0], 3), 128, np.uint8)
+        frame[100:100 + side, 100:100 + side] = cv2.resize(
+            code, (side, side), interpolation=cv2.INTER_NEAREST)[..., None]
+        decoder = decoding.AdaptiveDecoder()
+        start = perf_counter()
+        for i in range(count):
+            decoding.pyzbar.decode(frame)
+        full = (perf_counter() - start) / count * 1000
+        for i in range(count):
+            decoder.decode(frame)
+        print(f"{side:>8}|{full:>9.2f}|{decoder.mean_duration:>13.2f}|{decoder.scale:>7.3f}|{decoder.full_scans:>12}")
+
+
+def bench_motion(seconds=60, fps=30, capture=(1280, 720), visits=3):
+    """Measure how many frames of a mostly idle scanning station decoding.MotionGate lets
+    through to the decoder, how long a check takes and how many frames it takes to open the gate
+    once a code is held into the picture
+    """
+    rng = np.random.default_rng(0)
+    scene = cv2.GaussianBlur(rng.integers(0, 256, (capture[1], capture[0], 3), np.uint8), (31, 31), 0)
+    noise = [rng.integers(0, 12, scene.shape, np.uint8) for i in range(8)]
+    visit_frames = {int(seconds * fps * (i + 1) / (visits + 1)) for i in range(visits)}
+    now = [0.0]
+    gate = decoding.MotionGate(clock=lambda: now[0])
+    checking = 0
+    latencies = []
+    visit = None
+    for i in range(seconds * fps):
+        now[0] = i / fps
+        frame = cv2.add(scene, noise[i % len(noise)])
+        if i in visit_frames:
+            visit = i
+        if visit is not None and i - visit < fps: # a code is moved through the picture for a second
+            offset = (i - visit) * 10
+            frame[200:400, 300 + offset:500 + offset] = 0
+        start = perf_counter()
+        passed = gate.check(frame)
+        checking += perf_counter() - start
+        if visit is not None and len(latencies) < len(visit_frames) and passed:
+            if not latencies or latencies[-1][0] != visit:
+                latencies.append((visit, i - visit))
+    print(f"frames: {gate.checked}, decoded: {gate.decoded_fraction:.1%}, "
+        f"check: {checking / gate.checked * 1000:.2f} ms/frame")
+    print(f"frames until the gate opened for a code: {[latency for visit, latency in latencies]}")
+
+
+def bench_decoder_pools(frames_per_camera=100, cameras=(1, 2, 4), capture=(1280, 720), workers=None):
+    """Compare the decode throughput of decoding.DecoderPool and decoding.ProcessDecoderPool
+    with several cameras submitting frames at once, needs the zbar library
+    """
+    qr = qrcode.QRCode()
+    qr.add_data("1234")
+    code = np.where(qr.get_matrix(), 0, 255).astype(np.uint8)
+    frame = np.full((capture[1], capture[0], 3), 128, np.uint8)
+    frame[100:400, 100:400] = cv2.resize(code, (300, 300), interpolation=cv2.INTER_NEAREST)[..., None]
+    print(f"{'cameras':>8}|{'threads frames/s':>18}|{'processes frames/s':>20}")
+    print("-"*48)
+    for camera_count in cameras:
+        rates = []
+        for pool in (decoding.DecoderPool(workers), decoding.ProcessDecoderPool(workers)):
+            def camera(camera_id):
+                for i in range(frames_per_camera):
+                    pool.decode(camera_id, frame)
+            pool.decode(0, frame) # start the workers
+            threads = [Thread(target=camera, args=(camera_id,)) for camera_id in range(camera_count)]
+            start = perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            rates.append(camera_count * frames_per_camera / (perf_counter() - start))
+            pool.shutdown()
+        print(f"{camera_count:>8}|{rates[0]:>18.1f}|{rates[1]:>20.1f}")
+
+
+def bench_scans(minutes=2, fps=30, dwell=1.0, gap=0.5, hit_rate=0.8):
+    """Compare the scans per minute of a replayed stocktaking video between the former
+    global pause of ten seconds after every recognition and classes.CodeCooldown
+    Devices are held into the camera for dwell seconds one after the other, every third one twice
+    in a row, and zbar finds the code in hit_rate of the frames it's visible in
+    """
+    rng = random.Random(0)
+    observations = []
+    timestamp, device = 0.0, 0
+    while timestamp < minutes * 60:
+        device += 1
+        for uid in (device, device) if device % 3 == 0 else (device,):
+            for i in range(int(dwell * fps)):
+                found = [("QRCODE", f"id={uid}")] if rng.random() < hit_rate else []
+                observations.append((timestamp, found))
+                timestamp += 1 / fps
+            for i in range(int(gap * fps)):
+                observations.append((timestamp, []))
+                timestamp += 1 / fps
+
+    def paused(observations, sensibility=10, pause=10):
+        barcodes = Counter()
+        recognized = []
+        paused_until = 0
+        for timestamp, found_codes in observations:
+            if timestamp < paused_until or not found_codes:
+                continue
+            barcodes.update(found_codes)
+            code, count = barcodes.most_common(1)[0]
+            if count > sensibility:
+                recognized.append(code)
+                barcodes = Counter()
+                paused_until = timestamp + pause
+        return recognized
+
+    def cooldown(observations):
+        class ReplayStream():
+            camera_id = 0
+            subscribe_codes = queue.Queue
+        sync = classes.VideoStreamUISync(None, ReplayStream(), None, classes.CodeCooldown(10))
+        recognized = []
+        for timestamp, found_codes in observations:
+            recognized.extend(sync.observe(timestamp, found_codes))
+        return recognized
+
+    print(f"devices: {device}, duplicates presented: {device // 3}")
+    print(f"{'strategy':<10}|{'scans/min':>11}|{'missed devices':>16}|{'duplicates':>12}")
+    print("-"*52)
+    for name, strategy in (("pause", paused), ("cooldown", cooldown)):
+        recognized = strategy(observations)
+        distinct = len(set(recognized))
+        print(f"{name:<10}|{distinct / minutes:>11.1f}|{device - distinct:>16}|{len(recognized) - distinct:>12}")
+
+
+def bench_engine(writes=500, reads=2000):
+    """Compare write and read throughput of a bare engine with the configured engine profile
+    Writes commit every row on its own like slots.save_to_db, reads open a short session
+    per lookup like the UI handlers do
+    """
+    print(f"{'profile':<10}|{'writes/s':>12}|{'reads/s':>12}")
+    print("-"*36)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, profile in (("default", None), ("tuned", classes.engine_profile)):
+            engine = classes.create_engine(pathlib.Path(directory) / f"{name}.db", profile)
+            classes.Base.metadata.create_all(bind=engine)
+            CSession = classes.setup_context_session(engine)
+
+            start = perf_counter()
+            for i in range(writes):
+                with CSession() as session:
+                    session.add(classes.Producer(f"Producer {i}"))
+            write_rate = writes / (perf_counter() - start)
+
+            random.seed(0)
+            start = perf_counter()
+            for i in range(reads):
+                with CSession() as session:
+                    session.query(classes.Producer.name).\
+                        filter_by(uid=random.randint(1, writes)).first()
+            read_rate = reads / (perf_counter() - start)
+
+            engine.dispose()
+            print(f"{name:<10}|{write_rate:>12.1f}|{read_rate:>12.1f}")
+
+
+def bench_stream(seconds=10, fps=30, capture=(1280, 720), codes=("1", "22", "333")):
+    """Measure throughput and latency of barcodereader.LazyVideoStream on generated frames,
+    as fast as the pipeline runs and paced like a camera at fps, needs the zbar library
+    """
+    print(f"{'source':>9}|{'frames/s':>9}|{'latency ms':>11}|{'p95 ms':>7}|{'codes found':>12}")
+    print("-"*52)
+    for realtime in (False, True):
+        source = sources.SyntheticSource(
+            codes, capture, fps, realtime, dwell=seconds / len(codes), count=seconds * fps)
+        stream = barcodereader.LazyVideoStream(source=source)
+        code_stream = stream.subscribe_codes(maxsize=0)
+        latencies = []
+        found = set()
+        start = perf_counter()
+        stream.start()
+        while stream.is_alive() or not code_stream.empty():
+            try:
+                timestamp, found_codes = code_stream.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            latencies.append(monotonic() - timestamp)
+            found.update(data for barcode_type, data in found_codes)
+        duration = perf_counter() - start
+        stream.decoder_pool.shutdown()
+        latencies.sort()
+        print(f"{'realtime' if realtime else 'fastest':>9}|{len(latencies) / duration:>9.1f}|"
+            f"{np.mean(latencies) * 1000:>11.2f}|{latencies[int(len(latencies) * 0.95)] * 1000:>7.2f}|"
+            f"{len(found):>5} of {len(codes)}")
+
+
+def bench_tree(sizes=(1000, 10000, 100000, 1000000), users=100, locations=10, repeat=20):
+    """Measure how long the pages that open and expand the device overview take to fetch
+    for inventories of different sizes
+    """
+    print(f"{'devices':>10}|{'locations ms':>14}|{'users ms':>10}|{'devices ms':>12}")
+    print("-"*49)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            engine = classes.create_engine(pathlib.Path(directory) / f"{size}.db", classes.engine_profile)
+            classes.Base.metadata.create_all(bind=engine)
+            migrations.migrate(engine)
+            with engine.begin() as connection:
+                connection.execute(classes.Producer.__table__.insert(), [{"name": "Producer"}])
+                connection.execute(classes.Article.__table__.insert(), [{"name": "Article", "producer_uid": 1}])
+                connection.execute(
+                    classes.Location.__table__.insert(),
+                    [{"name": f"Location {i}"} for i in range(locations)])
+                connection.execute(
+                    classes.User.__table__.insert(),
+                    [{"e_mail": f"user{i}@example.com", "name": f"Name {i}", "surname": "Surname"} 
+                        for i in range(users)])
+                connection.execute(
+                    classes.Device.__table__.insert(),
+                    [{"uid": uid, "article_uid": 1} for uid in range(1, size + 1)])
+                connection.execute(
+                    classes.Responsibility.__table__.insert(),
+                    [{"device_uid": uid, "user_uid": uid % users + 1, "location_uid": uid % locations + 1} 
+                        for uid in range(1, size + 1)])
+            CSession = classes.setup_context_session(engine)
+            timings = []
+            for page in (
+                    lambda session: slots.tree_locations(session),
+                    lambda session: slots.tree_users(session, 1),
+                    lambda session: slots.tree_devices(session, 1, 1)):
+                start = perf_counter()
+                for i in range(repeat):
+                    with CSession() as session:
+                        page(session)
+                timings.append((perf_counter() - start) / repeat * 1000)
+            engine.dispose()
+            print(f"{size:>10}|{timings[0]:>14.2f}|{timings[1]:>10.2f}|{timings[2]:>12.2f}")
+
+
+def bench_passwords(targets=(0.1, 0.25, 0.5, 1.0)):
+    """Compare the verification time of the configured password policy with calibrated ones
+    See cli/cli_calibrate.py to store a calibrated policy in the config
+    """
+    password = "benchmark"
+    hash_ = passwords.hash(password)
+    start = perf_counter()
+    passwords.verify(password, hash_)
+    configured = perf_counter() - start
+    print(f"{'target s':>10}|{'rounds':>8}|{'memory KiB':>12}|{'lanes':>7}|{'verify s':>10}")
+    print("-"*51)
+    settings = {key: classes.config["passwords", key] for key in passwords.policy_keys}
+    print(f"{'config':>10}|{settings['rounds']:>8}|{settings['memory_cost']:>12}|"
+        f"{settings['parallelism']:>7}|{configured:>10.3f}")
+    for target in targets:
+        settings, seconds = passwords.calibrate(target)
+        print(f"{target:>10}|{settings['rounds']:>8}|{settings['memory_cost']:>12}|"
+            f"{settings['parallelism']:>7}|{seconds:>10.3f}")
+
+
+def bench_frames(count=300, capture=(1280, 720), display=(800, 450)):
+    """Compare time and memory allocated per frame on the way from a captured frame to a
+    mirrored QPixmap of display size between the former copying path and frames.FramePipeline
+    """
+    app = QGuiApplication.instance() or QGuiApplication([])
+    captured = np.random.default_rng(0).integers(0, 256, (capture[1], capture[0], 3), np.uint8)
+
+    def copying(frame):
+        frame = cv2.resize(frame, display)
+        frame = cv2.flip(frame, 1)
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        height, width, channel = frame.shape
+        return QPixmap(QImage(frame.data, width, height, 3 * width, QImage.Format_RGB888))
+
+    pipeline = frames.FramePipeline()
+    def pooled(frame):
+        display_frame = pipeline.process(frame, display, mirror=True)
+        pixmap = frames.to_qpixmap(display_frame)
+        pipeline.release(display_frame)
+        return pixmap
+
+    print(f"{'path':<10}|{'ms/frame':>10}|{'KiB allocated/frame':>21}")
+    print("-"*43)
+    for name, path in (("copying", copying), ("pooled", pooled)):
+        path(captured) # warm up caches and the pool
+        start = perf_counter()
+        for i in range(count):
+            path(captured)
+        duration = perf_counter() - start
+        tracemalloc.start()
+        allocated = 0
+        for i in range(count):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            path(captured)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        print(f"{name:<10}|{duration / count * 1000:>10.3f}|{allocated / count / 1024:>21.1f}")
+    print(f"buffers allocated by the pool: {pipeline.pool.allocations}")
+
+
+benchmarks = {
+    "confirmation": bench_confirmation,
+    "decode": bench_decode,
+    "decoder_pools": bench_decoder_pools,
+    "engine": bench_engine,
+    "frames": bench_frames,
+    "motion": bench_motion,
+    "passwords": bench_passwords,
+    "scans": bench_scans,
+    "stream": bench_stream,
+    "tree": bench_tree,
+}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run TUInventory benchmarks")
+    parser.add_argument("benchmark", choices=sorted(benchmarks), help="Name of the benchmark")
+    args = parser.parse_args()
+    benchmarks[args.benchmark]()
@@ -0,0 +1,420 @@
+"""Bulk import and export of inventory data
+Rows are streamed from CSV or JSON Lines files in chunks, names are resolved through a
+single lookup dict and every chunk is written with executemany inserts in one transaction.
+Exports stream rows into CSV, JSON Lines or TSV files one at a time.
+Users are provisioned from the same file formats with their passwords hashed in a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import partial
+from itertools import islice
+import json
+import os
+import pathlib
+from time import perf_counter
+
+import sqlalchemy
+
+import classes
+from config import config
+from logger import logger
+import passwords
+
+import_fields = ("producer", "article", "code", "user", "location")
+user_fields = ("e_mail", "name", "surname", "phonenumber", "location", "password")
+export_fields = ("device", "code", "article", "producer", "user", "e_mail", "location")
+export_formats = ("csv", "jsonl", "tsv")
+
+
+class ImportReport():
+    """Summary of a bulk import
+
+        Attributes:
+            rows: Number of rows that were read
+            imported: Number of devices that were imported
+            errors: List of (line, message) for every row that was skipped
+            duration: Time in seconds the import took
+
+        Properties:
+            rows_per_second: Throughput of the import
+    """
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.errors = []
+        self.duration = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.duration if self.duration else 0.0
+
+    def __str__(self):
+        return (f"Imported {self.imported} of {self.rows} rows in {self.duration:.2f}s "
+            f"({self.rows_per_second:.0f} rows/s, {len(self.errors)} errors)")
+
+
+def read_rows(path):
+    """Stream the rows of a CSV or JSON Lines file
+    A JSON file holding a single array can't be streamed and is parsed at once
+
+        Args:
+            path: Path of the file, files ending in .csv are read as CSV
+
+        Yields:
+            (line, row) where row is a dict or None if the line isn't valid JSON
+    """
+    path = pathlib.Path(path)
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.suffix.lower() == ".csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        head = f.read(1024).lstrip()
+        f.seek(0)
+        if head.startswith("["):
+            for line, row in enumerate(json.load(f), start=1):
+                yield line, row
+            return
+        for line, text in enumerate(f, start=1):
+            if not text.strip():
+                continue
+            try:
+                yield line, json.loads(text)
+            except ValueError:
+                yield line, None
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most size elements without materializing it"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Lookup():
+    """Resolves names to uids with a single dict that's filled with one query per table
+    Keys are (table, normalized name), values are uids - or (uid, producer_uid) for articles
+    """
+    def __init__(self, connection):
+        self.uids = {}
+        for uid, name in connection.execute(sqlalchemy.select(
+                [classes.Producer.uid, classes.Producer.name])):
+            self.uids["producer", name] = uid
+        for uid, name, producer_uid in connection.execute(sqlalchemy.select(
+                [classes.Article.uid, classes.Article.name, classes.Article.producer_uid])):
+            self.uids["article", name] = (uid, producer_uid)
+        for uid, e_mail in connection.execute(sqlalchemy.select(
+                [classes.User.uid, classes.User.e_mail])):
+            self.uids["user", e_mail] = uid
+        for uid, name in connection.execute(sqlalchemy.select(
+                [classes.Location.uid, classes.Location.name])):
+            self.uids["location", name] = uid
+
+    def __contains__(self, key):
+        return key in self.uids
+
+    def __getitem__(self, key):
+        return self.uids[key]
+
+    def update(self, entries):
+        self.uids.update(entries)
+
+
+def _normalize(row):
+    """Clean up a row the same way the constructors of the mapped classes do"""
+    row = {field: str(row.get(field) or "").strip() for field in import_fields}
+    row["producer"] = row["producer"].title()
+    row["user"] = row["user"].lower()
+    row["location"] = row["location"].title()
+    return row
+
+
+def _validate(row, lookup, new_articles):
+    """Get the reason why a normalized row can't be imported or None if it's fine
+
+        Args:
+            row: Normalized row
+            lookup: _Lookup of the names that exist already
+            new_articles: dict of the articles that are new in the chunk to the producer
+                of their first valid row, rows of an article with another producer are invalid
+    """
+    for field in ("producer", "article", "user", "location"):
+        if not row[field]:
+            return f"Missing {field}"
+    if ("user", row["user"]) not in lookup:
+        return f"Unknown user {row['user']}"
+    if ("article", row["article"]) in lookup:
+        producer_uid = lookup["article", row["article"]][1]
+        if ("producer", row["producer"]) not in lookup or lookup["producer", row["producer"]] != producer_uid:
+            return f"Article {row['article']} belongs to another producer"
+    elif new_articles.setdefault(row["article"], row["producer"]) != row["producer"]:
+        return f"Article {row['article']} belongs to another producer"
+    return None
+
+
+def _insert_names(connection, table, names):
+    """Insert all names into a table with a single executemany and return their uids"""
+    if not names:
+        return {}
+    connection.execute(table.insert(), [{"name": name} for name in names])
+    rows = connection.execute(
+        sqlalchemy.select([table.c.uid, table.c.name]).where(table.c.name.in_(names)))
+    return dict((name, uid) for uid, name in rows)
+
+
+def _import_chunk(connection, rows, lookup):
+    """Write the validated rows of a chunk, returns the lookup entries that were added"""
+    producers = classes.Producer.__table__
+    articles = classes.Article.__table__
+    locations = classes.Location.__table__
+    devices = classes.Device.__table__
+    responsibilities = classes.Responsibility.__table__
+
+    new_entries = {}
+    new_producers = {row["producer"] for row in rows if ("producer", row["producer"]) not in lookup}
+    for name, uid in _insert_names(connection, producers, sorted(new_producers)).items():
+        new_entries["producer", name] = uid
+    new_locations = {row["location"] for row in rows if ("location", row["location"]) not in lookup}
+    for name, uid in _insert_names(connection, locations, sorted(new_locations)).items():
+        new_entries["location", name] = uid
+
+    def uid_of(table, name):
+        return new_entries[table, name] if (table, name) in new_entries else lookup[table, name]
+
+    new_articles = {
+        row["article"]: uid_of("producer", row["producer"])
+        for row in rows if ("article", row["article"]) not in lookup} # _validate made sure the producers agree
+    if new_articles:
+        connection.execute(
+            articles.insert(),
+            [{"name": name, "producer_uid": producer_uid} for name, producer_uid in new_articles.items()])
+        for uid, name, producer_uid in connection.execute(
+                sqlalchemy.select([articles.c.uid, articles.c.name, articles.c.producer_uid]).\
+                where(articles.c.name.in_(list(new_articles)))):
+            new_entries["article", name] = (uid, producer_uid)
+
+    first_uid = connection.execute(sqlalchemy.select(
+        [sqlalchemy.func.coalesce(sqlalchemy.func.max(devices.c.uid), 0)])).scalar() + 1
+    device_rows = []
+    responsibility_rows = []
+    for uid, row in enumerate(rows, start=first_uid):
+        device_rows.append({
+            "uid": uid,
+            "code": row["code"] or None,
+            "article_uid": uid_of("article", row["article"])[0]})
+        responsibility_rows.append({
+            "device_uid": uid,
+            "user_uid": lookup["user", row["user"]],
+            "location_uid": uid_of("location", row["location"])})
+    connection.execute(devices.insert(), device_rows)
+    connection.execute(responsibilities.insert(), responsibility_rows)
+    return new_entries
+
+
+def import_inventory(engine, path, chunk_size=1000):
+    """Import devices and their responsibilities from a CSV or JSON Lines file
+    Every row describes a device with the columns producer, article, code (optional),
+    user (e-mail) and location. Producers, articles and locations that don't exist yet are
+    created, users have to exist already. Invalid rows are reported and skipped, a chunk that
+    fails to write is rolled back and all of its rows are reported.
+
+        Args:
+            engine: Engine of the database to import into
+            path: Path of the CSV or JSON Lines file
+            chunk_size: Number of rows that are written in one transaction
+
+        Returns:
+            ImportReport
+    """
+    report = ImportReport()
+    start = perf_counter()
+    with engine.connect() as connection:
+        lookup = _Lookup(connection)
+    for chunk in chunked(read_rows(path), chunk_size):
+        valid_rows = []
+        lines = []
+        new_articles = {}
+        for line, row in chunk:
+            report.rows += 1
+            if not isinstance(row, dict):
+                report.errors.append((line, "Invalid row"))
+                continue
+            row = _normalize(row)
+            error = _validate(row, lookup, new_articles)
+            if error:
+                report.errors.append((line, error))
+                continue
+            valid_rows.append(row)
+            lines.append(line)
+        if not valid_rows:
+            continue
+        try:
+            with engine.begin() as connection:
+                new_entries = _import_chunk(connection, valid_rows, lookup)
+        except sqlalchemy.exc.DBAPIError as e:
+            logger.error(f"Failed to import chunk at line {lines[0]}: {e}")
+            report.errors.extend((line, f"Chunk failed: {e.orig}") for line in lines)
+        else:
+            lookup.update(new_entries)
+            report.imported += len(valid_rows)
+    report.duration = perf_counter() - start
+    logger.info(f"Bulk import of {path}: {report}")
+    return report
+
+
+def write_rows(rows, f, format_="csv"):
+    """Write rows of export_fields to an open text file as they come in
+
+        Args:
+            rows: Iterable of tuples with the values of export_fields
+            f: File opened in text mode, for csv and tsv with newline=""
+            format_: One of export_formats
+
+        Returns:
+            Number of rows written
+    """
+    if format_ not in export_formats:
+        raise ValueError(f"Unknown export format {format_}")
+    count = 0
+    if format_ == "jsonl":
+        for row in rows:
+            f.write(json.dumps(dict(zip(export_fields, row)), ensure_ascii=False))
+            f.write("\n")
+            count += 1
+        return count
+    writer = csv.writer(f, delimiter="\t" if format_ == "tsv" else ",")
+    writer.writerow(export_fields)
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def _normalize_user(row):
+    """Clean up a user row the same way the constructor of User does"""
+    row = {field: str(row.get(field) or "").strip() for field in user_fields}
+    row["e_mail"] = row["e_mail"].lower()
+    row["name"] = row["name"].title()
+    row["surname"] = row["surname"].title()
+    row["location"] = row["location"].title()
+    return row
+
+
+def _validate_user(row, known_e_mails):
+    """Get the reason why a normalized user row can't be provisioned or None if it's fine"""
+    if not row["e_mail"]:
+        return "Missing e_mail"
+    if row["e_mail"] in known_e_mails:
+        return f"User {row['e_mail']} exists already"
+    try:
+        row["phonenumber"] = classes.PhoneNumber(row["phonenumber"])
+    except classes.PhoneNumber.NoNumberFoundWarning:
+        return f"Invalid phonenumber {row['phonenumber']}"
+    return None
+
+
+def write_credentials(credentials, path):
+    """Write (e_mail, password) pairs to a CSV file that only the owner may read"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(("e_mail", "password"))
+        writer.writerows(credentials)
+
+
+def provision_users(engine, path, credentials_path, generate_password, workers=None, chunksize=16):
+    """Create users from a CSV or JSON Lines file in a single transaction
+    Every row describes a user with the columns e_mail, name, surname, phonenumber, location
+    and password. Rows without a password get a generated one, the generated credentials are
+    written to credentials_path. Locations that don't exist yet are created. The passwords
+    are hashed with the current policy in a process pool since argon2 dominates the cost.
+
+        Args:
+            engine: Engine of the database to provision into
+            path: Path of the CSV or JSON Lines file
+            credentials_path: Path of the CSV file the generated passwords are written to
+            generate_password: Function that returns a new password
+            workers: Number of processes that hash passwords, all cores if None
+            chunksize: Number of passwords that are sent to a process at once
+
+        Returns:
+            ImportReport
+    """
+    report = ImportReport()
+    start = perf_counter()
+    with engine.connect() as connection:
+        known_e_mails = {e_mail for e_mail, in connection.execute(sqlalchemy.select([classes.User.e_mail]))}
+    rows = []
+    credentials = []
+    for line, row in read_rows(path):
+        report.rows += 1
+        if not isinstance(row, dict):
+            report.errors.append((line, "Invalid row"))
+            continue
+        row = _normalize_user(row)
+        error = _validate_user(row, known_e_mails)
+        if error:
+            report.errors.append((line, error))
+            continue
+        known_e_mails.add(row["e_mail"])
+        if not row["password"]:
+            row["password"] = generate_password()
+            credentials.append((row["e_mail"], row["password"]))
+        rows.append(row)
+    if not rows:
+        report.duration = perf_counter() - start
+        return report
+
+    hash_start = perf_counter()
+    settings = {key: config["passwords", key] for key in passwords.policy_keys}
+    with ProcessPoolExecutor(workers) as pool:
+        hashes = list(pool.map(
+            partial(passwords.hash, settings=settings),
+            (row["password"] for row in rows),
+            chunksize=chunksize))
+    hash_duration = perf_counter() - hash_start
+    logger.info(f"Hashed {len(hashes)} passwords in {hash_duration:.2f}s ({len(hashes) / hash_duration:.1f}/s)")
+
+    users = classes.User.__table__
+    phone_numbers = classes.PhoneNumber.__table__
+    locations = classes.Location.__table__
+    try:
+        with engine.begin() as connection:
+            location_uids = dict((name, uid) for uid, name in connection.execute(
+                sqlalchemy.select([locations.c.uid, locations.c.name])))
+            new_locations = sorted({row["location"] for row in rows if row["location"]} - set(location_uids))
+            location_uids.update(_insert_names(connection, locations, new_locations))
+            first_uid = connection.execute(sqlalchemy.select(
+                [sqlalchemy.func.coalesce(sqlalchemy.func.max(users.c.uid), 0)])).scalar() + 1
+            connection.execute(users.insert(), [{
+                    "uid": uid,
+                    "e_mail": row["e_mail"],
+                    "password": hash_,
+                    "salt": classes.User.new_salt(),
+                    "name": row["name"],
+                    "surname": row["surname"],
+                    "is_admin": False,
+                    "location_uid": location_uids.get(row["location"])}
+                for uid, (row, hash_) in enumerate(zip(rows, hashes), start=first_uid)])
+            connection.execute(phone_numbers.insert(), [{
+                    "user_uid": uid,
+                    "raw_string": row["phonenumber"].raw_string,
+                    "country_code": row["phonenumber"].country_code,
+                    "area_code": row["phonenumber"].area_code,
+                    "subscriber_number": row["phonenumber"].subscriber_number,
+                    "extension": row["phonenumber"].extension}
+                for uid, row in enumerate(rows, start=first_uid)])
+    except sqlalchemy.exc.DBAPIError as e:
+        logger.error(f"Failed to provision users from {path}: {e}")
+        report.errors.append((0, f"Transaction failed: {e.orig}"))
+    else:
+        report.imported = len(rows)
+        write_credentials(credentials, credentials_path)
+    report.duration = perf_counter() - start
+    logger.info(f"User provisioning from {path}: {report}")
+    return report
@@ -2,26 +2,78 @@
 This also handles database initialization
 """
 
-from collections import Counter
+from collections import Counter, deque
+from math import ceil
 import hashlib
 import re
 from secrets import randbits
 from threading import Lock, Thread
-from time import sleep, time
+from time import perf_counter, sleep, time
 
-import cv2
-from passlib.hash import argon2
 import sqlalchemy
 from sqlalchemy import Boolean, Column, Float, Integer, LargeBinary, String
 from sqlalchemy.ext.declarative import declarative_base
-from PyQt5.QtGui import QImage, QPixmap
 
+from config import config
 from logger import logger
+import frames
+import migrations
+import passwords
 from utils import absolute_path
 
 orm = sqlalchemy.orm
 
 Base = declarative_base()
+
+
+def create_engine(path, profile=None):
+    """Create an engine for the SQLite database at path
+    The profile is applied to every new connection through a connect event and the
+    connections are pooled so that background threads can reuse them
+
+        Args:
+            path: Path of the database file
+            profile (dict): Settings as found in the database section of config.ini,
+                None leaves SQLite's and SQLAlchemy's defaults untouched
+
+        Raises:
+            ValueError: If journal_mode or synchronous in profile aren't valid SQLite modes
+    """
+    if profile is None:
+        return sqlalchemy.create_engine(f"sqlite:///{path}", echo=False)
+
+    journal_mode = str(profile["journal_mode"]).upper()
+    synchronous = str(profile["synchronous"]).upper()
+    if journal_mode not in ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"):
+        raise ValueError(f"Invalid journal_mode {journal_mode}")
+    if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Invalid synchronous level {synchronous}")
+    pragmas = (
+        f"PRAGMA journal_mode={journal_mode}",
+        f"PRAGMA synchronous={synchronous}",
+        f"PRAGMA cache_size={int(profile['cache_size'])}",
+        f"PRAGMA mmap_size={int(profile['mmap_size'])}",
+        f"PRAGMA busy_timeout={int(profile['busy_timeout'])}")
+
+    engine = sqlalchemy.create_engine(
+        f"sqlite:///{path}", 
+        echo=False, 
+        connect_args={"check_same_thread": False}, # connections are only shared via the pool
+        poolclass=sqlalchemy.pool.QueuePool,
+        pool_size=int(profile["pool_size"]),
+        pool_timeout=float(profile["pool_timeout"]))
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def apply_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+engine_profile = {key: config["database", key] for key in config.options("database")}
 if __name__ == "__main__":
     print("")
     if not input("Warning! Do you really want to delete the database and write some example data to it? [y/N]: ") in ("y", "Y"):
@@ -30,7 +82,7 @@ if __name__ == "__main__":
     logger.info("Database cleared! This was authorized via a prompt")
     with open(absolute_path("test.db"), "w") as f:
         f.flush()
-engine = sqlalchemy.create_engine(f"sqlite:///{absolute_path('test.db')}", echo=False)
+engine = create_engine(absolute_path("test.db"), engine_profile)
 # engine = sqlalchemy.create_engine("sqlite:///:memory:", echo=False)
 
 
@@ -54,12 +106,17 @@ class BigInt(sqlalchemy.types.TypeDecorator):
         return int(value)
 
 
-def setup_context_session(engine):
+def setup_context_session(engine, refresh="batched"):
     """Factory for contextmanagers for Session objects
     Initialize a ContextSession class
 
         Args:
             engine (sqlalchemy.engine.base.Engine): Engine that's bound to the sessionmaker
+            refresh (str): Default strategy for reloading the instances that were added to a
+                session once it's committed. Can be overridden per session.
+                "none": Nothing is reloaded, instances keep the state they had at commit
+                "batched": Instances are reloaded with one IN query per mapped class before
+                    the session is closed, suits the UI handlers that read them afterwards
 
         Example:
             engine = sqlalchemy.create_engine('sqlite:///:memory:')
@@ -67,13 +124,17 @@ def setup_context_session(engine):
             with CSession() as session:
                 session.add(user1)
                 session.add(user2)
+            with CSession(refresh="none") as session:
+                session.add_all(devices)
     """
     class ContextSession():
         _engine = engine
+        refresh_strategies = ("none", "batched")
+        max_parameters = 999 # SQLite's default limit of bound parameters per statement
 
         class _StateKeepingSession(orm.session.Session):
-            def __init__(self):
-                super().__init__(bind=engine)
+            def __init__(self, expire_on_commit=True):
+                super().__init__(bind=engine, expire_on_commit=expire_on_commit)
                 self.instances = []
 
             def add(self, instance, *args, **kwargs):
@@ -84,25 +145,93 @@ def setup_context_session(engine):
                 self.instances += instances
                 super().add_all(instances, *args, **kwargs)
 
+        def __init__(self, refresh=refresh):
+            if refresh not in self.refresh_strategies:
+                raise ValueError(f"Unknown refresh strategy {refresh}")
+            self.refresh = refresh
+
         def __enter__(self):
-            self.session = self._StateKeepingSession()
+            self.session = self._StateKeepingSession(expire_on_commit=self.refresh != "none")
             return self.session
 
+        def _refresh_batched(self):
+            """Reload all persistent instances with one query per mapped class
+            Relationships that are loaded immediately anyway are loaded with one more query each,
+            lazy relationships stay lazy
+            """
+            identities = {}
+            for instance in self.session.instances:
+                state = sqlalchemy.inspect(instance)
+                if state.persistent:
+                    identities.setdefault(type(instance), set()).add(state.identity)
+            for class_, class_identities in identities.items():
+                mapper = sqlalchemy.inspect(class_)
+                primary_key = mapper.primary_key
+                eager = [
+                    orm.selectinload(getattr(class_, relationship.key))
+                    for relationship in mapper.relationships if relationship.lazy == "immediate"]
+                class_identities = list(class_identities)
+                batch_size = self.max_parameters // len(primary_key)
+                for i in range(0, len(class_identities), batch_size):
+                    batch = class_identities[i:i + batch_size]
+                    if len(primary_key) == 1:
+                        criterion = primary_key[0].in_([identity[0] for identity in batch])
+                    else:
+                        criterion = sqlalchemy.or_(*(
+                            sqlalchemy.and_(*(column == value for column, value in zip(primary_key, identity)))
+                            for identity in batch))
+                    self.session.query(class_).filter(criterion).\
+                        options(*eager).populate_existing().all()
+
         def __exit__(self, exc_type, exc_value, traceback):
             if exc_value or exc_type or traceback:
                 self.session.rollback()
                 return False # propagate exceptions upwards
             else:
                 self.session.commit()
-                # [self.session.refresh(instance) for instance in self.session.instances] if I didn't mess up the map below, this can be deleted
-                for x in map(self.session.refresh, self.session.instances):
-                    pass # refresh all instances via side effect of map
+                if self.refresh == "batched":
+                    self._refresh_batched()
                 self.session.expunge_all()
                 self.session.close()
                 return True
     return ContextSession
 
 
+class QueryCounter():
+    """Contextmanager that counts the statements an engine executes while it's active
+
+        Args:
+            engine (sqlalchemy.engine.base.Engine): Engine whose statements are counted, or a
+                Connection to only count the statements of e.g. one session
+
+        Attributes:
+            queries: Number of statements that were executed inside the with-block
+            duration: Time in seconds that was spent inside the with-block
+
+        Example:
+            with QueryCounter(engine) as counter:
+                build_something()
+            logger.info(f"{counter.queries} queries in {counter.duration:.3f}s")
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.queries = 0
+        self.duration = 0.0
+
+    def _count(self, *args, **kwargs):
+        self.queries += 1
+
+    def __enter__(self):
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self._count)
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = perf_counter() - self._start
+        sqlalchemy.event.remove(self.engine, "before_cursor_execute", self._count)
+        return False
+
+
 class Producer(Base):
     """Represents a producer of articles"""
     __tablename__ = "producers"
@@ -122,7 +251,7 @@ class Article(Base):
     __tablename__ = "articles"
     uid = Column(Integer, primary_key=True)
     name = Column(String, unique=True)
-    producer_uid = Column(Integer, sqlalchemy.ForeignKey("producers.uid"))
+    producer_uid = Column(Integer, sqlalchemy.ForeignKey("producers.uid"), index=True)
     #last_price = Column(Float(asdecimal=True))
     devices = orm.relationship(
         "Device", 
@@ -140,7 +269,7 @@ class Device(Base):
     """Represents a device"""
     __tablename__ = "devices"
     uid = Column(Integer, primary_key=True)
-    article_uid = Column(Integer, sqlalchemy.ForeignKey("articles.uid"))
+    article_uid = Column(Integer, sqlalchemy.ForeignKey("articles.uid"), index=True)
     code = Column(String)
     responsibility = orm.relationship(
         "Responsibility", 
@@ -251,6 +380,7 @@ class Location(Base):
 class User(Base):
     """Represents a user of the application"""
     __tablename__ = "users"
+    __table_args__ = (sqlalchemy.Index("ix_users_name_surname", "name", "surname"), )
     uid = Column(Integer, primary_key=True)
     e_mail = Column(String, unique=True)
     password = Column(LargeBinary)
@@ -289,18 +419,14 @@ class User(Base):
         return randbits(128)
 
     def hash(self, password):
-        """Hash a string with argon2
-        The salt is concatenated with the e_mail to get the final salt
+        """Hash a string with argon2 using the current policy of the passwords module
+        The complete PHC string including the salt and cost parameters is stored
         """
-        salt = f"{self.salt}{self.e_mail}".encode()
-        hash = argon2.using(
-            salt=salt, 
-            rounds=512, 
-            memory_cost=1024, 
-            max_threads=8, 
-            digest_size=256).hash(password)
-        self.password = re.match(r"\$argon2i\$v=\d+\$m=\d+,t=\d+,p=\d+\$(?P<hash>.+)", hash).\
-            group("hash").encode()
+        self.password = passwords.hash(password)
+
+    def verify(self, password):
+        """Check a password against the stored hash, works for hashes of any policy"""
+        return passwords.verify(password, self.password)
 
     def __str__(self):
         return f"{self.name} {self.surname}".title()
@@ -309,9 +435,11 @@ class User(Base):
 class Responsibility(Base):
     """Represents a responsibility a User has for a Device"""
     __tablename__ = "responsibilities"
+    __table_args__ = (
+        sqlalchemy.Index("ix_responsibilities_location_user_device", "location_uid", "user_uid", "device_uid"), )
     device_uid = Column(Integer, sqlalchemy.ForeignKey("devices.uid"), primary_key=True)
-    user_uid = Column(Integer, sqlalchemy.ForeignKey("users.uid"), primary_key=True)
-    location_uid = Column(Integer, sqlalchemy.ForeignKey("locations.uid"), primary_key=True)
+    user_uid = Column(Integer, sqlalchemy.ForeignKey("users.uid"), primary_key=True, index=True)
+    location_uid = Column(Integer, sqlalchemy.ForeignKey("locations.uid"), primary_key=True, index=True)
     
     def __init__(self, device=None, user=None, location=None):
         self.device = device
@@ -323,6 +451,7 @@ class Responsibility(Base):
 
 
 Base.metadata.create_all(bind=engine) # Database initialized
+migrations.migrate(engine) # existing tables brought up to date
 logger.info("Database initialized, tables verified")
 
 
@@ -393,69 +522,185 @@ class Timeout(Thread):
         self.run() 
 
 
+class CodeCooldown():
+    """Table of recently recognized codes that mustn't be recognized again until their time to live ran out
+    Other codes aren't affected, so devices can be scanned one after the other without waiting.
+    One table can be shared by the VideoStreamUISyncs of several cameras.
+
+        Args:
+            ttl: Seconds a code is suppressed after it was accepted
+
+        Attributes:
+            expiries: dict of code to the time its suppression ends
+            lock: mutex for expiries
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.expiries = {}
+        self.lock = Lock()
+
+    def accept(self, code, timestamp):
+        """Check whether a code may be recognized and suppress it for ttl seconds if so
+
+            Args:
+                code: The recognized code
+                timestamp: Time of the recognition in seconds, e.g. time.monotonic()
+
+            Returns:
+                False if the code is still suppressed, True otherwise
+        """
+        with self.lock:
+            for expired in [code for code, expiry in self.expiries.items() if expiry <= timestamp]:
+                del self.expiries[expired]
+            if code in self.expiries:
+                return False
+            self.expiries[code] = timestamp + self.ttl
+            return True
+
+
+voter_keys = ("window", "min_ratio", "min_hits")
+
+
+class CodeVoter():
+    """Confirms codes that were found in enough of the frames of the last window seconds
+    Every frame is a vote, frames without codes count against all codes, so stray decodes
+    never add up. The number of hits a code needs follows the measured frame rate, so
+    confirming a code takes the same time on slow and fast machines.
+    Only the frames of the last window seconds are kept.
+
+        Args:
+            window: Length of the voting window in seconds
+            min_ratio: Fraction of the frames in the window a code has to be found in
+            min_hits: Lower bound for the hits a code needs, so single frames never confirm codes
+
+        Attributes:
+            frames: deque of (timestamp, set of codes) of the frames in the window
+            hits: Counter of the frames in the window every code was found in
+            appeared: Codes of the last frame that weren't in the window before
+            interval: Moving average of the time between frames in seconds, None until the second frame
+    """
+    def __init__(self, window=0.5, min_ratio=0.5, min_hits=3):
+        self.window = window
+        self.min_ratio = min_ratio
+        self.min_hits = min_hits
+        self.frames = deque()
+        self.hits = Counter()
+        self.appeared = []
+        self.interval = None
+
+    @property
+    def fps(self):
+        """Measured frame rate, None until the second frame"""
+        return 1 / self.interval if self.interval else None
+
+    def required_hits(self):
+        """Number of hits that confirm a code at the measured frame rate"""
+        if not self.fps:
+            return self.min_hits
+        return max(self.min_hits, ceil(self.min_ratio * self.fps * self.window))
+
+    def observe(self, timestamp, found_codes):
+        """Add the codes of a frame to the window
+
+            Args:
+                timestamp: Time the frame was captured at in seconds
+                found_codes: List of the codes in the frame
+
+            Returns:
+                List of the codes that are confirmed by the window
+        """
+        if self.frames:
+            interval = timestamp - self.frames[-1][0]
+            self.interval = interval if self.interval is None else 0.9 * self.interval + 0.1 * interval
+        codes = set(found_codes)
+        self.appeared = [code for code in codes if code not in self.hits]
+        self.frames.append((timestamp, codes))
+        self.hits.update(codes)
+        while self.frames[0][0] <= timestamp - self.window:
+            self.hits.subtract(self.frames.popleft()[1])
+        for code in [code for code, hits in self.hits.items() if hits <= 0]:
+            del self.hits[code]
+        required = self.required_hits()
+        return [
+            code for code in codes
+            if self.hits[code] >= required and self.hits[code] >= self.min_ratio * len(self.frames)]
+
+
 class VideoStreamUISync(Thread):
     """Class to tie a LazyVideoStream to some canvas in Qt
+    The thread recognizes barcodes in the code stream of the videostream. The display frames
+    are shown by show_frame, which runs in the GUI thread, so create instances in the GUI thread.
+
         Args:
-            canvas: canvas has to be able to take pixmaps/implement setPixmap
+            canvas: canvas has to be able to take pixmaps/implement setPixmap, None to only
+                recognize barcodes
             videostream: Instance of LazyVideoStream that supplies the frames
-            signal: qt-signal that's emitted if a barcode has been recognized
-            job: set to "both", "codes" or "frames" to set whether it should 
-                only process image data, barcodes and signals or both
+            signal: qt-signal that's emitted with the data of a recognized barcode
+                and the id of the camera it was recognized by
+            cooldown: CodeCooldown that suppresses codes which were just recognized,
+                a new one with the cooldown from the config if None
+            seen_signal: qt-signal that's emitted like signal as soon as a code shows up,
+                before it's confirmed, e.g. to prefetch what's shown once it's recognized
 
         Attributes:
-            barcodes: Counter that holds all found barcodes USE barcode_lock WHEN ACCESSING!
-            barcode_lock: Lock for barcodes
-            sensibility: How often a barcode has to be recognized to count it as valid
+            voter: CodeVoter with the window from the recognition section of the config
+            codes: Queue of the code stream of videostream
+            display: LatestFrame display of videostream, None if there's no canvas
     """
-    def __init__(self, canvas, videostream, signal, job="both"):
+    def __init__(self, canvas, videostream, signal, cooldown=None, seen_signal=None):
         super().__init__(name=f"{self.__class__.__name__}Thread_{id(self)}")
         self.canvas = canvas
         self.videostream = videostream
         self.daemon = True
-        self.barcodes = Counter()
-        self.barcode_lock = Lock()
-        self.sensibility = 10
+        self.voter = CodeVoter(**{key: config["recognition", key] for key in voter_keys})
         self.signal = signal
-        self.job = job
+        self.seen_signal = seen_signal
+        self.cooldown = cooldown if cooldown else CodeCooldown(config["recognition", "cooldown"])
+        self.codes = videostream.subscribe_codes()
+        self.display = None
+        if canvas is not None:
+            self.display = videostream.subscribe_display()
+            self.display.ready.connect(self.show_frame)
 
     @staticmethod
     def _matrice_to_QPixmap(frame):
         """Convert cv2/numpy matrice to a Qt QPixmap"""
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        height, width, channel = frame.shape
-        image = QImage(frame.data, width, height, 3 * width, QImage.Format_RGB888)
-        return QPixmap(image)
+        return frames.to_qpixmap(frame)
 
-    def get_most_common(self):
-        """Get barcode with highest occurence"""
-        with self.barcode_lock:
-            return self.barcodes.most_common(1)[0]
+    def show_frame(self):
+        """Show the newest display frame on the canvas, runs in the GUI thread"""
+        frame = self.display.take()
+        if frame is None:
+            return
+        pixmap = self._matrice_to_QPixmap(frame)
+        self.videostream.release(frame)
+        self.canvas.setPixmap(pixmap)
+        # scale the next frames to the canvas already
+        self.videostream.target_resolution = (self.canvas.width(), self.canvas.height())
+
+    def observe(self, timestamp, found_codes):
+        """Vote with the codes of a frame and get the ones that are recognized with it
 
-    def reset_counter(self):
-        with self.barcode_lock:
-            self.barcodes = Counter()
+            Args:
+                timestamp: Time the frame was captured at in seconds
+                found_codes: List of (type, data) of the codes in the frame
 
-    def update_counter(self, found_codes):
-        with self.barcode_lock:
-            self.barcodes.update(found_codes)
+            Returns:
+                List of (type, data) of the recognized codes that aren't cooling down
+        """
+        confirmed = self.voter.observe(timestamp, found_codes)
+        return [code for code in confirmed if self.cooldown.accept(code, timestamp)]
 
     def run(self):
-        """Start synchronization"""
+        """Start recognizing barcodes"""
         while True:
-            self.videostream.request_queue.put(True)
-            frame, found_codes = self.videostream.frame_queue.get()
-            if self.job == "frames" or self.job == "both":
-                pixmap = self._matrice_to_QPixmap(frame)
-                self.canvas.setPixmap(pixmap)
-            elif self.job == "codes" or self.job == "both":
-                if found_codes:
-                    self.update_counter(found_codes)
-                    most_common = self.get_most_common()
-                    if most_common[1] > self.sensibility:
-                        self.signal.emit(most_common[0][1])
-                        self.reset_counter()
-                        sleep(10)
-            cv2.waitKey(1)
+            timestamp, found_codes = self.codes.get()
+            recognized = self.observe(timestamp, found_codes)
+            if self.seen_signal is not None:
+                for barcode_type, data in self.voter.appeared:
+                    self.seen_signal.emit(data, self.videostream.camera_id)
+            for barcode_type, data in recognized:
+                self.signal.emit(data, self.videostream.camera_id)
 
 
 if __name__ == "__main__":
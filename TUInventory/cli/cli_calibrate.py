@@ -0,0 +1,29 @@
+"""Password policy calibration command line interface
+Measures argon2 on this machine and picks the cost parameters that hit a target verification time
+"""
+
+from argparse import ArgumentParser
+import pathlib
+import sys
+from sys import exit, stderr, stdout
+
+parser = ArgumentParser(description="Calibrate the argon2 password policy to a target verification time")
+parser.add_argument("-t", "--target", dest="target", type=float, default=0.5, help="Verification time in seconds")
+parser.add_argument("-p", "--parallelism", dest="parallelism", type=int, help="Number of lanes, configured value if omitted")
+parser.add_argument("-m", "--max_memory", dest="max_memory", type=int, default=1048576, help="Upper bound for memory_cost in KiB")
+parser.add_argument("-w", "--write", dest="write", action="store_true", help="Store the parameters as the new policy in the config")
+
+args = parser.parse_args()
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from config import config
+import passwords
+
+settings, seconds = passwords.calibrate(args.target, args.parallelism, args.max_memory)
+stdout.write(" ".join(f"{key}={value}" for key, value in settings.items()) + f" verify={seconds:.3f}s\n")
+if args.write:
+    for key, value in settings.items():
+        config["passwords", key] = value
+    config.flush()
+    stderr.write("Stored as new password policy, existing hashes are updated on the next login\n")
+exit(0)
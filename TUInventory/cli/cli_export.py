@@ -0,0 +1,34 @@
+"""Inventory export command line interface
+Streams all devices with article, producer, user and location into a CSV, JSON Lines or TSV file
+"""
+
+from argparse import ArgumentParser
+import pathlib
+import sys
+from sys import exit, stderr, stdout
+from time import perf_counter
+
+parser = ArgumentParser(description="Export the inventory to a CSV, JSON Lines or TSV file")
+parser.add_argument("-o", "--output", dest="path", type=str, help="Path to output file, stdout if omitted")
+parser.add_argument("-f", "--format", dest="format_", choices=("csv", "jsonl", "tsv"), default="csv", help="Output format")
+parser.add_argument("-l", "--location", dest="location", type=str, help="Only export devices at this location")
+parser.add_argument("-u", "--user", dest="user", type=str, help="Only export devices of the user with this e-mail")
+parser.add_argument("-p", "--producer", dest="producer", type=str, help="Only export devices by this producer")
+parser.add_argument("-b", "--batch_size", dest="batch_size", type=int, default=1000, help="Rows fetched at once")
+
+args = parser.parse_args()
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import bulk
+import slots
+
+rows = slots.export_inventory(args.location, args.user, args.producer, args.batch_size)
+start = perf_counter()
+if args.path:
+    with open(args.path, "w", newline="", encoding="utf-8") as f:
+        count = bulk.write_rows(rows, f, args.format_)
+else:
+    count = bulk.write_rows(rows, stdout, args.format_)
+duration = perf_counter() - start
+stderr.write(f"Exported {count} rows in {duration:.2f}s\n")
+exit(0)
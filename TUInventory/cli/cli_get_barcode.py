@@ -1,51 +1,176 @@
-"""Simple barcodereader command line interface"""
+"""Simple barcodereader command line interface
+Decodes a single image, or with --batch all images of directories and glob patterns in
+parallel. Batches are written as JSON Lines to stdout while the files finish, one line per
+found code and one line with an error for every file that failed.
+"""
 
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import glob
+from itertools import islice
+import json
+import os
+import pathlib
+import sys
 from sys import exit, stderr, stdout
+from time import perf_counter
 
-parser = ArgumentParser(description="Extract all barcodes from an image")
-parser.add_argument("-i", "--image", dest="path", type=str, help="Path to image")
-parser.add_argument("-d", "--detailed", dest="detailed", action="store_true", help="Return all extracted information")
-parser.add_argument("-tb", "--enable_tracebacks", dest="enable_tracebacks", action="store_true", help="Enable tracebacks rather than custom messages")
-
-args = parser.parse_args()
-path = args.path
-detailed = args.detailed
-enable_tracebacks = args.enable_tracebacks
-
-try:
-    from cv2 import imread
-except ImportError as e:
-    if enable_tracebacks:
-        raise e
-    exit("Failed to import OpenCV (Module cv2)")
-try:
-    from pyzbar import pyzbar
-except ImportError as e:
-    if enable_tracebacks:
-        raise e
-    exit("Failed to import pyzbar")
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from utils import image_suffixes
+
+
+def image_paths(patterns):
+    """Yield the images of directories and the images matching glob patterns"""
+    for pattern in patterns:
+        path = pathlib.Path(pattern)
+        children = sorted(path.iterdir()) if path.is_dir() else map(pathlib.Path, glob.iglob(pattern, recursive=True))
+        for child in children:
+            if child.suffix.lower() in image_suffixes and child.is_file():
+                yield str(child)
 
 
-if not path:
-    stderr.write("No path provided\n")
-    exit(1)
+def decode_file(path):
+    """Decode all barcodes of an image, runs in the worker processes of a batch
 
-try:
-    image = imread(path)
+        Returns:
+            List of dicts with path, symbology, data, polygon and decode_ms of every code,
+            a single dict with path and error if the file couldn't be decoded
+    """
+    from cv2 import IMREAD_GRAYSCALE, imread
+
+    image = imread(path, IMREAD_GRAYSCALE) # zbar only scans grayscale anyway
+    if image is None:
+        return [{"path": path, "error": "no valid image"}]
+    from pyzbar import pyzbar
+    start = perf_counter()
     barcodes = pyzbar.decode(image)
+    decode_ms = round((perf_counter() - start) * 1000, 3)
     if not barcodes:
-        stderr.write("Couldn't find any barcodes\n")
+        return [{"path": path, "error": "no barcodes", "decode_ms": decode_ms}]
+    return [{
+        "path": path,
+        "symbology": barcode.type,
+        "data": barcode.data.decode("utf-8", "replace"),
+        "polygon": [[point.x, point.y] for point in barcode.polygon],
+        "decode_ms": decode_ms} for barcode in barcodes]
+
+
+def decode_batch(patterns, workers=None, output=stdout, decode=decode_file):
+    """Decode the images of patterns in worker processes and write the results as JSON Lines
+    At most two files per worker are in flight, so memory stays bounded for any number of files.
+    If a worker process dies, e.g. because zbar crashed on a corrupt file, the pool is started
+    again and the files that were in flight are decoded one at a time, so only the file that
+    crashed its worker is reported as failed.
+
+        Args:
+            patterns: Directories or glob patterns of the images
+            workers: Number of worker processes, one per CPU core if None
+            output: Text file the JSON Lines are written to
+            decode: Function that decodes a file in the workers, see decode_file
+
+        Returns:
+            Tuple of the number of files and the number of files that failed
+    """
+    workers = workers if workers else os.cpu_count()
+    paths = image_paths(patterns)
+    suspects = [] # files that were in flight when a worker died
+    files = failed = 0
+    pending = {}
+    executor = ProcessPoolExecutor(workers)
+
+    def submit(path):
+        try:
+            future = executor.submit(decode, path)
+        except BrokenProcessPool as e: # a worker died since the last results came in
+            future = Future()
+            future.set_exception(e)
+        pending[future] = path
+
+    try:
+        while True:
+            if not suspects:
+                for path in islice(paths, 2 * workers - len(pending)):
+                    submit(path)
+            elif not pending:
+                submit(suspects.pop(0))
+            if not pending:
+                return files, failed
+            isolated = len(pending) == 1 # a crash can only be caused by this file
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                done, _ = wait(pending) # the other files in flight fail as well
+                executor.shutdown()
+                executor = ProcessPoolExecutor(workers)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    lines = future.result()
+                except BrokenProcessPool:
+                    if not isolated:
+                        suspects.append(path)
+                        continue
+                    lines = [{"path": path, "error": "worker process crashed"}]
+                except Exception as e:
+                    lines = [{"path": path, "error": str(e)}]
+                files += 1
+                failed += "error" in lines[0]
+                for line in lines:
+                    output.write(json.dumps(line) + "\n")
+                output.flush()
+    finally:
+        executor.shutdown()
+
+
+if __name__ == "__main__": # the worker processes of a batch import this module again
+    parser = ArgumentParser(description="Extract all barcodes from an image")
+    parser.add_argument("-i", "--image", dest="path", type=str, help="Path to image")
+    parser.add_argument("-b", "--batch", dest="batch", nargs="+", help="Directories or glob patterns of images, results are written as JSON Lines")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, help="Processes that decode a batch, all cores if omitted")
+    parser.add_argument("-d", "--detailed", dest="detailed", action="store_true", help="Return all extracted information")
+    parser.add_argument("-tb", "--enable_tracebacks", dest="enable_tracebacks", action="store_true", help="Enable tracebacks rather than custom messages")
+
+    args = parser.parse_args()
+    path = args.path
+    detailed = args.detailed
+    enable_tracebacks = args.enable_tracebacks
+
+    try:
+        from cv2 import imread
+    except ImportError as e:
+        if enable_tracebacks:
+            raise e
+        exit("Failed to import OpenCV (Module cv2)")
+    try:
+        from pyzbar import pyzbar
+    except ImportError as e:
+        if enable_tracebacks:
+            raise e
+        exit("Failed to import pyzbar")
+
+    if args.batch:
+        files, failed = decode_batch(args.batch, args.workers)
+        stderr.write(f"Decoded {files - failed} of {files} files\n")
+        exit(0)
+
+    if not path:
+        stderr.write("No path provided\n")
         exit(1)
-except TypeError as e:
-    if enable_tracebacks:
-        raise e
-    stderr.write(f"There's no valid image at {path}\n")
-    exit(1)
-
-
-if detailed:
-    stdout.write(str(barcodes))
-else:
-    stdout.write(barcodes[0].data.decode("utf-8"))
-exit(0)
\ No newline at end of file
+
+    try:
+        image = imread(path)
+        barcodes = pyzbar.decode(image)
+        if not barcodes:
+            stderr.write("Couldn't find any barcodes\n")
+            exit(1)
+    except TypeError as e:
+        if enable_tracebacks:
+            raise e
+        stderr.write(f"There's no valid image at {path}\n")
+        exit(1)
+
+    if detailed:
+        stdout.write(str(barcodes))
+    else:
+        stdout.write(barcodes[0].data.decode("utf-8"))
+    exit(0)
@@ -0,0 +1,31 @@
+"""Bulk import command line interface
+Imports devices with their responsibilities from CSV or JSON Lines files
+with the columns producer, article, code, user (e-mail) and location
+"""
+
+from argparse import ArgumentParser
+import pathlib
+import sys
+from sys import exit, stderr, stdout
+
+parser = ArgumentParser(description="Import devices and their responsibilities from a CSV or JSON Lines file")
+parser.add_argument("-i", "--input", dest="path", type=str, help="Path to CSV or JSON Lines file")
+parser.add_argument("-c", "--chunk_size", dest="chunk_size", type=int, default=1000, help="Rows per transaction")
+
+args = parser.parse_args()
+
+if not args.path:
+    stderr.write("No path provided\n")
+    exit(1)
+if not pathlib.Path(args.path).is_file():
+    stderr.write(f"There's no file at {args.path}\n")
+    exit(1)
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import slots
+
+report = slots.import_inventory(args.path, args.chunk_size)
+for line, message in report.errors:
+    stderr.write(f"line {line}: {message}\n")
+stdout.write(f"{report}\n")
+exit(1 if report.errors else 0)
@@ -0,0 +1,35 @@
+"""Bulk user provisioning command line interface
+Creates users from CSV or JSON Lines files with the columns e_mail, name, surname,
+phonenumber, location and password (optional, generated if empty)
+"""
+
+from argparse import ArgumentParser
+import pathlib
+import sys
+from sys import exit, stderr, stdout
+
+if __name__ == "__main__": # the processes that hash passwords may import this module again
+    parser = ArgumentParser(description="Create users from a CSV or JSON Lines file")
+    parser.add_argument("-i", "--input", dest="path", type=str, help="Path to CSV or JSON Lines file")
+    parser.add_argument("-o", "--output", dest="credentials", type=str, default="credentials.csv", help="Path the generated passwords are written to")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, help="Processes that hash passwords, all cores if omitted")
+
+    args = parser.parse_args()
+
+    if not args.path:
+        stderr.write("No path provided\n")
+        exit(1)
+    if not pathlib.Path(args.path).is_file():
+        stderr.write(f"There's no file at {args.path}\n")
+        exit(1)
+
+    sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+    import slots
+
+    report = slots.provision_users(args.path, args.credentials, args.workers)
+    for line, message in report.errors:
+        stderr.write(f"line {line}: {message}\n")
+    stdout.write(f"{report}\n")
+    if report.imported:
+        stdout.write(f"Generated credentials written to {args.credentials}\n")
+    exit(1 if report.errors else 0)
@@ -66,14 +66,58 @@ if not config.config_file.exists():
     config["timeout"] = 15.0
     config.flush()
 config.read()
+if not config.has_section("database"):
+    config["database", "journal_mode"] = "WAL"
+    config["database", "synchronous"] = "NORMAL"
+    config["database", "cache_size"] = -16000 # negative values are in KiB
+    config["database", "mmap_size"] = 268435456
+    config["database", "busy_timeout"] = 5000 # ms
+    config["database", "pool_size"] = 5
+    config["database", "pool_timeout"] = 30.0
+    config.flush()
+if not config.has_section("login"):
+    config["login", "parallel_verifications"] = 2 # argon2 verifications that may run at once
+    config.flush()
+if not config.has_section("passwords"): # argon2 policy, see passwords.calibrate
+    config["passwords", "rounds"] = 3
+    config["passwords", "memory_cost"] = 65536 # KiB
+    config["passwords", "parallelism"] = 4
+    config.flush()
+if not config.has_section("motion"): # decoding is skipped while the camera image doesn't change
+    config["motion", "enabled"] = True
+    config["motion", "pixel_threshold"] = 25 # grayscale difference of a changed pixel
+    config["motion", "min_area"] = 0.002 # fraction of changed pixels that counts as motion
+    config["motion", "hold"] = 1.5 # seconds frames are still decoded after the last motion
+    config.flush()
+if not config.has_section("cameras"):
+    config["cameras", "ids"] = "0" # comma separated, the first camera is shown in the UI
+    config["cameras", "decoder_workers"] = 2 # workers that decode the frames of all cameras
+    config.flush()
+if not config.has_section("recognition"):
+    config["recognition", "cooldown"] = 10.0 # seconds until the same code is recognized again
+    config.flush()
+if not config.has_option("recognition", "window"): # see classes.CodeVoter
+    config["recognition", "window"] = 0.5 # seconds of frames a code is confirmed by
+    config["recognition", "min_ratio"] = 0.5 # fraction of these frames it has to be found in
+    config["recognition", "min_hits"] = 3
+    config.flush()
+if not config.has_option("recognition", "device_cache_size"):
+    config["recognition", "device_cache_size"] = 256 # scanned devices whose texts are kept
+    config.flush()
+if not config.has_option("cameras", "decoder_backend"):
+    config["cameras", "decoder_backend"] = "threads" # or "processes" to decode outside of the GIL
+    config.flush()
+
+
+def camera_ids():
+    """Get the ids of the configured cameras"""
+    return [int(camera_id) for camera_id in config["cameras", "ids"].split(",") if camera_id.strip()]
 
 
 class SettingsManger(Thread):
-    def __init__(self, video_ui_sync_1, video_ui_sync_2, videostream):
+    def __init__(self, videostreams):
         super().__init__(name=f"{self.__class__.__name__}Thread_{id(self)}")
-        self.video_ui_sync_1 = video_ui_sync_1
-        self.video_ui_sync_2 = video_ui_sync_2
-        self.videostream = videostream
+        self.videostreams = videostreams
         self.event = Event()
         self.daemon = True
 
@@ -82,4 +126,5 @@ class SettingsManger(Thread):
             self.event.wait()
             self.event.clear()
             config.read()
-            self.videostream.mirror = config["mirror"]
\ No newline at end of file
+            for videostream in self.videostreams:
+                videostream.mirror = config["mirror"]
\ No newline at end of file
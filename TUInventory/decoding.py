@@ -0,0 +1,476 @@
+"""Barcode decoding on grayscale, downscaled copies of the frames
+zbar only scans 8 bit grayscale images, pyzbar hands it the first channel of colour frames.
+Converting to grayscale ourselves and scanning a downscaled copy is a lot cheaper for codes
+held in front of the camera. The scale adapts to the size of the codes that were found and
+the full resolution is only scanned again if the downscaled copy looks like it contains a code.
+A MotionGate in front of the decoder skips decoding altogether while nothing moves.
+The cameras share the worker threads of a DecoderPool, or the worker processes of a
+ProcessDecoderPool that get the frames through shared memory.
+"""
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
+import sys
+from threading import Lock
+import types
+from time import monotonic, perf_counter
+
+import cv2
+import numpy as np
+
+from config import config
+from frames import BufferPool
+
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None # the zbar library is missing, decoders need an explicit decode function
+
+motion_keys = ("pixel_threshold", "min_area", "hold")
+
+
+class DecodeStatistics():
+    """Decode times and scale of the frames of one camera
+
+        Attributes:
+            scale: Current scale of the downscaled copy, None until the first frame
+            misses: Number of frames in a row without any codes
+            durations: Decode times of the last frames in seconds
+            frames: Number of decoded frames
+            full_scans: Number of frames that were scanned at full resolution again
+    """
+    def __init__(self):
+        self.scale = None
+        self.misses = 0
+        self.durations = deque(maxlen=100)
+        self.frames = 0
+        self.full_scans = 0
+
+    @property
+    def last_duration(self):
+        """Decode time of the last frame in milliseconds"""
+        return self.durations[-1] * 1000 if self.durations else 0.0
+
+    @property
+    def mean_duration(self):
+        """Mean decode time of the last frames in milliseconds"""
+        return sum(self.durations) / len(self.durations) * 1000 if self.durations else 0.0
+
+
+class AdaptiveDecoder(DecodeStatistics):
+    """Finds barcodes in frames by scanning a grayscale copy at an adaptive scale
+    The decode times and the scale are kept as described in DecodeStatistics. Once no codes
+    were found for decay_frames frames, the scale falls back to the one of base_width, so a
+    single small code doesn't keep all later frames at a high resolution.
+
+        Args:
+            decode: Function that scans a grayscale image and returns pyzbar's Decoded tuples,
+                pyzbar.decode if None
+            base_width: Width of the downscaled copy before any codes were found
+            min_scale: Lower bound for the scale
+            code_size: Tuple of (min, max) length of the shortest side of a code in pixels of
+                the downscaled copy, the scale is adapted once a code is outside of this range
+            candidate_size: Side length of the square that's checked for a suspected code
+            candidate_density: Fraction of edge pixels in a square that makes it a suspected code
+            decay_frames: Number of frames without codes after which the scale falls back
+            pool: BufferPool the grayscale copies are taken from, a new one if None
+    """
+    def __init__(
+            self, decode=None, base_width=640, min_scale=0.25, code_size=(48, 160),
+            candidate_size=16, candidate_density=0.3, decay_frames=30, pool=None):
+        super().__init__()
+        if decode is None:
+            if pyzbar is None:
+                raise ImportError("pyzbar needs the zbar library to decode barcodes")
+            decode = pyzbar.decode
+        self._decode = decode
+        self.base_width = base_width
+        self.min_scale = min_scale
+        self.code_size = code_size
+        self.candidate_size = candidate_size
+        self.candidate_density = candidate_density
+        self.decay_frames = decay_frames
+        self.pool = pool if pool else BufferPool()
+
+    def _quantize(self, scale):
+        """Clamp a scale and round it to 1/16 so only a few buffer sizes are ever used"""
+        scale = round(scale * 16) / 16
+        return min(1.0, max(self.min_scale, scale))
+
+    def _grayscale(self, frame):
+        if frame.ndim == 2:
+            return frame, False
+        gray = self.pool.acquire(frame.shape[:2])
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+        return gray, True
+
+    def suspect(self, gray):
+        """Check whether a grayscale image contains a square that's as dense in edges as a code"""
+        edges = cv2.Canny(gray, 100, 200)
+        density = cv2.blur(edges, (self.candidate_size, self.candidate_size))
+        return cv2.minMaxLoc(density)[1] >= self.candidate_density * 255
+
+    def _scan(self, gray, factor_x, factor_y):
+        """Scan a grayscale image and map the polygons by the given factors"""
+        results = []
+        for barcode in self._decode(gray):
+            polygon = np.asarray([(point.x, point.y) for point in barcode.polygon], np.float64)
+            polygon *= (factor_x, factor_y)
+            polygon = np.rint(polygon).astype(np.int32).reshape((-1, 1, 2))
+            results.append((barcode.type, barcode.data.decode("utf-8"), polygon))
+        return results
+
+    def _adapt(self, results):
+        """Pick the scale that brings the smallest found code into code_size"""
+        side = min(min(cv2.minAreaRect(polygon)[1]) for type_, data, polygon in results)
+        if self.code_size[0] <= side * self.scale <= self.code_size[1]:
+            return
+        self.scale = self._quantize(sum(self.code_size) / 2 / max(side, 1))
+
+    def decode(self, frame):
+        """Find the barcodes in a frame
+
+            Args:
+                frame: BGR or grayscale frame, it isn't modified
+
+            Returns:
+                List of (type, data, polygon) of all found codes where polygon is an int32 array
+                of shape (points, 1, 2) in coordinates of frame, as used by cv2.polylines
+        """
+        start = perf_counter()
+        height, width = frame.shape[:2]
+        if self.scale is None or self.misses >= self.decay_frames:
+            self.scale = self._quantize(self.base_width / width)
+            self.misses = 0
+        gray, pooled = self._grayscale(frame)
+        try:
+            if self.scale < 1:
+                small_width = max(1, round(width * self.scale))
+                small_height = max(1, round(height * self.scale))
+                small = self.pool.acquire((small_height, small_width))
+                try:
+                    cv2.resize(gray, (small_width, small_height), dst=small, interpolation=cv2.INTER_AREA)
+                    results = self._scan(small, width / small_width, height / small_height)
+                    if not results and self.suspect(small):
+                        self.full_scans += 1
+                        results = self._scan(gray, 1, 1)
+                finally:
+                    self.pool.release(small)
+            else:
+                results = self._scan(gray, 1, 1)
+            if results:
+                self._adapt(results)
+                self.misses = 0
+            else:
+                self.misses += 1
+        finally:
+            if pooled:
+                self.pool.release(gray)
+        self.frames += 1
+        self.durations.append(perf_counter() - start)
+        return results
+
+
+class DecoderPool():
+    """Decodes the frames of several cameras on a shared pool of worker threads
+    Every camera gets its own AdaptiveDecoder since the scale adapts to what that camera sees.
+    zbar and OpenCV release the GIL while they work, so the workers decode in parallel.
+    A camera has to wait for the result of its frame before it submits the next one,
+    an AdaptiveDecoder must not decode two frames at once.
+
+        Args:
+            workers: Number of worker threads, ThreadPoolExecutor's default if None
+            decode: Function the AdaptiveDecoders scan with, see AdaptiveDecoder
+
+        Attributes:
+            decoders: dict of camera id to the AdaptiveDecoder of that camera
+            executor: ThreadPoolExecutor that runs the decoders
+            lock: mutex for decoders
+    """
+    def __init__(self, workers=None, decode=None):
+        self.decode_function = decode
+        self.decoders = {}
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=f"{self.__class__.__name__}Thread")
+        self.lock = Lock()
+
+    def decoder(self, camera_id):
+        """Get the AdaptiveDecoder of a camera, it's created on first use"""
+        with self.lock:
+            if camera_id not in self.decoders:
+                self.decoders[camera_id] = AdaptiveDecoder(self.decode_function)
+            return self.decoders[camera_id]
+
+    def submit(self, camera_id, frame):
+        """Decode a frame of a camera in a worker
+
+            Returns:
+                Future of the results of AdaptiveDecoder.decode
+        """
+        return self.executor.submit(self.decoder(camera_id).decode, frame)
+
+    def decode(self, camera_id, frame):
+        """Decode a frame of a camera in a worker and wait for the results"""
+        return self.submit(camera_id, frame).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+_slots = [] # SharedMemory slots of a ProcessDecoderPool, attached once per worker process
+_decoders = {} # camera id -> AdaptiveDecoder of a worker process
+_decode_function = None
+
+
+def _attach(names, decode):
+    """Initializer of the ProcessDecoderPool workers"""
+    global _decode_function
+    for name in names:
+        _slots.append(shared_memory.SharedMemory(name))
+    _decode_function = decode
+
+
+_main_lock = Lock() # mutex for swapping sys.modules["__main__"]
+
+
+@contextmanager
+def _without_main():
+    """Hide the __main__ module of the application while worker processes are spawned
+    Spawned processes import the __main__ module of their parent again, for the application
+    that's main.py with the database, the UI and everything else. Without it, workers only
+    import the modules of what they unpickle.
+    """
+    with _main_lock:
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main
+
+
+def _decode_slot(index, shape, camera_id, scale, misses):
+    """Decode the grayscale frame in a slot in a ProcessDecoderPool worker
+    The frames of a camera are decoded by all workers, so the scale and misses of the camera
+    are handed in
+
+        Returns:
+            (results, seconds, scale, misses, full_scans) where results holds (type, data, polygon)
+            with polygon as a list of [x, y] points
+    """
+    if camera_id not in _decoders:
+        _decoders[camera_id] = AdaptiveDecoder(_decode_function)
+    decoder = _decoders[camera_id]
+    decoder.scale = scale
+    decoder.misses = misses
+    full_scans = decoder.full_scans
+    frame = np.ndarray(shape, np.uint8, buffer=_slots[index].buf)
+    results = [(type_, data, polygon.reshape(-1, 2).tolist()) for type_, data, polygon in decoder.decode(frame)]
+    return results, decoder.durations[-1], decoder.scale, decoder.misses, decoder.full_scans - full_scans
+
+
+class ProcessDecoderPool():
+    """Decodes the frames of several cameras in worker processes so decoding doesn't hold the GIL
+    The frames are converted to grayscale straight into a ring of shared memory slots, only the
+    slot index, the scale and misses of the camera and the small results are pickled. submit
+    blocks while all slots are in use. Every worker keeps its own AdaptiveDecoder per camera
+    that starts from the scale and misses the camera's last frame ended with, the decode times
+    and scales of all of them are gathered in the DecodeStatistics of that camera. The workers are spawned rather
+    than forked, a fork of the running application with its Qt and capture threads could
+    deadlock. They're spawned without the __main__ module of the application unless decode
+    is defined there.
+
+        Args:
+            workers: Number of worker processes, one per CPU core if None
+            decode: Function the AdaptiveDecoders scan with, see AdaptiveDecoder, has to be picklable
+            max_resolution: Tuple of (width, height) of the largest frame that's decoded
+            slots: Number of shared memory slots, twice the number of workers if None
+
+        Attributes:
+            statistics: dict of camera id to the DecodeStatistics of that camera
+            executor: ProcessPoolExecutor that runs the decoders
+            spawning: Context manager the workers are started in
+            slots: SharedMemory slots
+            free_slots: Queue of the indices of the slots that are free
+            lock: mutex for statistics
+    """
+    def __init__(self, workers=None, decode=None, max_resolution=(1920, 1080), slots=None):
+        workers = workers if workers else os.cpu_count()
+        slots = slots if slots else 2 * workers
+        self.slot_size = max_resolution[0] * max_resolution[1]
+        self.slots = [shared_memory.SharedMemory(create=True, size=self.slot_size) for i in range(slots)]
+        self.free_slots = queue.Queue()
+        for index in range(slots):
+            self.free_slots.put(index)
+        self.spawning = nullcontext if getattr(decode, "__module__", None) == "__main__" else _without_main
+        self.executor = ProcessPoolExecutor(
+            workers, multiprocessing.get_context("spawn"),
+            initializer=_attach, initargs=([slot.name for slot in self.slots], decode))
+        self.statistics = {}
+        self.lock = Lock()
+
+    def decoder(self, camera_id):
+        """Get the DecodeStatistics of a camera"""
+        with self.lock:
+            if camera_id not in self.statistics:
+                self.statistics[camera_id] = DecodeStatistics()
+            return self.statistics[camera_id]
+
+    def submit(self, camera_id, frame):
+        """Decode a frame of a camera in a worker process
+
+            Returns:
+                Future of the results like AdaptiveDecoder.decode returns them
+
+            Raises:
+                ValueError: if the frame is larger than max_resolution
+        """
+        height, width = frame.shape[:2]
+        if height * width > self.slot_size:
+            raise ValueError(f"Frame of {width}x{height} doesn't fit into the shared memory slots")
+        index = self.free_slots.get()
+        gray = np.ndarray((height, width), np.uint8, buffer=self.slots[index].buf)
+        if frame.ndim == 2:
+            np.copyto(gray, frame)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+        future = Future()
+        statistics = self.decoder(camera_id)
+        with self.lock:
+            scale, misses = statistics.scale, statistics.misses
+        with self.spawning(): # submit starts the workers on demand
+            job = self.executor.submit(_decode_slot, index, (height, width), camera_id, scale, misses)
+        job.add_done_callback(lambda job: self._finished(camera_id, index, job, future))
+        return future
+
+    def _finished(self, camera_id, index, job, future):
+        self.free_slots.put(index)
+        try:
+            results, seconds, scale, misses, full_scans = job.result()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        statistics = self.decoder(camera_id)
+        with self.lock:
+            statistics.durations.append(seconds)
+            statistics.frames += 1
+            statistics.full_scans += full_scans
+            statistics.scale = scale
+            statistics.misses = misses
+        future.set_result([
+            (type_, data, np.asarray(polygon, np.int32).reshape((-1, 1, 2))) 
+            for type_, data, polygon in results])
+
+    def decode(self, camera_id, frame):
+        """Decode a frame of a camera in a worker process and wait for the results"""
+        return self.submit(camera_id, frame).result()
+
+    def shutdown(self):
+        """Stop the workers and free the shared memory"""
+        self.executor.shutdown()
+        for slot in self.slots:
+            slot.unlink()
+            try:
+                slot.close()
+            except BufferError: # a capture thread still writes into it, it's unmapped on exit
+                pass
+
+
+class MotionGate():
+    """Lets frames through to the decoder only while the scene changes
+    Every frame is shrunk to a grayscale thumbnail and compared with the thumbnail of the
+    frame before. Shrinking averages out the sensor noise, so a static scene never opens the
+    gate while a code moved into the picture opens it on the first frame it shows up in.
+
+        Args:
+            pixel_threshold: Grayscale difference that counts a thumbnail pixel as changed
+            min_area: Fraction of changed thumbnail pixels that counts as motion
+            hold: Seconds frames are still let through after the last motion, so a code that's
+                held still in front of the camera keeps being decoded
+            thumbnail_width: Width of the thumbnails that are compared
+            clock: Function returning the current time in seconds
+
+        Attributes:
+            checked: Number of frames that were checked
+            passed: Number of frames that were let through
+            last_motion: Time of the last motion
+    """
+    def __init__(self, pixel_threshold=25, min_area=0.002, hold=1.5, thumbnail_width=160, clock=monotonic):
+        self.pixel_threshold = pixel_threshold
+        self.min_area = min_area
+        self.hold = hold
+        self.thumbnail_width = thumbnail_width
+        self.clock = clock
+        self.checked = 0
+        self.passed = 0
+        self.last_motion = None
+        self._previous = None
+        self._current = None
+        self._spare = None
+        self._difference = None
+
+    @property
+    def decoded_fraction(self):
+        """Fraction of the checked frames that were let through"""
+        return self.passed / self.checked if self.checked else 1.0
+
+    def _thumbnail(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.thumbnail_width, max(1, round(height * self.thumbnail_width / width)))
+        if self._current is None or self._current.shape != size[::-1]:
+            self._previous = None
+            self._current = np.empty(size[::-1], np.uint8)
+            self._spare = np.empty(size[::-1], np.uint8)
+            self._difference = np.empty(size[::-1], np.uint8)
+        if frame.ndim == 2:
+            cv2.resize(frame, size, dst=self._current, interpolation=cv2.INTER_AREA)
+        else:
+            small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self._current)
+        return self._current
+
+    def check(self, frame):
+        """Check whether a frame should be decoded
+
+            Args:
+                frame: BGR or grayscale frame, it isn't modified
+
+            Returns:
+                True if the scene changed within the last hold seconds
+        """
+        now = self.clock()
+        current = self._thumbnail(frame)
+        if self._previous is None:
+            moved = True
+        else:
+            cv2.absdiff(current, self._previous, dst=self._difference)
+            cv2.threshold(self._difference, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self._difference)
+            moved = cv2.countNonZero(self._difference) >= self.min_area * current.size
+        self._previous, self._current = current, self._previous if self._previous is not None else self._spare
+        if moved:
+            self.last_motion = now
+        self.checked += 1
+        if now - self.last_motion <= self.hold:
+            self.passed += 1
+            return True
+        return False
+
+
+def motion_gate():
+    """Get a MotionGate with the thresholds from the motion section of the config, None if it's disabled"""
+    if not config["motion", "enabled"]:
+        return None
+    return MotionGate(**{key: config["motion", key] for key in motion_keys})
+
+
+def decoder_pool():
+    """Get the pool of the decoder_backend in the cameras section of the config,
+    "processes" for a ProcessDecoderPool and "threads" for a DecoderPool
+    """
+    if config["cameras", "decoder_backend"] == "processes":
+        return ProcessDecoderPool(config["cameras", "decoder_workers"])
+    return DecoderPool(config["cameras", "decoder_workers"])
@@ -0,0 +1,125 @@
+"""Background execution of database jobs so the Qt GUI thread never blocks on SQL"""
+
+import queue
+from threading import Lock, Thread
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from logger import logger
+
+
+class Job():
+    """A function that's run by a worker of a DatabaseExecutor
+
+        Args:
+            function: Called in a worker thread with a session and args
+            args: Arguments for function
+            callback: Called in the GUI thread with the result of function
+            errback: Called in the GUI thread with the exception function raised
+            key: Jobs with the same key are coalesced, only the latest one is delivered
+
+        Attributes:
+            cancelled: Set by cancel, cancelled jobs aren't run or delivered
+    """
+    def __init__(self, function, args, callback=None, errback=None, key=None):
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.key = key
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the job, a job that's already running finishes but isn't delivered"""
+        self.cancelled = True
+
+
+class DatabaseExecutor(QObject):
+    """Runs jobs in worker threads that own their sessions and delivers the results via Qt signal
+    Submitting a job with the key of an earlier job cancels the earlier one, so repeated
+    refresh requests only run and get delivered once.
+    Has to be created in the GUI thread, callbacks are run in that thread.
+
+        Args:
+            session_factory: ContextSession class the workers open their sessions with
+            workers: Number of worker threads
+            parent: Parent QObject
+
+        Attributes:
+            jobs: Queue of jobs waiting for a worker
+            lock: mutex for latest
+            latest: dict of key to the latest job submitted with it
+            threads: Worker threads
+    """
+    _finished = pyqtSignal(object, object, object) # job, result, exception
+
+    def __init__(self, session_factory, workers=1, parent=None):
+        super().__init__(parent)
+        self.session_factory = session_factory
+        self.jobs = queue.Queue()
+        self.lock = Lock()
+        self.latest = {}
+        self._finished.connect(self._deliver)
+        self.threads = [
+            Thread(target=self._work, name=f"{self.__class__.__name__}Thread_{i}", daemon=True)
+            for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, function, *args, callback=None, errback=None, key=None):
+        """Queue function to be called as function(session, *args) in a worker thread
+
+            Args:
+                function: Function to run, gets an open session as first argument
+                args: Further arguments for function
+                callback: Called in the GUI thread with the result
+                errback: Called in the GUI thread with the raised exception
+                key: Cancels the previous job with the same key
+
+            Returns:
+                Job that can be cancelled
+        """
+        job = Job(function, args, callback, errback, key)
+        if key is not None:
+            with self.lock:
+                previous = self.latest.get(key)
+                if previous is not None:
+                    previous.cancel()
+                self.latest[key] = job
+        self.jobs.put(job)
+        return job
+
+    def cancel(self, key):
+        """Cancel the latest job submitted with key"""
+        with self.lock:
+            job = self.latest.pop(key, None)
+        if job is not None:
+            job.cancel()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job.cancelled:
+                continue
+            try:
+                with self.session_factory() as session:
+                    result = job.function(session, *job.args)
+            except Exception as e:
+                logger.error(f"Job {job.function.__name__} failed: {e!r}")
+                self._finished.emit(job, None, e)
+            else:
+                self._finished.emit(job, result, None)
+
+    def _deliver(self, job, result, exception):
+        """Hand the outcome of a job to its callbacks, runs in the GUI thread"""
+        if job.key is not None:
+            with self.lock:
+                if self.latest.get(job.key) is job:
+                    del self.latest[job.key]
+        if job.cancelled:
+            return
+        if exception is not None:
+            if job.errback:
+                job.errback(exception)
+        elif job.callback:
+            job.callback(result)
@@ -0,0 +1,167 @@
+"""Frame path from the camera to Qt without allocations per frame
+Display frames are scaled and mirrored into pooled buffers, the QImage handed to Qt wraps
+such a buffer, so the only copy left is the one QPixmap makes of the QImage.
+Consumers hand the frames back to the pool once they converted them.
+A LatestFrame hands the display frames from the capture thread to the GUI thread.
+"""
+
+from threading import Lock
+
+import cv2
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+
+
+class BufferPool():
+    """Hands out reusable numpy buffers
+    A buffer that's acquired belongs to the caller until it's released again,
+    new buffers are only allocated if all buffers of a shape are in use. Free buffers take up
+    at most max_bytes, buffers of the shapes that weren't released for the longest time are
+    dropped first, so the buffers of e.g. an old display size don't stay around.
+
+        Args:
+            dtype: dtype of the buffers
+            max_bytes: Maximum size of all free buffers together
+
+        Attributes:
+            free: dict of shape to list of buffers that can be handed out, ordered from
+                the least to the most recently released shape
+            free_bytes: Size of all free buffers together
+            allocations: Number of buffers that were allocated so far
+            lock: mutex for free, free_bytes and allocations
+    """
+    def __init__(self, dtype=np.uint8, max_bytes=64 * 2**20):
+        self.dtype = dtype
+        self.max_bytes = max_bytes
+        self.free = {}
+        self.free_bytes = 0
+        self.allocations = 0
+        self.lock = Lock()
+
+    def acquire(self, shape):
+        """Get a buffer of given shape, its content is undefined"""
+        with self.lock:
+            buffers = self.free.get(shape)
+            if buffers:
+                buffer = buffers.pop()
+                self.free_bytes -= buffer.nbytes
+                return buffer
+            self.allocations += 1
+        return np.empty(shape, self.dtype)
+
+    def release(self, buffer):
+        """Give a buffer that was acquired back to the pool"""
+        with self.lock:
+            buffers = self.free.pop(buffer.shape, [])
+            self.free[buffer.shape] = buffers # moves the shape to the end
+            buffers.append(buffer)
+            self.free_bytes += buffer.nbytes
+            while self.free_bytes > self.max_bytes:
+                shape, buffers = next(iter(self.free.items()))
+                self.free_bytes -= buffers.pop(0).nbytes
+                if not buffers:
+                    del self.free[shape]
+
+
+class FramePipeline():
+    """Scales and mirrors captured frames into pooled buffers
+    The frame is scaled straight into the display buffer and mirrored in place there,
+    which costs about as much as the scaling alone
+
+        Args:
+            pool: BufferPool the display frames are taken from, a new one if None
+    """
+    def __init__(self, pool=None):
+        self.pool = pool if pool else BufferPool()
+
+    def process(self, frame, target_resolution=None, mirror=False):
+        """Get the display frame of a captured frame
+        The captured frame isn't modified and may be reused once this returns
+
+            Args:
+                frame: Captured BGR frame
+                target_resolution: Tuple of (width, height) of the display frame, size of frame if None
+                mirror: Set to True to mirror the display frame horizontally
+
+            Returns:
+                Display frame from the pool, release it with release once it's not used anymore
+        """
+        height, width = frame.shape[:2]
+        target_width, target_height = target_resolution if target_resolution else (width, height)
+        display_frame = self.pool.acquire((target_height, target_width) + frame.shape[2:])
+        if (target_width, target_height) != (width, height):
+            cv2.resize(frame, (target_width, target_height), dst=display_frame)
+            if mirror:
+                cv2.flip(display_frame, 1, dst=display_frame)
+        elif mirror:
+            cv2.flip(frame, 1, dst=display_frame)
+        else:
+            np.copyto(display_frame, frame)
+        return display_frame
+
+    def release(self, display_frame):
+        """Give a display frame back to the pool"""
+        self.pool.release(display_frame)
+
+
+class LatestFrame(QObject):
+    """Slot for the newest display frame of a producer thread, the newest frame always wins
+    A frame that wasn't taken before the next one is put is handed to release right away,
+    so a slow GUI skips frames instead of working through a backlog. ready is only emitted
+    for frames that are put into an empty slot, so at most one event is queued at a time.
+    Connections to ready that were made in the GUI thread are called in the GUI thread.
+
+        Args:
+            release: Function the replaced frames are handed to, e.g. FramePipeline.release
+            parent: Parent QObject
+
+        Attributes:
+            frame: The frame that wasn't taken yet, None if the slot is empty
+            dropped: Number of frames that were replaced before they were taken
+            lock: mutex for frame and dropped
+
+        Signals:
+            ready: Emitted when a frame is put into the empty slot
+    """
+    ready = pyqtSignal()
+
+    def __init__(self, release, parent=None):
+        super().__init__(parent)
+        self.release = release
+        self.frame = None
+        self.dropped = 0
+        self.lock = Lock()
+
+    def put(self, frame):
+        """Put a new frame into the slot, called from the producer thread"""
+        with self.lock:
+            replaced, self.frame = self.frame, frame
+            if replaced is not None:
+                self.dropped += 1
+        if replaced is None:
+            self.ready.emit()
+        else:
+            self.release(replaced)
+
+    def take(self):
+        """Take the newest frame out of the slot, hand it to release once it's displayed
+
+            Returns:
+                The newest frame, None if there's none
+        """
+        with self.lock:
+            frame, self.frame = self.frame, None
+        return frame
+
+
+def to_qpixmap(frame):
+    """Convert a display frame to a QPixmap, the frame is converted from BGR to RGB in place
+    The QImage only wraps the buffer and QPixmap.fromImage makes the single copy. Qt can wrap
+    BGR data directly (QImage.Format_BGR888) but converts it to its pixmap format on a slow
+    path, swapping the channels in place first and using the fast RGB888 path is quicker.
+    """
+    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    height, width = frame.shape[:2]
+    image = QImage(frame.data, width, height, frame.strides[0], QImage.Format_RGB888)
+    return QPixmap.fromImage(image)
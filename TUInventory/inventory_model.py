@@ -0,0 +1,187 @@
+"""Lazy item model for the device overview
+Only the first page of locations is loaded when the model is reset. The users at a location
+and their devices are fetched page by page with keyset-paginated queries once their parent
+is expanded or scrolled to the end, so opening the overview costs the same for any inventory size.
+All queries run on a DatabaseExecutor so the view never waits for the database.
+"""
+
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+
+import classes
+from logger import logger
+import slots
+
+
+def fetch_page(session, fetch, kind, *args):
+    """Fetch a page of the tree with one of the slots.tree_ functions and log its cost
+
+        Args:
+            session: Open session
+            fetch: slots.tree_locations, slots.tree_users or slots.tree_devices
+            kind: Kind of the nodes in the page
+            args: Further arguments for fetch
+
+        Returns:
+            The rows of the page
+    """
+    with classes.QueryCounter(session.connection()) as counter:
+        rows = fetch(session, *args)
+    logger.info(
+        f"Fetched {len(rows)} {kind} nodes with {counter.queries} queries in {counter.duration * 1000:.1f} ms")
+    return rows
+
+
+class Node():
+    """Node in the tree of an InventoryModel
+
+        Args:
+            kind: One of "root", "location", "user" and "device"
+            key: uid of the location, user or device
+            text: Text that's displayed for the node
+            parent: Parent node
+            row: Position of the node in the children of parent
+            sort_key: Sort key of the node in the pages of its parent
+
+        Attributes:
+            children: Child nodes that were fetched so far
+            more: Whether there may be further children in the database
+            fetching: Whether a page of children is being fetched
+    """
+    child_kinds = {"root": "location", "location": "user", "user": "device"}
+
+    def __init__(self, kind, key=None, text="", parent=None, row=0, sort_key=None):
+        self.kind = kind
+        self.key = key
+        self.text = text
+        self.parent = parent
+        self.row = row
+        self.sort_key = sort_key
+        self.children = []
+        self.more = kind != "device"
+        self.fetching = False
+
+    def sort_key_of_last(self):
+        """Get the sort key the next page of children starts after"""
+        return self.children[-1].sort_key if self.children else None
+
+
+class InventoryModel(QAbstractItemModel):
+    """Tree of locations, the users at every location and the devices they're responsible for
+
+        Args:
+            executor: DatabaseExecutor the pages are fetched with
+            page_size: Number of children that are fetched at once
+            parent: Parent QObject
+
+        Attributes:
+            root: Invisible root node holding the locations
+            generation: Incremented on every reset so pages of an old tree are dropped
+    """
+    def __init__(self, executor, page_size=200, parent=None):
+        super().__init__(parent)
+        self.executor = executor
+        self.page_size = page_size
+        self.root = Node("root")
+        self.generation = 0
+
+    def refresh(self):
+        """Drop all loaded nodes and fetch the first page of locations again"""
+        self.beginResetModel()
+        self.generation += 1
+        self.root = Node("root")
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def node(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self.node(parent)
+        if column != 0 or not 0 <= row < len(node.children):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is self.root:
+            return QModelIndex()
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self.node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        return bool(node.children) or node.more
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == Qt.DisplayRole:
+            return node.text
+        if role == Qt.UserRole and node.kind == "device":
+            return node.key
+        return None
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        return node.more and not node.fetching
+
+    def fetchMore(self, parent):
+        """Fetch the next page of children of parent in the background"""
+        node = self.node(parent)
+        if not self.canFetchMore(parent):
+            return
+        node.fetching = True
+        if node.kind == "root":
+            job = (slots.tree_locations, node.sort_key_of_last())
+        elif node.kind == "location":
+            job = (slots.tree_users, node.key, node.sort_key_of_last())
+        else:
+            job = (slots.tree_devices, node.parent.key, node.key, node.sort_key_of_last())
+        generation = self.generation
+        self.executor.submit(
+            fetch_page, job[0], Node.child_kinds[node.kind], *job[1:], self.page_size,
+            callback=lambda rows: self._insert(generation, node, rows),
+            errback=lambda exception: self._failed(generation, node))
+
+    def _failed(self, generation, node):
+        if generation == self.generation:
+            node.fetching = False
+
+    def _insert(self, generation, node, rows):
+        """Append a fetched page of rows to the children of node"""
+        if generation != self.generation:
+            return
+        node.fetching = False
+        node.more = len(rows) == self.page_size
+        parent = QModelIndex() if node is self.root else self.createIndex(node.row, 0, node)
+        if not rows:
+            if parent.isValid():
+                self.dataChanged.emit(parent, parent) # lets the view drop the expand indicator
+            return
+        kind = Node.child_kinds[node.kind]
+        first = len(node.children)
+        self.beginInsertRows(parent, first, first + len(rows) - 1)
+        for row, values in enumerate(rows, start=first):
+            key, text, sort_key = self.describe(kind, values)
+            node.children.append(Node(kind, key, text, node, row, sort_key))
+        self.endInsertRows()
+
+    @staticmethod
+    def describe(kind, values):
+        """Get key, text and sort key of a node from the row it was fetched as"""
+        if kind == "location":
+            uid, name = values
+            return uid, str(name), name
+        if kind == "user":
+            uid, name, surname = values
+            return uid, f"{name} {surname}".strip().title(), (name, surname, uid)
+        uid, article_name = values
+        return uid, f"{article_name} mit ID {uid}", uid
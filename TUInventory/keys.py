@@ -1,4 +1,11 @@
-"""Generation and reading of RSA keys for asymmetric encryption"""
+"""Generation and reading of RSA keys for asymmetric encryption
+Keys are generated in background threads, read_keys waits for a generation that's still
+writing the requested files. Parsed keys are cached until one of their files changes.
+"""
+
+import os
+import pathlib
+from threading import Event, Lock, Thread
 
 try:
     from Cryptodome.Cipher import PKCS1_OAEP
@@ -9,27 +16,134 @@ except ImportError as e:
         from Crypto.PublicKey import RSA
     except ImportError as err:
         raise err
-        
+
+from logger import logger
 from utils import absolute_path
 
 PUBLIC_KEY_PATH = absolute_path("pub.key")
 
-def generate_key(path_public, path_private):
+_lock = Lock() # mutex for _cache and _pending
+_cache = {} # (path_public, path_private) -> (file states, (cipher, decipher))
+_pending = {} # path -> KeyGenerator that's writing it
+
+
+def _write(path, data):
+    """Write data to a temporary file and move it to path so readers never see partial keys"""
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def generate_key(path_public, path_private, bits=4096):
     """Generate new RSA key-pair and save it to the given paths
 
         Args:
             path_public: Path where the public-key should be stored
             path_private: Path where th private-key should be stored
+            bits: Length of the key
+    """
+    key = RSA.generate(bits)
+    _write(path_private, key.exportKey())
+    _write(path_public, key.publickey().exportKey())
+
+
+class KeyGenerator(Thread):
+    """Generates a new RSA key-pair in the background, see generate_key_async
+    The thread isn't a daemon, so the interpreter waits for it at exit and a key-pair that
+    replaces a used one is always written.
+
+        Args:
+            path_public: Path where the public-key should be stored
+            path_private: Path where th private-key should be stored
+            bits: Length of the key
+
+        Attributes:
+            ready: Event that's set once the keys are saved or generating them failed
+            error: Exception the generation failed with, None if it succeeded
+            callbacks: Functions that are called with the generator once it's done
+    """
+    def __init__(self, path_public, path_private, bits=4096):
+        super().__init__(name=f"{self.__class__.__name__}Thread_{id(self)}")
+        self.path_public = path_public
+        self.path_private = path_private
+        self.bits = bits
+        self.ready = Event()
+        self.error = None
+        self.callbacks = []
+
+    def run(self):
+        try:
+            generate_key(self.path_public, self.path_private, self.bits)
+            logger.info(f"Generated new key-pair at {self.path_public} and {self.path_private}")
+        except Exception as e:
+            self.error = e
+            logger.error(f"Failed to generate key-pair at {self.path_private}: {e}")
+        finally:
+            with _lock:
+                for path in (self.path_public, self.path_private):
+                    if _pending.get(str(path)) is self:
+                        del _pending[str(path)]
+                self.ready.set()
+                callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback with the generator once it's done, right away if it's done already
+        The callback runs in the thread of the generator unless it's done already
+        """
+        with _lock:
+            if not self.ready.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+
+def generate_key_async(path_public, path_private, bits=4096):
+    """Start generating a new RSA key-pair in a background thread
+
+        Args:
+            path_public: Path where the public-key should be stored
+            path_private: Path where th private-key should be stored
+            bits: Length of the key
+
+        Returns:
+            The started KeyGenerator, its ready event is set once the keys are saved
     """
-    key = RSA.generate(4096)
-    with open(path_public, "wb") as f:
-        f.write(key.publickey().exportKey())
-    with open(path_private, "wb") as f:
-        f.write(key.exportKey())
+    generator = KeyGenerator(path_public, path_private, bits)
+    with _lock:
+        _pending[str(path_public)] = generator
+        _pending[str(path_private)] = generator
+    generator.start()
+    return generator
+
+
+def pending(*paths):
+    """Get the KeyGenerators that are still writing any of the given paths"""
+    with _lock:
+        return {_pending[str(path)] for path in paths if str(path) in _pending}
+
+
+def wait(*paths, timeout=None):
+    """Block until no KeyGenerator is writing any of the given paths
+
+        Returns:
+            False if the timeout ran out first, True otherwise
+    """
+    return all(generator.ready.wait(timeout) for generator in pending(*paths))
+
+
+def _file_state(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_ino, stat.st_size
 
 
 def read_keys(path_public, path_private):
     """Read a key-pair from the given paths and build ciphers from it
+    Waits for a generation of the keys that's still running. The ciphers are cached
+    and only rebuilt when one of the files was modified.
 
         Args:
             path_public: Path where the public-key is stored
@@ -38,10 +152,19 @@ def read_keys(path_public, path_private):
         Returns:
             (PKCS1_OAEP-cipher from public-key, PKCS1_OAEP-decipher from private-key)
     """
+    wait(path_public, path_private)
+    key = (str(path_public), str(path_private))
+    state = (_file_state(path_public), _file_state(path_private))
+    with _lock:
+        cached = _cache.get(key)
+    if cached and cached[0] == state:
+        return cached[1]
     with open(path_public, "rb") as f:
         publickey = RSA.importKey(f.read())
     with open(path_private, "rb") as f:
         privatekey = RSA.importKey(f.read())
     cipher = PKCS1_OAEP.new(publickey)
     decipher = PKCS1_OAEP.new(privatekey)
+    with _lock:
+        _cache[key] = (state, (cipher, decipher))
     return cipher, decipher
@@ -9,8 +9,9 @@ from time import sleep
 from PyQt5.QtWidgets import QApplication
 
 from barcodereader import LazyVideoStream, VideoStream
-from classes import VideoStreamUISync, Timeout
-from config import config, SettingsManger
+from classes import CodeCooldown, VideoStreamUISync, Timeout
+from config import camera_ids, config, SettingsManger
+from decoding import decoder_pool
 import keys
 from logger import logger
 import ui
@@ -25,43 +26,40 @@ if "win32" in sys.platform:
         logger.debug(str(e))
 
 
-class Dummy():
-    pass
-
-
 def main():
     public_key_path = keys.PUBLIC_KEY_PATH
-    if not public_key_path.exists():
+    if not public_key_path.exists(): # generated in background, keys.read_keys waits for it
         private_key_path = absolute_path("priv.key")
-        keys.generate_key(public_key_path, private_key_path)
+        keys.generate_key_async(public_key_path, private_key_path)
     app = QApplication(sys.argv)
     dialog_main = ui.MainDialog()
     dialog_main.showMaximized()
     
-    try:
-        videostream = LazyVideoStream()
+    decoders = decoder_pool()
+    cooldown = CodeCooldown(config["recognition", "cooldown"]) # a code seen by several cameras counts once
+    videostreams = []
+    for camera_id in camera_ids():
+        try:
+            videostream = LazyVideoStream(camera_id=camera_id, decoder_pool=decoders)
+        except IOError as e:
+            logger.error(str(e))
+            continue
         videostream.mirror = config["mirror"]
         videostream.start()
         logger.info(f"Camera {videostream.camera_id} succesfully opened")
-        video_ui_sync_1 = VideoStreamUISync(
-            dialog_main.ui.videoFeed, videostream, 
-            dialog_main.code_recognized, "frames")
-        video_ui_sync_2 = VideoStreamUISync(
-            dialog_main.ui.videoFeed, videostream, 
-            dialog_main.code_recognized, "codes")
-        video_ui_sync_1.start()
-        video_ui_sync_2.start()
-        logger.info("Connected Camera to UI")
-    except IOError as e:
-        logger.error(str(e))
-        videostream = Dummy()
-        video_ui_sync_1 = Dummy()
-        video_ui_sync_2 = Dummy()
+        canvas = None if videostreams else dialog_main.ui.videoFeed # the first camera is shown in the UI
+        VideoStreamUISync(
+            canvas, videostream, dialog_main.code_recognized, cooldown, dialog_main.code_seen).start()
+        videostreams.append(videostream)
+        logger.info(f"Connected camera {videostream.camera_id} to UI")
     
-    settings_manager = SettingsManger(video_ui_sync_1, video_ui_sync_2, videostream)
+    settings_manager = SettingsManger(videostreams)
     settings_manager.start()
     dialog_main.settings_event = settings_manager.event
-    return app.exec_()
+    try:
+        return app.exec_()
+    finally:
+        decoders.shutdown() # unlinks the shared memory of a ProcessDecoderPool
 
 
 if __name__ == "__main__":
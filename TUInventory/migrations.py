@@ -0,0 +1,170 @@
+"""Versioned schema migrations for existing databases
+Base.metadata.create_all only creates missing tables and never alters existing ones,
+so every change to the schema of an existing table is registered here under the
+next free version number. The applied versions are tracked in the schema_version table.
+Migrations should be idempotent since SQLite commits DDL statements immediately.
+"""
+
+from logger import logger
+
+migrations = []
+
+foreign_key_indexes = (
+    ("responsibilities", "user_uid"),
+    ("responsibilities", "location_uid"),
+    ("devices", "article_uid"),
+    ("articles", "producer_uid"))
+
+tree_indexes = (
+    ("ix_responsibilities_location_user_device", "responsibilities", ("location_uid", "user_uid", "device_uid")),
+    ("ix_users_name_surname", "users", ("name", "surname")))
+
+
+def migration(version):
+    """Function-decorator to register a migration for the given schema version
+    The decorated function gets called with an open connection. A migration that can't be
+    applied yet returns False, it isn't recorded then and is retried on the next start.
+    """
+    def register(function):
+        migrations.append((version, function))
+        migrations.sort(key=lambda migration: migration[0])
+        return function
+    return register
+
+
+def applied_versions(connection):
+    """Get the set of schema versions that were applied to the database"""
+    return {row[0] for row in connection.execute("SELECT version FROM schema_version")}
+
+
+def add_column(connection, table, column, type_, default=None):
+    """Add a column to an existing table if it doesn't exist yet
+
+        Args:
+            connection: Open connection to the database
+            table (str): Name of the table
+            column (str): Name of the new column
+            type_ (str): SQL type of the new column
+            default: SQL literal that's used as default value for existing rows
+    """
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return
+    default = f" DEFAULT {default}" if default is not None else ""
+    connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type_}{default}")
+
+
+def migrate(engine):
+    """Apply all pending migrations to the database in order of their version"""
+    with engine.connect() as connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "applied_at TEXT NOT NULL)")
+    for version, function in migrations:
+        with engine.begin() as connection:
+            if version in applied_versions(connection):
+                continue
+            if function(connection) is False:
+                logger.info(f"Postponed migration to schema version {version}: {function.__name__}")
+                continue
+            connection.execute(
+                "INSERT INTO schema_version (version, applied_at) VALUES (?, datetime('now'))",
+                version)
+        logger.info(f"Migrated database to schema version {version}: {function.__name__}")
+
+
+@migration(1)
+def add_foreign_key_indexes(connection):
+    """Index the foreign keys that responsibilities, devices and articles are filtered on"""
+    for table, column in foreign_key_indexes:
+        connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})")
+
+
+def _fts5_available(connection):
+    """Check whether the SQLite library was compiled with the FTS5 extension"""
+    try:
+        connection.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(probe)")
+    except Exception:
+        return False
+    connection.execute("DROP TABLE temp._fts5_probe")
+    return True
+
+
+def _index_devices(condition):
+    """Build the statement that adds all devices d matching condition to the search_index"""
+    return f"""
+        INSERT INTO search_index (rowid, device, code, article, producer, user, e_mail, location)
+        SELECT d.uid, d.uid, COALESCE(d.code, ''), COALESCE(a.name, ''), COALESCE(p.name, ''),
+            COALESCE(group_concat(COALESCE(u.name, '') || ' ' || COALESCE(u.surname, ''), ' '), ''),
+            COALESCE(group_concat(u.e_mail, ' '), ''),
+            COALESCE(group_concat(l.name, ' '), '')
+        FROM devices d
+        LEFT JOIN articles a ON a.uid = d.article_uid
+        LEFT JOIN producers p ON p.uid = a.producer_uid
+        LEFT JOIN responsibilities r ON r.device_uid = d.uid
+        LEFT JOIN users u ON u.uid = r.user_uid
+        LEFT JOIN locations l ON l.uid = r.location_uid
+        WHERE {condition}
+        GROUP BY d.uid"""
+
+
+def _reindex(condition, delete=None):
+    """Build the statements that rebuild the search_index entries of all devices d matching condition
+    delete is a condition on the rowid for entries that are removed first, by default the devices
+    matching condition
+    """
+    if delete is None:
+        delete = f"rowid IN (SELECT d.uid FROM devices d WHERE {condition})"
+    return f"DELETE FROM search_index WHERE {delete}; {_index_devices(condition)};"
+
+
+search_triggers = {
+    "devices_ai": ("AFTER INSERT ON devices", _reindex("d.uid = NEW.uid", "rowid = NEW.uid")),
+    "devices_au": ("AFTER UPDATE ON devices", _reindex("d.uid = NEW.uid", "rowid IN (OLD.uid, NEW.uid)")),
+    "devices_ad": ("AFTER DELETE ON devices", "DELETE FROM search_index WHERE rowid = OLD.uid;"),
+    "responsibilities_ai": (
+        "AFTER INSERT ON responsibilities", 
+        _reindex("d.uid = NEW.device_uid", "rowid = NEW.device_uid")),
+    "responsibilities_au": (
+        "AFTER UPDATE ON responsibilities", 
+        _reindex("d.uid IN (OLD.device_uid, NEW.device_uid)", "rowid IN (OLD.device_uid, NEW.device_uid)")),
+    "responsibilities_ad": (
+        "AFTER DELETE ON responsibilities", 
+        _reindex("d.uid = OLD.device_uid", "rowid = OLD.device_uid")),
+    "articles_au": ("AFTER UPDATE ON articles", _reindex("d.article_uid IN (OLD.uid, NEW.uid)")),
+    "producers_au": (
+        "AFTER UPDATE ON producers", 
+        _reindex("d.article_uid IN (SELECT uid FROM articles WHERE producer_uid IN (OLD.uid, NEW.uid))")),
+    "users_au": (
+        "AFTER UPDATE OF name, surname, e_mail ON users", 
+        _reindex("d.uid IN (SELECT device_uid FROM responsibilities WHERE user_uid IN (OLD.uid, NEW.uid))")),
+    "locations_au": (
+        "AFTER UPDATE ON locations", 
+        _reindex("d.uid IN (SELECT device_uid FROM responsibilities WHERE location_uid IN (OLD.uid, NEW.uid))")),
+}
+
+
+@migration(2)
+def add_search_index(connection):
+    """Create the FTS5 search_index over devices and the triggers that keep it in sync
+    The rowid of every entry is the uid of its device
+    """
+    if not _fts5_available(connection):
+        logger.warning("SQLite was compiled without FTS5, full-text search is unavailable")
+        return False
+    connection.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "device, code, article, producer, user, e_mail, location, prefix='2 3')")
+    for name, (event, body) in search_triggers.items():
+        connection.execute(f"DROP TRIGGER IF EXISTS search_index_{name}")
+        connection.execute(f"CREATE TRIGGER search_index_{name} {event} BEGIN {body} END")
+    connection.execute("DELETE FROM search_index")
+    connection.execute(_index_devices("1"))
+
+
+@migration(3)
+def add_tree_indexes(connection):
+    """Index the sort keys that the pages of the device overview are fetched by"""
+    for name, table, columns in tree_indexes:
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
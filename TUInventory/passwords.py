@@ -0,0 +1,97 @@
+"""Password hashing policy
+Passwords are stored as complete argon2 PHC strings like $argon2i$v=19$m=65536,t=3,p=4$<salt>$<hash>
+so every account carries the cost parameters it was hashed with. The policy in the passwords
+section of the config can be raised at any time, hashes that don't match it are replaced
+on the next successful login.
+Accounts from before the PHC strings only stored <salt>$<hash> and are verified with
+the fixed parameters they were created with.
+"""
+
+from time import perf_counter
+
+from passlib.hash import argon2
+
+from config import config
+
+policy_keys = ("rounds", "memory_cost", "parallelism")
+legacy_parameters = "$argon2i$v=19$m=1024,t=512,p=4$"
+
+
+def policy(settings=None):
+    """Get the argon2 hasher of the current policy
+
+        Args:
+            settings: dict that overrides the rounds, memory_cost and parallelism from config
+
+        Returns:
+            passlib argon2 handler
+    """
+    parameters = {key: config["passwords", key] for key in policy_keys}
+    parameters.update(settings or {})
+    return argon2.using(**parameters)
+
+
+def hash(password, settings=None):
+    """Hash a password with the current policy, returns the PHC string as bytes"""
+    return policy(settings).hash(password).encode()
+
+
+def is_legacy(stored):
+    """Check whether a stored hash is missing its parameters"""
+    return not stored.startswith(b"$argon2")
+
+
+def to_phc(stored):
+    """Get the complete PHC string of a stored hash"""
+    if is_legacy(stored):
+        return legacy_parameters + stored.decode()
+    return stored.decode()
+
+
+def verify(password, stored):
+    """Check a password against a stored hash of any policy
+
+        Raises:
+            ValueError: if stored isn't a valid hash
+    """
+    return argon2.verify(password, to_phc(stored))
+
+
+def needs_update(stored, settings=None):
+    """Check whether a stored hash was made with other parameters than the current policy"""
+    return is_legacy(stored) or policy(settings).needs_update(stored.decode())
+
+
+def calibrate(target=0.5, parallelism=None, max_memory_cost=1048576, min_rounds=3, password="calibration"):
+    """Find the cost parameters that make a verification take about target seconds on this machine
+    The time of a verification grows linearly with memory_cost * rounds. The memory cost is
+    raised first since it's what makes argon2 expensive on dedicated hardware, the rounds
+    only go above min_rounds once max_memory_cost is reached.
+
+        Args:
+            target: Time in seconds a verification should take
+            parallelism: Number of lanes, the configured parallelism if None
+            max_memory_cost: Upper bound for memory_cost in KiB
+            min_rounds: Lower bound for rounds, argon2i needs at least 3
+            password: Password that's hashed for the measurements
+
+        Returns:
+            (settings, seconds) where settings is a dict of policy_keys and seconds
+            the measured verification time with them
+    """
+    if parallelism is None:
+        parallelism = config["passwords", "parallelism"]
+
+    def measure(settings):
+        hash_ = hash(password, settings)
+        start = perf_counter()
+        verify(password, hash_)
+        return perf_counter() - start
+
+    block = 8 * parallelism # argon2 needs at least 8 KiB per lane
+    settings = {"rounds": min_rounds, "memory_cost": min(65536, max_memory_cost), "parallelism": parallelism}
+    work = settings["memory_cost"] * min_rounds * target / measure(settings)
+    memory_cost = min(max_memory_cost, work / min_rounds)
+    settings["memory_cost"] = max(block, int(memory_cost) // block * block)
+    settings["rounds"] = max(min_rounds, round(work / settings["memory_cost"]))
+    return settings, measure(settings)
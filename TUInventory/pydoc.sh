@@ -1,13 +1,22 @@
 #!/bin/bash
 
 pydoc -w barcodereader
+pydoc -w benchmark
+pydoc -w bulk
 pydoc -w classes
 pydoc -w config
+pydoc -w decoding
+pydoc -w executor
+pydoc -w frames
+pydoc -w inventory_model
 pydoc -w keys
 pydoc -w logger
 pydoc -w main
+pydoc -w migrations
+pydoc -w passwords
 pydoc -w qr_generator
 pydoc -w slots
+pydoc -w sources
 pydoc -w ui
 pydoc -w unittests
 pydoc -w utils
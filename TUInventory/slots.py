@@ -1,15 +1,203 @@
+from collections import OrderedDict
 from functools import wraps
+import re
 from secrets import choice, compare_digest
 from string import ascii_letters, digits
+from threading import BoundedSemaphore, Lock
 
 import sqlalchemy
 
+import bulk
 import classes
+from config import config
 import keys
 from logger import logger
+import passwords
 
 
 CSession = classes.setup_context_session(classes.engine)
+verification_slots = BoundedSemaphore(config["login", "parallel_verifications"]) # bounds argon2 hashing
+
+
+class ReferenceCache():
+    """In-process cache of the reference tables that fill the comboboxes
+    Each table is loaded with a single query on first access and kept as a pre-sorted
+    tuple of rows until it's invalidated or patched
+
+        Args:
+            session_factory: ContextSession class that's used to load the tables
+
+        Attributes:
+            session_factory: Given session_factory
+            lock: mutex for _tables
+            _tables: dict of table name to tuple of cached rows
+
+        Rows:
+            locations: (uid, name) sorted by name
+            producers: (uid, name) sorted by name
+            articles: (uid, name, producer_uid) sorted by name
+            users: (uid, str(user)) sorted by uid
+    """
+    _sort_keys = {
+        "locations": lambda row: row[1],
+        "producers": lambda row: row[1],
+        "articles": lambda row: row[1],
+        "users": lambda row: row[0]}
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.lock = Lock()
+        self._tables = {}
+
+    @staticmethod
+    def _query(session, table):
+        """Load all rows of a table from the database"""
+        if table == "locations":
+            return session.query(classes.Location.uid, classes.Location.name).all()
+        elif table == "producers":
+            return session.query(classes.Producer.uid, classes.Producer.name).all()
+        elif table == "articles":
+            return session.query(
+                classes.Article.uid, 
+                classes.Article.name, 
+                classes.Article.producer_uid).all()
+        elif table == "users":
+            users = session.query(classes.User.uid, classes.User.name, classes.User.surname).all()
+            return [(uid, f"{name} {surname}".title()) for uid, name, surname in users]
+        raise KeyError(table)
+
+    @staticmethod
+    def _row(instance):
+        """Build the table name and cache row for a mapped instance"""
+        if isinstance(instance, classes.Location):
+            return "locations", (instance.uid, instance.name)
+        elif isinstance(instance, classes.Producer):
+            return "producers", (instance.uid, instance.name)
+        elif isinstance(instance, classes.Article):
+            return "articles", (instance.uid, instance.name, instance.producer_uid)
+        elif isinstance(instance, classes.User):
+            return "users", (instance.uid, str(instance))
+        return None, None
+
+    def _get(self, table):
+        with self.lock:
+            if table not in self._tables:
+                with self.session_factory() as session:
+                    rows = self._query(session, table)
+                self._tables[table] = tuple(sorted(rows, key=self._sort_keys[table]))
+            return self._tables[table]
+
+    def locations(self):
+        return self._get("locations")
+
+    def producers(self):
+        return self._get("producers")
+
+    def articles(self, producer_uid=None):
+        """Get all articles, optionally only those of the producer with the given uid"""
+        articles = self._get("articles")
+        if producer_uid is None:
+            return articles
+        return tuple(article for article in articles if article[2] == producer_uid)
+
+    def users(self):
+        return self._get("users")
+
+    def invalidate(self, *tables):
+        """Drop the given tables from the cache, drops all tables if none are given"""
+        with self.lock:
+            if not tables:
+                self._tables.clear()
+            for table in tables:
+                self._tables.pop(table, None)
+
+    def patch(self, instance):
+        """Insert or update the row of a freshly saved instance
+        Tables that aren't loaded yet and instances of uncached classes are ignored
+        """
+        table, row = self._row(instance)
+        with self.lock:
+            if table not in self._tables:
+                return
+            rows = [cached for cached in self._tables[table] if cached[0] != row[0]]
+            rows.append(row)
+            rows.sort(key=self._sort_keys[table])
+            self._tables[table] = tuple(rows)
+
+
+reference_cache = ReferenceCache(CSession)
+
+
+class DeviceInfoCache():
+    """Least recently used cache of the display texts of scanned devices
+    Devices that are scanned again or were prefetched while their code was being confirmed
+    are shown without a query. Entries have to be invalidated once the responsibility of
+    their device or the names it shows change. Every invalidation starts a new generation of
+    the entry, texts that were read in an older generation aren't put into the cache anymore.
+
+        Args:
+            maxsize: Number of devices that are kept
+
+        Attributes:
+            lock: mutex for _entries, _generations and _epoch
+            _entries: OrderedDict of device uid to the texts of device_info, least recently used first
+            _generations: dict of device uid to the number of times it was invalidated
+            _epoch: Number of times all devices were invalidated
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+
+    def get(self, uid):
+        """Get the cached texts of a device, None if they aren't cached"""
+        with self.lock:
+            info = self._entries.get(uid)
+            if info is not None:
+                self._entries.move_to_end(uid)
+            return info
+
+    def generation(self, uid):
+        """Get the generation of the entry of a device, get it before its texts are read"""
+        with self.lock:
+            return self._epoch, self._generations.get(uid, 0)
+
+    def put(self, uid, info, generation=None):
+        """Cache the texts of a device
+
+            Args:
+                uid: uid of the device
+                info: Texts of device_info
+                generation: Result of generation from before info was read, info isn't cached
+                    if the device was invalidated since. None to cache it anyway.
+
+            Returns:
+                Whether info was cached
+        """
+        with self.lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(uid, 0)):
+                return False
+            self._entries[uid] = info
+            self._entries.move_to_end(uid)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate(self, *uids):
+        """Drop the given devices from the cache, drops all devices if none are given"""
+        with self.lock:
+            if not uids:
+                self._entries.clear()
+                self._generations.clear()
+                self._epoch += 1
+            for uid in uids:
+                self._entries.pop(uid, None)
+                self._generations[uid] = self._generations.get(uid, 0) + 1
+
+
+device_info_cache = DeviceInfoCache(config["recognition", "device_cache_size"])
 
 
 def synchronized(function):
@@ -21,6 +209,7 @@ def synchronized(function):
             save_to_db(instance)
         except sqlalchemy.exc.IntegrityError: # uid already in db
             raise classes.IntegrityError(str(args) + str(kwargs))
+        reference_cache.patch(instance)
         return instance
     return synchronized_function
 
@@ -54,21 +243,43 @@ def login(e_mail, password):
         e_mail (str): e_mail of the user that wants to log in
         password (str): user provided password to check against
     """
-    e_mail = e_mail.lower()
     with CSession() as session:
-        try:
-            user = session.query(classes.User).filter_by(e_mail=e_mail).first()
-            user_at_gate = classes.User(e_mail, password, salt=user.salt)
-            if compare_digest(user_at_gate.password, user.password):
-                session.expunge(user)
-                logger.info(f"Successfully logged in as {user.uid}")
-                return user
-            else:
-                logger.info(f"Attempted login with wrong password for user {e_mail}")
-                return None
-        except (AttributeError, ValueError) as e: #user not found exception
-            logger.info(f"Attempted login from unknown user {e_mail}")
-            raise ValueError(f"Attemped login from unknown user {e_mail}")
+        return verify_login(session, e_mail, password)
+
+
+def verify_login(session, e_mail, password):
+    """Check the credentials of a user with an open session
+    Can be run in a worker of a DatabaseExecutor. At most config["login", "parallel_verifications"]
+    passwords are hashed at once, further logins wait for a free slot.
+    Hashes that don't match the current password policy are replaced after a successful login.
+    Args:
+        session: Open session
+        e_mail (str): e_mail of the user that wants to log in
+        password (str): user provided password to check against
+    Returns:
+        The user if the password is correct, None otherwise
+    Raises:
+        ValueError: if there's no user with this e_mail
+    """
+    e_mail = e_mail.lower()
+    try:
+        user = session.query(classes.User).filter_by(e_mail=e_mail).first()
+        with verification_slots:
+            verified = user.verify(password)
+            if verified and passwords.needs_update(user.password):
+                user.hash(password)
+                session.flush()
+                logger.info(f"Rehashed password of user {user.uid} with the current policy")
+        if verified:
+            session.expunge(user)
+            logger.info(f"Successfully logged in as {user.uid}")
+            return user
+        else:
+            logger.info(f"Attempted login with wrong password for user {e_mail}")
+            return None
+    except (AttributeError, ValueError) as e: #user not found exception
+        logger.info(f"Attempted login from unknown user {e_mail}")
+        raise ValueError(f"Attemped login from unknown user {e_mail}")
 
 
 def logout():
@@ -98,6 +309,229 @@ def create_producer(*args, **kwargs):
     return classes.Producer(*args, **kwargs)
 
 
+def tree_locations(session, after=None, limit=200):
+    """Get a page of the locations that devices are at, ordered by name
+
+        Args:
+            session: Open session
+            after: Name of the location the page starts after, None for the first page
+            limit: Maximum number of rows in the page
+
+        Returns:
+            List of (location.uid, location.name)
+    """
+    has_devices = session.query(classes.Responsibility).\
+        filter(classes.Responsibility.location_uid == classes.Location.uid).exists()
+    query = session.query(classes.Location.uid, classes.Location.name).filter(has_devices)
+    if after is not None:
+        query = query.filter(classes.Location.name > after)
+    return query.order_by(classes.Location.name).limit(limit).all()
+
+
+def tree_users(session, location_uid, after=None, limit=200):
+    """Get a page of the users that are responsible for devices at a location, ordered by name
+
+        Args:
+            session: Open session
+            location_uid: uid of the location
+            after: (name, surname, uid) of the user the page starts after, None for the first page
+            limit: Maximum number of rows in the page
+
+        Returns:
+            List of (user.uid, user.name, user.surname), missing names are empty strings
+    """
+    has_devices = session.query(classes.Responsibility).filter(
+        classes.Responsibility.user_uid == classes.User.uid,
+        classes.Responsibility.location_uid == location_uid).exists()
+    # a NULL in the keyset would make the comparison NULL and drop the user from all pages
+    name = sqlalchemy.func.coalesce(classes.User.name, "")
+    surname = sqlalchemy.func.coalesce(classes.User.surname, "")
+    query = session.query(classes.User.uid, name, surname).filter(has_devices)
+    if after is not None:
+        query = query.filter(sqlalchemy.tuple_(name, surname, classes.User.uid) > sqlalchemy.tuple_(*after))
+    return query.order_by(name, surname, classes.User.uid).limit(limit).all()
+
+
+def tree_devices(session, location_uid, user_uid, after=None, limit=200):
+    """Get a page of the devices a user is responsible for at a location, ordered by uid
+
+        Args:
+            session: Open session
+            location_uid: uid of the location
+            user_uid: uid of the user
+            after: uid of the device the page starts after, None for the first page
+            limit: Maximum number of rows in the page
+
+        Returns:
+            List of (device.uid, article.name)
+    """
+    query = session.query(classes.Responsibility.device_uid, classes.Article.name).\
+        join(classes.Device, classes.Responsibility.device_uid == classes.Device.uid).\
+        join(classes.Article, classes.Device.article_uid == classes.Article.uid).\
+        filter(
+            classes.Responsibility.location_uid == location_uid,
+            classes.Responsibility.user_uid == user_uid)
+    if after is not None:
+        query = query.filter(classes.Responsibility.device_uid > after)
+    return query.order_by(classes.Responsibility.device_uid).limit(limit).all()
+
+
+def device_info(session, uid):
+    """Get the display texts of a device and its responsibility
+
+        Args:
+            session: Open session
+            uid: uid of the device
+
+        Returns:
+            (str(device), str(user), str(location)) or None if there's no such device
+    """
+    resp = session.query(classes.Responsibility).join(classes.Device).filter_by(uid=uid).first()
+    if resp is None:
+        return None
+    return str(resp.device), str(resp.user), str(resp.location)
+
+
+def cached_device_info(session, uid):
+    """Get the display texts of a device like device_info through device_info_cache
+    Unknown devices aren't cached since they may be created any time
+    """
+    info = device_info_cache.get(uid)
+    if info is None:
+        generation = device_info_cache.generation(uid) # a change committed meanwhile isn't overwritten
+        info = device_info(session, uid)
+        if info is not None:
+            device_info_cache.put(uid, info, generation)
+    return info
+
+
+def change_responsibility(session, device_uid, user_uid, location_name):
+    """Hand a device over to another user and location
+
+        Args:
+            session: Open session, the change is committed with it
+            device_uid: uid of the device
+            user_uid: uid of the new responsible user
+            location_name: name of the new location
+
+        Returns:
+            uid of the device or None if there's no such device
+    """
+    resp = session.query(classes.Responsibility).join(classes.Device).filter_by(uid=device_uid).first()
+    if resp is None:
+        return None
+    resp.location = session.query(classes.Location).filter_by(name=location_name).first()
+    resp.user = session.query(classes.User).filter_by(uid=user_uid).first()
+    device_info_cache.invalidate(device_uid) # invalidated again once committed, see ui.changed_responsibility
+    return resp.device.uid
+
+
+def export_inventory(location=None, user=None, producer=None, batch_size=1000):
+    """Stream the inventory as flat rows without building ORM objects
+    The rows are fetched in batches of batch_size so memory stays constant for any size
+
+        Args:
+            location (str): Only export devices at the location with this name
+            user (str): Only export devices of the user with this e-mail
+            producer (str): Only export devices of articles by the producer with this name
+            batch_size: Number of rows fetched from the database at once
+
+        Yields:
+            Tuples with the values of bulk.export_fields
+    """
+    with CSession(refresh="none") as session:
+        query = session.query(
+                classes.Device.uid,
+                classes.Device.code,
+                classes.Article.name,
+                classes.Producer.name,
+                classes.User.name,
+                classes.User.surname,
+                classes.User.e_mail,
+                classes.Location.name).\
+            select_from(classes.Responsibility).\
+            join(classes.Device, classes.Responsibility.device_uid == classes.Device.uid).\
+            join(classes.Article, classes.Device.article_uid == classes.Article.uid).\
+            outerjoin(classes.Producer, classes.Article.producer_uid == classes.Producer.uid).\
+            join(classes.User, classes.Responsibility.user_uid == classes.User.uid).\
+            join(classes.Location, classes.Responsibility.location_uid == classes.Location.uid)
+        if location:
+            query = query.filter(classes.Location.name == location.title())
+        if user:
+            query = query.filter(classes.User.e_mail == user.lower())
+        if producer:
+            query = query.filter(classes.Producer.name == producer.title())
+        rows = query.order_by(classes.Device.uid).yield_per(batch_size)
+        for uid, code, article, producer_name, name, surname, e_mail, location_name in rows:
+            yield (uid, code, article, producer_name, f"{name} {surname}".title(), e_mail, location_name)
+
+
+def import_inventory(path, chunk_size=1000):
+    """Import devices with their responsibilities from a CSV or JSON Lines file
+    See bulk.import_inventory for the expected columns
+
+        Args:
+            path: Path of the file to import
+            chunk_size: Number of rows that are written in one transaction
+
+        Returns:
+            bulk.ImportReport
+    """
+    report = bulk.import_inventory(classes.engine, path, chunk_size)
+    reference_cache.invalidate()
+    device_info_cache.invalidate()
+    return report
+
+
+def provision_users(path, credentials_path, workers=None):
+    """Create users from a CSV or JSON Lines file with their passwords hashed in parallel
+    See bulk.provision_users for the expected columns
+
+        Args:
+            path: Path of the file with the users
+            credentials_path: Path the generated passwords are written to
+            workers: Number of processes that hash passwords, all cores if None
+
+        Returns:
+            bulk.ImportReport
+    """
+    report = bulk.provision_users(classes.engine, path, credentials_path, generate_password, workers)
+    reference_cache.invalidate("users", "locations")
+    return report
+
+
+def search_available():
+    """Check whether the full-text search index exists, it needs SQLite with FTS5"""
+    return classes.engine.has_table("search_index")
+
+
+def search_query(text):
+    """Convert free text into an FTS5 query that matches all words as prefixes"""
+    terms = (term.replace('"', "") for term in text.split())
+    return " ".join(f'"{term}"*' for term in terms if re.search(r"\w", term))
+
+
+def search(text, limit=50):
+    """Full-text search for devices by code, article, producer, user, e-mail and location
+
+        Args:
+            text (str): Words to search for, every word has to match the beginning of a word
+            limit: Maximum number of results
+
+        Returns:
+            List of (device.uid, article.name, user names, location names) with the best match first
+    """
+    query = search_query(text)
+    if not query:
+        return []
+    with classes.engine.connect() as connection:
+        return connection.execute(
+            "SELECT rowid, article, user, location FROM search_index "
+            "WHERE search_index MATCH ? ORDER BY rank LIMIT ?", 
+            query, 
+            limit).fetchall()
+
+
 def generate_password(len_=15):
     """Generate an human readable password of given length"""
     alphabet = ascii_letters
@@ -116,6 +550,12 @@ def reset_password(user):
 
 
 def reset_admin_password(user, path_public, path_private):
+    """Reset the password of a user if the private-key at path_private matches the public-key
+    A new key-pair is generated in the background afterwards, see keys.pending
+
+        Returns:
+            The new password or None if the keys don't match
+    """
     try:
         cipher, decipher = keys.read_keys(path_public, path_private)
     except ValueError:
@@ -123,7 +563,7 @@ def reset_admin_password(user, path_public, path_private):
     text = b"True"
     ciphertext = cipher.encrypt(text)
     if compare_digest(decipher.decrypt(ciphertext), text):
-        keys.generate_key(path_public, path_private)
+        keys.generate_key_async(path_public, path_private)
         new_password = reset_password(user)
         return new_password
     else:
@@ -0,0 +1,185 @@
+"""Frame sources that stand in for a barcodereader.Camera
+Video files, directories of images and generated frames can be scanned like a camera feed,
+so the scanning pipeline can be benchmarked and tested without any hardware. Sources either
+deliver their frames in real time like a camera or as fast as they're read.
+"""
+
+import pathlib
+from time import monotonic, sleep
+
+import cv2
+import numpy as np
+import qrcode
+
+from utils import image_suffixes
+
+
+class FrameSource():
+    """Base class of the frame sources
+    Used like a Camera: entering the context opens the source and returns an object with
+    a read(image=None) method that returns (success, frame) like cv2.VideoCapture.read.
+    Subclasses implement _read and optionally open and close.
+
+        Args:
+            fps: Frame rate of the source
+            realtime: Set to True to deliver the frames at fps like a camera,
+                False to deliver them as fast as possible
+
+        Attributes:
+            frames: Number of frames that were read since the source was opened
+            start: Time the source was opened at
+    """
+    def __init__(self, fps=30, realtime=True):
+        self.fps = fps
+        self.realtime = realtime
+        self.frames = 0
+        self.start = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _read(self, image):
+        raise NotImplementedError
+
+    def __enter__(self):
+        self.open()
+        self.frames = 0
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, image=None):
+        """Get the next frame, waits for its time if the source is realtime
+
+            Args:
+                image: Frame of a previous read that may be overwritten
+
+            Returns:
+                (success, frame), success is False once the source is exhausted
+        """
+        if self.realtime:
+            delay = self.start + self.frames / self.fps - monotonic()
+            if delay > 0:
+                sleep(delay)
+        success, frame = self._read(image)
+        if success:
+            self.frames += 1
+        return success, frame
+
+
+class VideoFileSource(FrameSource):
+    """Frames of a video file
+
+        Args:
+            path: Path of the video file
+            realtime: See FrameSource, the frame rate is read from the file
+            loop: Set to True to start over at the end of the file
+    """
+    def __init__(self, path, realtime=True, loop=False):
+        super().__init__(realtime=realtime)
+        self.path = str(path)
+        self.loop = loop
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError(f"Failed to open video {self.path}")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30
+
+    def close(self):
+        self.capture.release()
+
+    def _read(self, image):
+        success, frame = self.capture.read(image)
+        if not success and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, frame = self.capture.read(image)
+        return success, frame
+
+
+class ImageDirectorySource(FrameSource):
+    """Images of a directory in the order of their names, they're read from disk for every frame
+
+        Args:
+            path: Path of the directory
+            fps: See FrameSource
+            realtime: See FrameSource
+            loop: Set to True to start over after the last image
+    """
+    def __init__(self, path, fps=30, realtime=True, loop=False):
+        super().__init__(fps, realtime)
+        self.path = pathlib.Path(path)
+        self.loop = loop
+        self.paths = []
+
+    def open(self):
+        if not self.path.is_dir():
+            raise IOError(f"There's no directory at {self.path}")
+        self.paths = sorted(path for path in self.path.iterdir() if path.suffix.lower() in image_suffixes)
+        if not self.paths:
+            raise IOError(f"There are no images in {self.path}")
+
+    def _read(self, image):
+        if self.frames >= len(self.paths) and not self.loop:
+            return False, None
+        frame = cv2.imread(str(self.paths[self.frames % len(self.paths)]))
+        return frame is not None, frame
+
+
+class SyntheticSource(FrameSource):
+    """Generated frames of QR codes that are held into the picture one after the other
+    Every code slides through the picture for dwell seconds, the background is a fixed
+    pattern with a little noise on top like the image of a real camera.
+    Without codes the source shows an idle scanning station.
+
+        Args:
+            codes: Texts of the QR codes that are shown in turn
+            resolution: Tuple of (width, height) of the frames
+            fps: See FrameSource
+            realtime: See FrameSource
+            dwell: Seconds every code is shown
+            code_size: Side length of the codes in pixels
+            count: Number of frames before the source is exhausted, endless if None
+            seed: Seed of the background and the noise
+    """
+    def __init__(
+            self, codes=(), resolution=(1280, 720), fps=30, realtime=True, dwell=1.0,
+            code_size=240, count=None, seed=0):
+        super().__init__(fps, realtime)
+        self.codes = []
+        for text in codes:
+            qr = qrcode.QRCode()
+            qr.add_data(text)
+            code = np.where(qr.get_matrix(), 0, 255).astype(np.uint8)
+            code = cv2.resize(code, (code_size, code_size), interpolation=cv2.INTER_NEAREST)
+            self.codes.append(cv2.cvtColor(code, cv2.COLOR_GRAY2BGR))
+        self.resolution = resolution
+        self.dwell = dwell
+        self.code_size = code_size
+        self.count = count
+        rng = np.random.default_rng(seed)
+        width, height = resolution
+        self.background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), np.uint8), (31, 31), 0)
+        self.noise = [rng.integers(0, 8, (height, width, 3), np.uint8) for i in range(4)]
+
+    def _read(self, image):
+        if self.count is not None and self.frames >= self.count:
+            return False, None
+        width, height = self.resolution
+        if image is None or image.shape != self.background.shape:
+            image = np.empty_like(self.background)
+        cv2.add(self.background, self.noise[self.frames % len(self.noise)], dst=image)
+        if self.codes:
+            frames_per_code = max(1, round(self.dwell * self.fps))
+            code = self.codes[self.frames // frames_per_code % len(self.codes)]
+            progress = self.frames % frames_per_code / frames_per_code
+            x = round((width - self.code_size) * (0.25 + 0.5 * progress))
+            y = (height - self.code_size) // 2
+            image[y:y + self.code_size, x:x + self.code_size] = code
+        return True, image
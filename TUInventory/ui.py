@@ -12,6 +12,8 @@ from PyQt5.QtWidgets import QFileDialog, QPushButton, QStyle
 
 import classes
 from config import config
+from executor import DatabaseExecutor
+from inventory_model import InventoryModel
 import keys
 from logger import logger
 import slots
@@ -22,7 +24,9 @@ CSession = classes.setup_context_session(classes.engine)
 
 
 class MainDialog(QtWidgets.QMainWindow):
-    code_recognized = pyqtSignal(str)
+    code_recognized = pyqtSignal(str, int) # data of the barcode, id of the camera
+    code_seen = pyqtSignal(str, int) # like code_recognized, but before the code is confirmed
+    key_generated = pyqtSignal(object) # emitted from a keys.KeyGenerator thread once it's done
 
     def __init__(self, parent=None):
         path = utils.absolute_path("mainScaling.ui")
@@ -30,17 +34,13 @@ class MainDialog(QtWidgets.QMainWindow):
         self.ui = uic.loadUi(path, self)
         self.logged_in_user = None
         self.savepath = None
+        self.executor = DatabaseExecutor(CSession, workers=2, parent=self)
+        self.login_executor = DatabaseExecutor(
+            CSession, workers=config["login", "parallel_verifications"], parent=self)
+        self.tree_model = InventoryModel(self.executor, parent=self)
+        self.treeView.setModel(self.tree_model)
         self.set_tree()
-        self.set_combobox_location_u()
-        self.set_combobox_location_u_admin()
-        self.set_combobox_location_d()
-        self.set_combobox_producer_a()
-        self.set_combobox_producer_d()
-        self.set_combobox_device_user()
-        self.set_combobox_device_location()
-        self.set_combobox_article_d()
-        self.set_combobox_user_d()
-        self.set_combobox_user_admin()
+        self.load_comboboxes()
         self.setMouseTracking(True)
         
         self.ui.rb_mirror_yes.setChecked(config["mirror"])
@@ -78,6 +78,15 @@ class MainDialog(QtWidgets.QMainWindow):
         self.ui.cb_producer_d.currentIndexChanged.connect(self.reload_combobox_article_d)
         self.ui.cb_user_admin.currentIndexChanged.connect(self.reload_user_change)
 
+        self.search_timer = QtCore.QTimer(self) # only search once typing pauses
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.search)
+        self.ui.t_search.textChanged.connect(self.search_timer.start)
+        self.ui.t_search.setEnabled(slots.search_available())
+        self.ui.list_search.itemClicked.connect(self.search_result_clicked)
+        self.ui.list_search.hide()
+
         foldericon_path = utils.absolute_path("pictures/folder.png")
         self.ui.b_save_device.setIcon(QtGui.QIcon(f"{foldericon_path}"))
         self.ui.b_save_device.setIconSize(QtCore.QSize(20,20))
@@ -134,6 +143,8 @@ class MainDialog(QtWidgets.QMainWindow):
         self.ui.line_5.hide()
         self.update_user_dependant()
         self.code_recognized.connect(self.recognized_barcode)
+        self.code_seen.connect(self.prefetch_barcode)
+        self.key_generated.connect(self.key_generation_finished)
 
         self.ui.t_setting_timeout.setText(str(config["timeout"]))
         self.ui.t_setting_qr_path.setText(config["qr_path"])
@@ -146,6 +157,20 @@ class MainDialog(QtWidgets.QMainWindow):
         self.timeout = classes.Timeout(time, MainDialog.status_bar_clear, self)
         self.timeout.start()
     
+    def watch_key_generation(self, generator):
+        """Report in the status bar once a key-pair that's generated in the background is saved
+            Args:
+                generator: keys.KeyGenerator to watch
+        """
+        generator.add_done_callback(self.key_generated.emit)
+
+    def key_generation_finished(self, generator):
+        """Slot that's called in the GUI thread once a watched key generation is done"""
+        if generator.error:
+            self.status_bar_text("Neues Schlüsselpaar konnte nicht gespeichert werden!", 10, "red")
+        else:
+            self.status_bar_text(f"Neues Schlüsselpaar unter {generator.path_private} gespeichert", 5, "green")
+
     def status_bar_clear(self):
         self.ui.label_status.setStyleSheet("color: black")
         self.ui.label_status.setText("")
@@ -237,139 +262,137 @@ class MainDialog(QtWidgets.QMainWindow):
         self.ui.line_5.show() 
 
     def set_tree(self):
-        """Fill main screen treeWidget"""
-        self.treeWidget.clear()
-        with CSession() as session:
-            locations = session.query(classes.Location).all()
-            locations.sort(key=lambda loc: loc.name)
-            for location in locations:
-                users = session.query(classes.User).join(classes.Responsibility).\
-                    filter_by(location=location).all()
-                users.sort(key=lambda user: str(user))
-                if users:
-                    location_item = QtWidgets.QTreeWidgetItem([str(location.name)])
-                    self.treeWidget.addTopLevelItem(location_item)
-                else:
-                    continue
-                for user in users:
-                    devices = session.query(classes.Device).join(classes.Responsibility).\
-                        filter_by(user=user, location=location).all()
-                    user_item = QtWidgets.QTreeWidgetItem([str(user)])
-                    devices.sort(key=lambda device: str(device))
-                    location_item.addChild(user_item)
-                    for device in devices:
-                        device_item = QtWidgets.QTreeWidgetItem([str(device)])
-                        user_item.addChild(device_item)
+        """Reload the device overview in the main screen
+        Only the first page of locations is fetched, users and devices follow when they're expanded
+        """
+        self.tree_model.refresh()
+
+    def search(self):
+        """Search in the background for the text in the search box"""
+        text = self.t_search.text()
+        if not text.strip():
+            self.executor.cancel("search")
+            self.show_search_results([])
+            return
+        self.executor.submit(self._search, text, key="search", callback=self.show_search_results)
+
+    @staticmethod
+    def _search(session, text):
+        return slots.search(text)
+
+    def show_search_results(self, results):
+        """Show ranked search results below the search box"""
+        self.list_search.clear()
+        for uid, article, user, location in results:
+            item = QtWidgets.QListWidgetItem(f"{article} mit ID {uid} - {user} - {location}")
+            item.setData(Qt.UserRole, uid)
+            self.list_search.addItem(item)
+        self.list_search.setVisible(bool(results))
+
+    def search_result_clicked(self, item):
+        """Show the device of a search result like a scanned one"""
+        self.show_device(item.data(Qt.UserRole))
+
+    def load_comboboxes(self):
+        """Load the reference data in the background and fill all comboboxes once it's there"""
+        self.executor.submit(self._load_reference_data, key="comboboxes", callback=self.set_comboboxes)
+
+    @staticmethod
+    def _load_reference_data(session):
+        slots.reference_cache.locations()
+        slots.reference_cache.producers()
+        slots.reference_cache.articles()
+        slots.reference_cache.users()
+
+    def set_comboboxes(self, result=None):
+        """Fill all comboboxes from the reference cache"""
+        self.set_combobox_location_u()
+        self.set_combobox_location_u_admin()
+        self.set_combobox_location_d()
+        self.set_combobox_producer_a()
+        self.set_combobox_producer_d()
+        self.set_combobox_device_user()
+        self.set_combobox_device_location()
+        self.set_combobox_article_d()
+        self.set_combobox_user_d()
+        self.set_combobox_user_admin()
 
     def set_combobox_location_u(self):
         """Fill Location ComboBox for User creation"""
         self.cb_location_u.clear()
-        with CSession() as session:
-            locations = session.query(classes.Location).all()
-            locations.sort(key=lambda location: str(location))
-            for location in locations:
-                self.cb_location_u.addItem(location.name)
+        for uid, name in slots.reference_cache.locations():
+            self.cb_location_u.addItem(name)
 
     def set_combobox_location_u_admin(self):
         """Fill Location ComboBox for User creation"""
         self.cb_location_u_admin.clear()
-        with CSession() as session:
-            locations = session.query(classes.Location).all()
-            locations.sort(key=lambda location: str(location))
-            for location in locations:
-                self.cb_location_u_admin.addItem(location.name)
+        for uid, name in slots.reference_cache.locations():
+            self.cb_location_u_admin.addItem(name)
     
     def set_combobox_location_d(self):
         """Fill Location ComboBox for Device creation"""
         self.cb_location_d.clear()
-        with CSession() as session:
-            locations = session.query(classes.Location).all()
-            locations.sort(key=lambda location: str(location))
-            for location in locations:
-                self.cb_location_d.addItem(location.name)
+        for uid, name in slots.reference_cache.locations():
+            self.cb_location_d.addItem(name)
 
     def set_combobox_producer_a(self):
         """Fill Producer ComboBox for Article creation"""
         self.cb_producer_a.clear()
-        with CSession() as session:
-            producers = session.query(classes.Producer).all()
-            producers.sort(key=lambda producer: str(producer.name))
-            for producer in producers:
-                self.cb_producer_a.addItem(producer.name)
+        for uid, name in slots.reference_cache.producers():
+            self.cb_producer_a.addItem(name)
             
     def set_combobox_producer_d(self):
         """Fill Producer ComboBox for Device creation"""
         self.cb_producer_d.clear()
         self.cb_producer_d.addItem("")
-        with CSession() as session:
-            producers = session.query(classes.Producer).all()
-            producers.sort(key=lambda producer: str(producer.name))
-            for producer in producers:
-                self.cb_producer_d.addItem(producer.name)
+        for uid, name in slots.reference_cache.producers():
+            self.cb_producer_d.addItem(name)
 
     def set_combobox_article_d(self):
         """Fill Article ComboBox for Device creation"""
         self.cb_article_d.clear()
-        with CSession() as session:
-            articles = session.query(classes.Article).all()
-            for article in articles:
-                self.cb_article_d.addItem(article.name)
+        for uid, name, producer_uid in slots.reference_cache.articles():
+            self.cb_article_d.addItem(name)
 
     def reload_combobox_article_d(self):
         """Change article depending on selected Producer"""
         self.cb_article_d.clear()
-        with CSession() as session:
-            articles = session.query(classes.Article).all()
-            producers = session.query(classes.Producer).all()
-            selected_producer = self.cb_producer_d.currentText()
-            if selected_producer:
-                for producer in producers:
-                    if producer.name == selected_producer:
-                        self.producerXY = producer.uid
-                        print (self.producerXY)
-                for article in articles:
-                    if article.producer_uid == self.producerXY:
-                        self.cb_article_d.addItem(article.name)
-            else:
-                for article in articles:    
-                    self.cb_article_d.addItem(article.name)
+        selected_producer = self.cb_producer_d.currentText()
+        producer_uid = None
+        if selected_producer:
+            for uid, name in slots.reference_cache.producers():
+                if name == selected_producer:
+                    producer_uid = uid
+        for uid, name, _ in slots.reference_cache.articles(producer_uid):
+            self.cb_article_d.addItem(name)
 
     def set_combobox_device_user(self):
         """Fill User ComboBox for QR-Code readings"""
         self.cb_device_user.clear()
         self.cb_device_user.addItem("")
-        with CSession() as session:
-            users = session.query(classes.User).all()
-            for user in users:
-                self.cb_device_user.addItem(f"{user.uid} {str(user)}")
+        for uid, name in slots.reference_cache.users():
+            self.cb_device_user.addItem(f"{uid} {name}")
 
     def set_combobox_device_location(self):
         """Fill Location ComboBox for QR-Code readings"""
         self.cb_device_location.clear()
         self.cb_device_location.addItem("")
-        with CSession() as session:
-            locations = session.query(classes.Location).all()
-            locations.sort(key=lambda location: str(location))
-            for location in locations:
-                self.cb_device_location.addItem(location.name)
+        for uid, name in slots.reference_cache.locations():
+            self.cb_device_location.addItem(name)
 
     def set_combobox_user_d(self):
         """Fill User ComboBox for Device creation"""
         self.cb_user_d.clear()
         self.cb_user_d.addItem("")
-        with CSession() as session:
-            users = session.query(classes.User).all()
-            for user in users:
-                self.cb_user_d.addItem(f"{user.uid} {str(user)}")
+        for uid, name in slots.reference_cache.users():
+            self.cb_user_d.addItem(f"{uid} {name}")
     
     def set_combobox_user_admin(self):
         """Fill User ComboBox for User change"""
         self.cb_user_admin.clear()
         self.cb_user_admin.addItem("")
-        with CSession() as session:
-            users = session.query(classes.User).all()
-            for user in users:
-                self.cb_user_admin.addItem(f"{user.uid} {str(user)}")
+        for uid, name in slots.reference_cache.users():
+            self.cb_user_admin.addItem(f"{uid} {name}")
 
     def reload_user_change(self):
         """Fill TextBoxes for User change"""
@@ -419,15 +442,20 @@ class MainDialog(QtWidgets.QMainWindow):
 
     def b_user_login_click(self):
         """Login button click"""
-        LoginDialog(self).exec()
+        dialog = LoginDialog(self, self.login_executor)
+        dialog.logged_in.connect(self.user_logged_in)
+        dialog.exec()
+
+    def user_logged_in(self, user):
+        """Set up the session of a user that logged in"""
+        self.logged_in_user = user
         self.update_user_dependant()
-        if self.logged_in_user:
-            # logger.info(f"Logged in as {self.logged_in_user}") # already logged in login
-            self.timeout = classes.Timeout(
-                config["timeout"]*60, 
-                lambda signal: signal.emit(True), 
-                self.ui.b_user_logout.clicked)
-            self.timeout.start()
+        # logger.info(f"Logged in as {self.logged_in_user}") # already logged in login
+        self.timeout = classes.Timeout(
+            config["timeout"]*60, 
+            lambda signal: signal.emit(True), 
+            self.ui.b_user_logout.clicked)
+        self.timeout.start()
 
     def b_user_logout_click(self, timed_out=False):
         """Logout button click - also handles timeouts via timed_out flag
@@ -539,6 +567,8 @@ class MainDialog(QtWidgets.QMainWindow):
             user.location = location
             if self.logged_in_user and password:
                 user.hash(password)
+        slots.reference_cache.patch(user)
+        slots.device_info_cache.invalidate() # the devices show the name of their user
                 
         if self.logged_in_user:
             self.logged_in_user = user
@@ -571,6 +601,8 @@ class MainDialog(QtWidgets.QMainWindow):
             user.location = location
             user.is_admin = self.checkBox.isChecked()
             session.add_all((user, location))
+        slots.reference_cache.patch(user)
+        slots.device_info_cache.invalidate() # the devices show the name of their user
                    
         if self.logged_in_user.uid == user.uid:
             self.logged_in_user = user
@@ -623,21 +655,27 @@ class MainDialog(QtWidgets.QMainWindow):
             self.not_all_fields_filled_notice()
             return
 
-        with CSession() as session:
-            resp = session.query(classes.Responsibility).join(classes.Device).filter_by(uid=device).first()
-            location = session.query(classes.Location).filter_by(name=new_location).first()
-            user = session.query(classes.User).filter_by(uid=user_uid).first()
-            if self.logged_in_user:
-                if user.uid != self.logged_in_user.uid and not self.logged_in_user.is_admin:
-                    self.status_bar_text("Um Geräte einem anderen Nutzer zuzuweisen ist ein Administrator nötig!", 5, "red")
-                    return    
-            else:
-                self.status_bar_text("Um Geräte einem anderen Nutzer zuzuweisen ist ein Administrator nötig!", 5, "red")
-                return
-            resp.location = location
-            resp.user = user
-            logger.info(f"Modified Responsibility for Device {resp.device.uid}")
-            self.status_bar_text(f"Verantwortlichkeit für Gerät {resp.device.uid} wurde bearbeitet", 5, "green")
+        if not self.logged_in_user or \
+                (user_uid != self.logged_in_user.uid and not self.logged_in_user.is_admin):
+            self.status_bar_text("Um Geräte einem anderen Nutzer zuzuweisen ist ein Administrator nötig!", 5, "red")
+            return
+        self.executor.submit(
+            slots.change_responsibility, device, user_uid, new_location, 
+            callback=self.changed_responsibility,
+            errback=lambda exception: self.change_responsibility_failed(device, exception))
+
+    def changed_responsibility(self, device_uid):
+        """Report a finished change of a Responsibility"""
+        if device_uid is None:
+            return
+        slots.device_info_cache.invalidate(device_uid)
+        logger.info(f"Modified Responsibility for Device {device_uid}")
+        self.status_bar_text(f"Verantwortlichkeit für Gerät {device_uid} wurde bearbeitet", 5, "green")
+        self.set_tree()
+
+    def change_responsibility_failed(self, device_uid, exception):
+        """Report a change of a Responsibility that couldn't be written, the executor logged the exception"""
+        self.status_bar_text(f"Verantwortlichkeit für Gerät {device_uid} konnte nicht bearbeitet werden", 5, "red")
 
     def b_delete_device_click(self):
         """Delete device from database"""
@@ -658,6 +696,7 @@ class MainDialog(QtWidgets.QMainWindow):
             self.t_code_user.setText("")
             self.t_code_location.setText("")
             self.set_tree()
+        slots.device_info_cache.invalidate(device)
 
     def b_create_device_click(self): # todo: handle if logged in user is no admin and can't create devices for others
         article = self.cb_article_d.currentText()
@@ -707,10 +746,8 @@ class MainDialog(QtWidgets.QMainWindow):
 
     def b_create_new_qrcode_click(self):
         """Creates a new QR-Code for a device"""
-        device = self.ui.treeWidget.currentItem().text(0)
-        try:
-            device_uid = re.match(r"(?:.* mit ID )(?P<ID>\d+)$", device).group("ID")
-        except AttributeError:
+        device_uid = self.ui.treeView.currentIndex().data(Qt.UserRole)
+        if device_uid is None:
             self.status_bar_text("Es konnte leider kein Gerät erkannt werden", 8, "red")
             return
         
@@ -770,47 +807,112 @@ class MainDialog(QtWidgets.QMainWindow):
         """
         self.status_bar_text("Bitte füllen Sie alle Felder aus", 5, "red")
 
-    def recognized_barcode(self, str_):
-        """Slot that's called if the camera recognized a barcode"""
-        logger.info(f"Recognized barcode: {str_}")
-        try:
-            match = re.search(r"id=(?P<id>\d+).*", str_)
-            # Could also match on r"id=(?P<id>\d+).*name=(?P<name>.*)" to only recognize codes that contain name and uid
-            uid = match.group("id")
-        except AttributeError:
+    @staticmethod
+    def device_uid(str_):
+        """Get the uid of the device from the data of a barcode, None if it's no code of ours"""
+        match = re.search(r"id=(?P<id>\d+).*", str_)
+        # Could also match on r"id=(?P<id>\d+).*name=(?P<name>.*)" to only recognize codes that contain name and uid
+        return int(match.group("id")) if match else None
+
+    def prefetch_barcode(self, str_, camera_id=0):
+        """Slot that's called as soon as a barcode shows up, loads its device before it's confirmed"""
+        uid = self.device_uid(str_)
+        if uid is not None and slots.device_info_cache.get(uid) is None:
+            self.executor.submit(slots.cached_device_info, uid, key=f"prefetch {uid}")
+
+    def recognized_barcode(self, str_, camera_id=0):
+        """Slot that's called if one of the cameras recognized a barcode"""
+        logger.info(f"Recognized barcode on camera {camera_id}: {str_}")
+        uid = self.device_uid(str_)
+        if uid is None:
             logger.info("Tried scanning external code/code with wrong data")
             return
-        with CSession() as session:
-            resp = session.query(classes.Responsibility).join(classes.Device).filter_by(uid=uid).first()
-            if resp is None:
-                logger.info(f"Scanned device is not in Database {uid}")
-                return
-            self.t_code_device.setText(str(resp.device))
-            self.t_code_user.setText(str(resp.user))
-            self.t_code_location.setText(str(resp.location))
-            self.status_bar_text("Barcode erkannt", 2, "green")
+        info = slots.device_info_cache.get(uid)
+        if info is not None:
+            self.recognized_device(uid, info)
+            return
+        self.executor.submit(
+            slots.cached_device_info, uid, key="device", 
+            callback=lambda info: self.recognized_device(uid, info))
+
+    def recognized_device(self, uid, info):
+        """Show the device of a recognized barcode once it's loaded"""
+        if info is None:
+            logger.info(f"Scanned device is not in Database {uid}")
+            return
+        self.show_device_info(info)
+        self.status_bar_text("Barcode erkannt", 2, "green")
         logger.info("Successfully processed barcode")
 
+    def show_device(self, uid):
+        """Load the device of given uid and its responsibility in the background and show it
+            Args:
+                uid: uid of the device
+        """
+        self.executor.submit(slots.device_info, uid, key="device", callback=self.show_device_info)
+
+    def show_device_info(self, info):
+        """Fill the device fields
+            Args:
+                info: Tuple of texts for device, user and location as given by slots.device_info
+        """
+        if info is None:
+            return
+        device, user, location = info
+        self.t_code_device.setText(device)
+        self.t_code_user.setText(user)
+        self.t_code_location.setText(location)
+
 
 class LoginDialog(QtWidgets.QDialog):
-    
-    def __init__(self, parent=None):
+    """Login dialog that checks the password in a worker so the GUI stays responsive while hashing
+
+        Args:
+            parent: Parent widget
+            executor: DatabaseExecutor the passwords are checked in, a new one if None
+
+        Signals:
+            logged_in: Emitted with the user after a successful login
+            login_failed: Emitted with the entered e_mail after a failed login
+    """
+    logged_in = pyqtSignal(object)
+    login_failed = pyqtSignal(str)
+
+    def __init__(self, parent=None, executor=None):
         path = utils.absolute_path("login.ui")
         super().__init__(parent)
         self.parent = parent
         self.ui = uic.loadUi(path, self)
+        self.executor = executor if executor else DatabaseExecutor(CSession, parent=self)
+        self.progress_login.hide()
         self.b_login.clicked.connect(self.b_login_click)
         self.b_password_lost.clicked.connect(self.b_password_lost_click)
 
     def b_login_click(self):
         username = self.t_username.text()
         password = self.t_password.text()
-        try:
-            self.parent.logged_in_user = slots.login(username, password)
-        except ValueError:
-            self.parent.status_bar_text(f'Benutzer "{username}" ist nicht bekannt', 5, "red")
+        self.b_login.setEnabled(False)
+        self.progress_login.show()
+        self.executor.submit(
+            slots.verify_login, username, password, key="login",
+            callback=lambda user: self.login_finished(username, user),
+            errback=lambda exception: self.login_finished(username, None, exception))
+
+    def login_finished(self, username, user, exception=None):
+        """Hand the result of the verification on and close the dialog"""
+        if user:
+            self.logged_in.emit(user)
+        else:
+            if isinstance(exception, ValueError) and self.parent is not None:
+                self.parent.status_bar_text(f'Benutzer "{username}" ist nicht bekannt', 5, "red")
+            self.login_failed.emit(username)
         self.close()
 
+    def reject(self):
+        """Drop a verification that's still running when the dialog is closed"""
+        self.executor.cancel("login")
+        super().reject()
+
     def b_password_lost_click(self):
         ResetDialog(self).exec()
 
@@ -867,6 +969,8 @@ class ResetDialog(QtWidgets.QDialog):        #Dialog to select a filepath for pa
         messagebox.setText(f"Das neue Passwort für {user} ist {password}")
         messagebox.setStandardButtons(QtWidgets.QMessageBox.Ok)
         messagebox.exec_()
+        for generator in keys.pending(public_path, private_path):
+            self.parent.parent.watch_key_generation(generator)
 
         self.close()
         self.parent.close()
@@ -1,9 +1,36 @@
+from collections import namedtuple
+import csv
+import io
+import json
 import os
+import queue
 import random
+import tempfile
+from threading import Event
+from time import perf_counter
 import unittest
 
+import cv2
+import numpy as np
+from passlib.hash import argon2
+from PyQt5.QtCore import QCoreApplication
+import qrcode
 
+import sqlalchemy
+
+import barcodereader
+import bulk
 import classes
+from cli import cli_get_barcode
+import decoding
+from decoding import AdaptiveDecoder, DecoderPool, MotionGate, ProcessDecoderPool, pyzbar
+from executor import DatabaseExecutor
+import frames
+import keys
+import migrations
+import passwords
+import slots
+import sources
 import utils
 
 
@@ -43,6 +70,755 @@ class TestTelephoneNumber(unittest.TestCase):
         self.assertEqual(self.phone_number("My number is 0 9723 1234+1 and yours is 09723 1234"), "+049 9723 1234-1")
 
 
+class TestReferenceCache(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+        self.CSession = classes.setup_context_session(self.engine)
+        with self.CSession() as session:
+            session.add_all([classes.Location("Lager"), classes.Location("Büro")])
+        self.cache = slots.ReferenceCache(self.CSession)
+
+    def test_loaded_once_and_sorted(self):
+        with classes.QueryCounter(self.engine) as counter:
+            self.cache.locations()
+            locations = self.cache.locations()
+        self.assertEqual(counter.queries, 1)
+        self.assertEqual([name for uid, name in locations], ["Büro", "Lager"])
+
+    def test_patch_and_invalidate(self):
+        self.cache.locations()
+        with self.CSession() as session:
+            location = classes.Location("Archiv")
+            session.add(location)
+        with classes.QueryCounter(self.engine) as counter:
+            self.cache.patch(location)
+            locations = self.cache.locations()
+        self.assertEqual(counter.queries, 0)
+        self.assertEqual([name for uid, name in locations], ["Archiv", "Büro", "Lager"])
+        self.cache.invalidate("locations")
+        self.assertEqual(len(self.cache.locations()), 3)
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+        for table, column in migrations.foreign_key_indexes: # simulate a database from before the indexes
+            self.engine.execute(f"DROP INDEX ix_{table}_{column}")
+        for name, table, columns in migrations.tree_indexes:
+            self.engine.execute(f"DROP INDEX {name}")
+
+    def query_plan(self, statement):
+        return " ".join(row[-1] for row in self.engine.execute(f"EXPLAIN QUERY PLAN {statement}"))
+
+    def test_foreign_key_indexes(self):
+        self.assertNotIn("ix_devices_article_uid", self.query_plan("SELECT * FROM devices WHERE article_uid = 1"))
+        migrations.migrate(self.engine)
+        for table, column in migrations.foreign_key_indexes:
+            plan = self.query_plan(f"SELECT * FROM {table} WHERE {column} = 1")
+            self.assertRegex(plan, rf"USING (COVERING )?INDEX ix_{table}_\w+ \({column}=\?\)")
+
+    def test_versions_applied_once(self):
+        migrations.migrate(self.engine)
+        migrations.migrate(self.engine)
+        versions = [row[0] for row in self.engine.execute("SELECT version FROM schema_version")]
+        self.assertEqual(versions, [version for version, function in migrations.migrations])
+
+    def test_postponed_migration(self):
+        fts5_available = migrations._fts5_available
+        migrations._fts5_available = lambda connection: False
+        try:
+            migrations.migrate(self.engine)
+        finally:
+            migrations._fts5_available = fts5_available
+        versions = [row[0] for row in self.engine.execute("SELECT version FROM schema_version")]
+        self.assertNotIn(2, versions)
+        self.assertFalse(self.engine.has_table("search_index"))
+        migrations.migrate(self.engine) # e.g. after SQLite was upgraded
+        self.assertIn(2, [row[0] for row in self.engine.execute("SELECT version FROM schema_version")])
+        self.assertTrue(self.engine.has_table("search_index"))
+
+    def test_add_column(self):
+        with self.engine.connect() as connection:
+            migrations.add_column(connection, "devices", "serial", "TEXT", "''")
+            migrations.add_column(connection, "devices", "serial", "TEXT", "''")
+        columns = [row[1] for row in self.engine.execute("PRAGMA table_info(devices)")]
+        self.assertEqual(columns.count("serial"), 1)
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+        migrations.migrate(self.engine)
+        self.engine.execute("INSERT INTO users (uid, e_mail, name, surname) VALUES (1, 'karl@example.com', 'Karl', 'König')")
+        self.engine.execute("INSERT INTO locations (uid, name) VALUES (1, 'Lager')")
+        self.engine.execute("INSERT INTO producers (uid, name) VALUES (1, 'Moxa')")
+        self.engine.execute("INSERT INTO articles (uid, name, producer_uid) VALUES (1, 'ioLogik E1241', 1)")
+        self.engine.execute("INSERT INTO devices (uid, code, article_uid) VALUES (7, 'X-42', 1)")
+        self.engine.execute("INSERT INTO responsibilities VALUES (7, 1, 1)")
+
+    def search(self, text):
+        query = slots.search_query(text)
+        return [row[0] for row in self.engine.execute(
+            "SELECT rowid FROM search_index WHERE search_index MATCH ? ORDER BY rank", query)]
+
+    def test_search_query(self):
+        self.assertEqual(slots.search_query('io "log  -'), '"io"* "log"*')
+
+    def test_triggers_keep_index_in_sync(self):
+        self.assertEqual(self.search("moxa lag"), [7])
+        self.assertEqual(self.search("karl@example"), [7])
+        self.engine.execute("UPDATE users SET name = 'Carl' WHERE uid = 1")
+        self.assertEqual(self.search("carl kön"), [7])
+        self.engine.execute("UPDATE users SET surname = NULL WHERE uid = 1")
+        self.assertEqual(self.search("carl"), [7])
+        self.engine.execute("UPDATE producers SET name = 'Wago' WHERE uid = 1")
+        self.assertEqual(self.search("wago"), [7])
+        self.engine.execute("DELETE FROM devices WHERE uid = 7")
+        self.assertEqual(self.search("wago"), [])
+
+
+class TestRefreshStrategies(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+
+    def add_locations(self, refresh, count=20):
+        CSession = classes.setup_context_session(self.engine, refresh)
+        locations = [classes.Location(f"{refresh} {i}") for i in range(count)]
+        with classes.QueryCounter(self.engine) as counter:
+            with CSession() as session:
+                session.add_all(locations)
+        return locations, session, counter.queries
+
+    def test_none_and_batched(self):
+        locations, session, none_queries = self.add_locations("none")
+        self.assertEqual([location.name for location in locations][:2], ["None 0", "None 1"])
+        locations, session, batched_queries = self.add_locations("batched")
+        self.assertEqual(locations[-1].name, "Batched 19")
+        self.assertEqual(locations[-1].responsibilities, [])
+        self.assertLessEqual(batched_queries - none_queries, 3) # one per class and eager relationship
+
+    def test_batches_by_primary_key_width(self):
+        CSession = classes.setup_context_session(self.engine)
+        CSession.max_parameters = 12
+        self.engine.execute(classes.User.__table__.insert(), {"e_mail": "karl@example.com", "salt": "0"})
+        location = classes.Location("Lager")
+        parameters = []
+        def record(connection, cursor, statement, statement_parameters, context, executemany):
+            if statement.lstrip().startswith("SELECT") and " OR " in statement:
+                parameters.append(len(statement_parameters))
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", record)
+        with CSession() as session:
+            user = session.query(classes.User).one()
+            session.add_all([classes.Responsibility(classes.Device(), user, location) for i in range(10)])
+        sqlalchemy.event.remove(self.engine, "before_cursor_execute", record)
+        self.assertEqual(parameters, [12, 12, 6]) # 4 responsibilities of 3 columns per query
+
+    def test_per_session_override(self):
+        CSession = classes.setup_context_session(self.engine)
+        with CSession(refresh="none") as session:
+            session.add(classes.Location("Lager"))
+        self.assertFalse(session.expire_on_commit)
+        for refresh in ("eager", "lazy"):
+            with self.assertRaises(ValueError):
+                CSession(refresh=refresh)
+
+
+class TestBulkImport(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+        self.engine.execute(classes.User.__table__.insert(), {"e_mail": "karl@example.com"})
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False) as f:
+            self.path = f.name
+            f.write("producer,article,code,user,location\n")
+            f.write("Moxa,ioLogik E1241,A1,Karl@example.com,Lager\n")
+            f.write("moxa,ioLogik E1241,A2,karl@example.com,Büro\n")
+            f.write("Wago,ioLogik E1241,A3,karl@example.com,Lager\n")
+            f.write("Wago,Switch 852,A4,nobody@example.com,Lager\n")
+            f.write("Wago,Switch 852,,karl@example.com,\n")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_import_with_row_errors(self):
+        report = bulk.import_inventory(self.engine, self.path, chunk_size=2)
+        self.assertEqual(report.rows, 5)
+        self.assertEqual(report.imported, 2)
+        self.assertEqual([line for line, message in report.errors], [4, 5, 6])
+        rows = self.engine.execute(
+            "SELECT devices.code, articles.name, producers.name, locations.name FROM responsibilities "
+            "JOIN devices ON devices.uid = responsibilities.device_uid "
+            "JOIN articles ON articles.uid = devices.article_uid "
+            "JOIN producers ON producers.uid = articles.producer_uid "
+            "JOIN locations ON locations.uid = responsibilities.location_uid "
+            "ORDER BY devices.uid").fetchall()
+        self.assertEqual(rows, [
+            ("A1", "ioLogik E1241", "Moxa", "Lager"), 
+            ("A2", "ioLogik E1241", "Moxa", "Büro")])
+
+    def test_new_article_with_two_producers_in_one_chunk(self):
+        report = bulk.import_inventory(self.engine, self.path)
+        self.assertEqual(report.imported, 2)
+        self.assertEqual(report.errors[0], (4, "Article ioLogik E1241 belongs to another producer"))
+        producers = self.engine.execute("SELECT name FROM producers").fetchall()
+        self.assertEqual(producers, [("Moxa",)])
+
+    def test_provision_users(self):
+        policy = {key: classes.config["passwords", key] for key in passwords.policy_keys}
+        for key, value in {"rounds": 3, "memory_cost": 64, "parallelism": 1}.items():
+            classes.config["passwords", key] = value
+        with open(self.path, "w", newline="") as f:
+            f.write("e_mail,name,surname,phonenumber,location,password\n")
+            f.write("Anna@example.com,anna,zett,0351 463-1234,Lager,geheim\n")
+            f.write("berta@example.com,Berta,Zett,,Neubau,\n")
+            f.write("karl@example.com,Karl,Zett,,Lager,\n")
+        credentials_file, credentials_path = tempfile.mkstemp(suffix=".csv")
+        os.close(credentials_file)
+        try:
+            report = bulk.provision_users(self.engine, self.path, credentials_path, lambda: "generiert", 2)
+            with open(credentials_path) as f:
+                credentials = f.read().splitlines()
+        finally:
+            for key, value in policy.items():
+                classes.config["passwords", key] = value
+            if os.path.exists(credentials_path):
+                os.remove(credentials_path)
+        self.assertEqual((report.imported, report.errors), (2, [(4, "User karl@example.com exists already")]))
+        self.assertEqual(credentials, ["e_mail,password", "berta@example.com,generiert"])
+        rows = self.engine.execute(
+            "SELECT users.e_mail, users.name, users.password, locations.name, phone_numbers.area_code "
+            "FROM users JOIN locations ON locations.uid = users.location_uid "
+            "JOIN phone_numbers ON phone_numbers.user_uid = users.uid ORDER BY users.uid").fetchall()
+        self.assertEqual([row[0] for row in rows], ["anna@example.com", "berta@example.com"])
+        self.assertEqual((rows[0][1], rows[0][3], rows[0][4]), ("Anna", "Lager", "351"))
+        self.assertTrue(passwords.verify("geheim", rows[0][2]))
+        self.assertTrue(passwords.verify("generiert", rows[1][2]))
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+        self.engine.execute("INSERT INTO producers (uid, name) VALUES (1, 'Moxa'), (2, 'Wago')")
+        self.engine.execute("INSERT INTO articles (uid, name, producer_uid) VALUES (1, 'ioLogik E1241', 1), (2, 'Switch 852', 2)")
+        self.engine.execute("INSERT INTO locations (uid, name) VALUES (1, 'Lager'), (2, 'Büro')")
+        self.engine.execute(
+            "INSERT INTO users (uid, e_mail, name, surname, salt) VALUES "
+            "(1, 'anna@tu.de', 'anna', 'zett', 1), (2, 'berta@tu.de', 'berta', 'zett', 2)")
+        self.engine.execute("INSERT INTO devices (uid, code, article_uid) VALUES (1, 'A1', 1), (2, NULL, 2), (3, 'A3', 1)")
+        self.engine.execute(
+            "INSERT INTO responsibilities (device_uid, user_uid, location_uid) VALUES (1, 1, 1), (2, 2, 2), (3, 2, 1)")
+        self.CSession = slots.CSession
+        slots.CSession = classes.setup_context_session(self.engine)
+
+    def tearDown(self):
+        slots.CSession = self.CSession
+
+    def export(self, format_, **filters):
+        output = io.StringIO(newline="")
+        count = bulk.write_rows(slots.export_inventory(batch_size=2, **filters), output, format_)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(count, len(lines) - (format_ != "jsonl"))
+        return lines
+
+    def test_formats(self):
+        rows = [
+            (1, "A1", "ioLogik E1241", "Moxa", "Anna Zett", "anna@tu.de", "Lager"),
+            (2, None, "Switch 852", "Wago", "Berta Zett", "berta@tu.de", "Büro"),
+            (3, "A3", "ioLogik E1241", "Moxa", "Berta Zett", "berta@tu.de", "Lager")]
+        for format_, delimiter in (("csv", ","), ("tsv", "\t")):
+            lines = list(csv.reader(self.export(format_), delimiter=delimiter))
+            self.assertEqual(lines[0], list(bulk.export_fields))
+            self.assertEqual(lines[1:], [[str(value) if value else "" for value in row] for row in rows])
+        lines = [json.loads(line) for line in self.export("jsonl")]
+        self.assertEqual(lines, [dict(zip(bulk.export_fields, row)) for row in rows])
+        with self.assertRaises(ValueError):
+            bulk.write_rows([], io.StringIO(), "xlsx")
+
+    def test_filters(self):
+        devices = lambda lines: [json.loads(line)["device"] for line in lines]
+        self.assertEqual(devices(self.export("jsonl", location="lager")), [1, 3])
+        self.assertEqual(devices(self.export("jsonl", user="Berta@tu.de")), [2, 3])
+        self.assertEqual(devices(self.export("jsonl", producer="moxa", user="berta@tu.de")), [3])
+        self.assertEqual(self.export("csv", location="Archiv"), [",".join(bulk.export_fields)])
+
+
+def crashing_decode(path):
+    """Stands in for cli_get_barcode.decode_file, kills its worker process on files named crash"""
+    if "crash" in os.path.basename(path):
+        os._exit(1)
+    return [{"path": path}]
+
+
+class TestGetBarcode(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        qr = qrcode.QRCode()
+        qr.add_data("42")
+        code = np.where(qr.get_matrix(), 0, 255).astype(np.uint8)
+        cv2.imwrite(self.path("code.png"), cv2.resize(code, (300, 300), interpolation=cv2.INTER_NEAREST))
+        with open(self.path("notes.txt"), "w") as f:
+            f.write("no image")
+        with open(self.path("broken.png"), "wb") as f:
+            f.write(b"no image")
+        os.mkdir(self.path("folder.png"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_image_paths(self):
+        images = [self.path("broken.png"), self.path("code.png")]
+        self.assertEqual(list(cli_get_barcode.image_paths([self.directory.name])), images)
+        self.assertEqual(sorted(cli_get_barcode.image_paths([self.path("*")])), images)
+
+    def test_crashed_worker(self):
+        names = [f"batch_{name}.png" for name in ("a", "b", "crash", "d", "e", "f")]
+        for name in names:
+            open(self.path(name), "wb").close()
+        output = io.StringIO()
+        files, failed = cli_get_barcode.decode_batch([self.path("batch_*")], 2, output, crashing_decode)
+        records = {record["path"]: record for record in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual((files, failed), (len(names), 1))
+        self.assertEqual(sorted(records), [self.path(name) for name in names])
+        self.assertEqual(records[self.path("batch_crash.png")]["error"], "worker process crashed")
+
+    @unittest.skipIf(pyzbar is None, "needs the zbar library")
+    def test_decode_batch(self):
+        output = io.StringIO()
+        files, failed = cli_get_barcode.decode_batch([self.directory.name], 2, output)
+        records = sorted((json.loads(line) for line in output.getvalue().splitlines()), key=lambda record: record["path"])
+        self.assertEqual((files, failed), (2, 1))
+        self.assertEqual(records[0], {"path": self.path("broken.png"), "error": "no valid image"})
+        self.assertEqual((records[1]["path"], records[1]["symbology"], records[1]["data"]), (self.path("code.png"), "QRCODE", "42"))
+        self.assertEqual(len(records[1]["polygon"]), 4)
+
+
+class TestTreePages(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=self.engine)
+        self.CSession = classes.setup_context_session(self.engine)
+        self.engine.execute("INSERT INTO locations (uid, name) VALUES (1, 'Lager'), (2, 'Büro'), (3, 'Archiv')")
+        self.engine.execute("INSERT INTO articles (uid, name) VALUES (1, 'ioLogik E1241')")
+        self.engine.execute(
+            "INSERT INTO users (uid, e_mail, name, surname, salt) VALUES "
+            "(1, 'b@tu.de', 'Berta', 'Zett', 1), (2, 'a@tu.de', 'Anna', 'Zett', 2), (3, 'c@tu.de', 'Anna', 'Zett', 3)")
+        for uid in range(1, 8):
+            self.engine.execute(f"INSERT INTO devices (uid, article_uid) VALUES ({uid}, 1)")
+            self.engine.execute(
+                "INSERT INTO responsibilities (device_uid, user_uid, location_uid) "
+                f"VALUES ({uid}, {uid % 3 + 1}, {1 if uid < 7 else 2})")
+
+    def pages(self, fetch, sort_key, *args):
+        pages = []
+        after = None
+        with self.CSession() as session:
+            while True:
+                page = fetch(session, *args, after, 2)
+                pages.append(page)
+                if len(page) < 2:
+                    return pages
+                after = sort_key(page[-1])
+
+    def test_keyset_pagination(self):
+        locations = self.pages(slots.tree_locations, lambda row: row[1])
+        self.assertEqual(locations, [[(2, "Büro"), (1, "Lager")], []]) # Archiv has no devices
+        users = self.pages(slots.tree_users, lambda row: (row[1], row[2], row[0]), 1)
+        self.assertEqual([[row[0] for row in page] for page in users], [[2, 3], [1]])
+        devices = self.pages(slots.tree_devices, lambda row: row[0], 1, 2)
+        self.assertEqual([[row[0] for row in page] for page in devices], [[1, 4], []])
+
+    def test_users_without_surname(self):
+        self.engine.execute("UPDATE users SET surname = NULL WHERE uid IN (2, 3)")
+        users = self.pages(slots.tree_users, lambda row: (row[1], row[2], row[0]), 1)
+        self.assertEqual([[row[0] for row in page] for page in users], [[2, 3], [1]])
+
+    def test_device_info_cache(self):
+        cache = slots.device_info_cache
+        cache.invalidate()
+        with self.CSession() as session:
+            info = slots.cached_device_info(session, 1)
+            with classes.QueryCounter(self.engine) as counter:
+                self.assertEqual(slots.cached_device_info(session, 1), info)
+            self.assertEqual(counter.queries, 0)
+            with classes.QueryCounter(self.engine) as counter:
+                self.assertIsNone(slots.cached_device_info(session, 99))
+                self.assertIsNone(slots.cached_device_info(session, 99))
+            self.assertEqual(counter.queries, 2) # unknown devices aren't cached
+        with self.CSession() as session:
+            slots.change_responsibility(session, 1, 1, "Archiv")
+        with self.CSession() as session:
+            self.assertEqual(slots.cached_device_info(session, 1)[1:], ("Berta Zett", "Archiv"))
+        small = slots.DeviceInfoCache(maxsize=2)
+        for uid in (1, 2, 1, 3): # 2 is the least recently used one once 3 is added
+            small.put(uid, (str(uid),))
+        self.assertEqual([small.get(uid) for uid in (1, 2, 3)], [("1",), None, ("3",)])
+        generation = small.generation(1) # a prefetch starts reading device 1
+        small.invalidate(1) # a change of its responsibility commits
+        self.assertFalse(small.put(1, ("stale",), generation))
+        self.assertIsNone(small.get(1))
+        generation = small.generation(1)
+        small.invalidate()
+        self.assertFalse(small.put(1, ("stale",), generation))
+        self.assertTrue(small.put(1, ("1",), small.generation(1)))
+        cache.invalidate()
+
+    def test_device_pages_use_index(self):
+        plan = " ".join(row[-1] for row in self.engine.execute(
+            "EXPLAIN QUERY PLAN SELECT device_uid FROM responsibilities "
+            "WHERE location_uid = 1 AND user_uid = 1 AND device_uid > 3 ORDER BY device_uid LIMIT 200"))
+        self.assertIn("ix_responsibilities_location_user_device", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class TestPasswords(unittest.TestCase):
+    def setUp(self):
+        self.policy = {key: classes.config["passwords", key] for key in passwords.policy_keys}
+        self.set_policy(rounds=3, memory_cost=64, parallelism=1)
+
+    def tearDown(self):
+        self.set_policy(**self.policy)
+
+    def set_policy(self, **settings):
+        for key, value in settings.items():
+            classes.config["passwords", key] = value
+
+    def test_policy_change(self):
+        stored = passwords.hash("geheim")
+        self.assertTrue(stored.startswith(b"$argon2i$v=19$m=64,t=3,p=1$"))
+        self.assertFalse(passwords.needs_update(stored))
+        self.set_policy(rounds=4)
+        self.assertTrue(passwords.needs_update(stored))
+        self.assertTrue(passwords.verify("geheim", stored))
+        self.assertFalse(passwords.verify("falsch", stored))
+
+    def test_rehash_legacy_on_login(self):
+        engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        classes.Base.metadata.create_all(bind=engine)
+        legacy_hash = argon2.using(
+            salt=b"1234a@tu.de", rounds=512, memory_cost=1024, digest_size=256).hash("geheim")
+        legacy = legacy_hash[legacy_hash.index("$", 20) + 1:].encode() # without the parameters
+        self.assertTrue(passwords.is_legacy(legacy))
+        engine.execute(classes.User.__table__.insert(), {"e_mail": "a@tu.de", "password": legacy, "salt": "1234"})
+        CSession = classes.setup_context_session(engine)
+        with CSession() as session:
+            self.assertIsNone(slots.verify_login(session, "a@tu.de", "falsch"))
+        self.assertEqual(engine.execute("SELECT password FROM users").scalar(), legacy)
+        with CSession() as session:
+            self.assertIsNotNone(slots.verify_login(session, "a@tu.de", "geheim"))
+        stored = engine.execute("SELECT password FROM users").scalar()
+        self.assertFalse(passwords.needs_update(stored))
+        self.assertTrue(passwords.verify("geheim", stored))
+
+
+class TestKeys(unittest.TestCase):
+    def test_background_generation_and_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path_public = os.path.join(directory, "pub.key")
+            path_private = os.path.join(directory, "priv.key")
+            generator = keys.generate_key_async(path_public, path_private, 1024)
+            cipher, decipher = keys.read_keys(path_public, path_private) # waits for the generator
+            self.assertTrue(generator.ready.is_set())
+            self.assertEqual(keys.pending(path_public, path_private), set())
+            self.assertIs(keys.read_keys(path_public, path_private)[0], cipher)
+            keys.generate_key_async(path_public, path_private, 1024)
+            new_cipher, new_decipher = keys.read_keys(path_public, path_private)
+            self.assertIsNot(new_cipher, cipher)
+            self.assertEqual(new_decipher.decrypt(new_cipher.encrypt(b"True")), b"True")
+
+    def test_done_callbacks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            generator = keys.generate_key_async(
+                os.path.join(directory, "pub.key"), os.path.join(directory, "priv.key"), 1024)
+            done = []
+            generator.add_done_callback(done.append)
+            generator.join()
+            generator.add_done_callback(done.append) # called right away once it's done
+        self.assertFalse(generator.daemon)
+        self.assertEqual(done, [generator, generator])
+
+
+class TestFramePipeline(unittest.TestCase):
+    def test_matches_resize_and_flip(self):
+        pipeline = frames.FramePipeline()
+        frame = np.random.default_rng(0).integers(0, 256, (72, 128, 3), np.uint8)
+        for resolution, mirror in (((80, 45), True), ((80, 45), False), (None, True), (None, False)):
+            expected = cv2.resize(frame, resolution) if resolution else frame
+            expected = cv2.flip(expected, 1) if mirror else expected
+            display_frame = pipeline.process(frame, resolution, mirror)
+            self.assertTrue(np.array_equal(display_frame, expected))
+            pipeline.release(display_frame)
+        self.assertEqual(pipeline.pool.allocations, 2) # one buffer per size, reused after release
+
+    def test_pool_drops_old_shapes(self):
+        pool = frames.BufferPool(max_bytes=3 * 100)
+        old = [pool.acquire((10, 10)) for i in range(2)]
+        for buffer in old:
+            pool.release(buffer)
+        new = [pool.acquire((5, 20)) for i in range(3)] # e.g. after the window was resized
+        for buffer in new:
+            pool.release(buffer)
+        self.assertEqual(list(pool.free), [(5, 20)])
+        self.assertEqual(pool.free_bytes, 300)
+        self.assertIs(pool.acquire((5, 20)), new[-1])
+
+    def test_latest_frame_wins(self):
+        released = []
+        display = frames.LatestFrame(released.append)
+        ready = []
+        display.ready.connect(lambda: ready.append(True))
+        for i in range(3):
+            display.put(i)
+        self.assertEqual((display.take(), display.take()), (2, None))
+        display.put(3)
+        self.assertEqual((released, len(ready), display.dropped), ([0, 1], 2, 2))
+
+
+Point = namedtuple("Point", "x y")
+Decoded = namedtuple("Decoded", "type data polygon")
+
+
+def fake_zbar(gray, min_side=60):
+    """Finds the dark code in gray like zbar would if it's at least min_side pixels wide"""
+    ys, xs = np.nonzero(gray < 60)
+    if not len(xs) or xs.max() - xs.min() < min_side:
+        return []
+    x0, y0, x1, y1 = xs.min(), ys.min(), xs.max(), ys.max()
+    return [Decoded("QRCODE", b"42", [Point(x0, y0), Point(x0, y1), Point(x1, y1), Point(x1, y0)])]
+
+
+class TestAdaptiveDecoder(unittest.TestCase):
+    def fake_decode(self, gray):
+        self.scanned.append(gray.shape)
+        return fake_zbar(gray)
+
+    def frame(self, x, y, side):
+        qr = qrcode.QRCode(border=0)
+        qr.add_data("42")
+        code = np.where(qr.get_matrix(), 0, 255).astype(np.uint8)
+        frame = np.full((1080, 1920, 3), 128, np.uint8)
+        frame[y:y + side, x:x + side] = cv2.resize(code, (side, side), interpolation=cv2.INTER_NEAREST)[..., None]
+        return frame
+
+    def setUp(self):
+        self.scanned = []
+        self.decoder = AdaptiveDecoder(decode=self.fake_decode)
+
+    def test_downscaled_decode(self):
+        (type_, data, polygon), = self.decoder.decode(self.frame(800, 400, 300))
+        self.assertEqual((type_, data), ("QRCODE", "42"))
+        self.assertLess(self.decoder.scale, 1)
+        self.assertEqual(self.scanned, [(338, 600)])
+        x, y, width, height = cv2.boundingRect(polygon)
+        self.assertLessEqual(max(abs(x - 800), abs(y - 400), abs(width - 300), abs(height - 300)), 4)
+
+    def test_full_resolution_retry(self):
+        self.assertEqual(self.decoder.decode(np.full((1080, 1920, 3), 128, np.uint8)), [])
+        self.assertEqual(self.decoder.full_scans, 0)
+        (type_, data, polygon), = self.decoder.decode(self.frame(100, 100, 100))
+        self.assertEqual(self.decoder.full_scans, 1)
+        self.assertEqual(cv2.boundingRect(polygon)[:2], (100, 100))
+        self.assertEqual(self.decoder.scale, 1) # small codes are scanned at full resolution from now on
+        self.assertEqual(self.decoder.frames, len(self.decoder.durations))
+
+    def test_scale_decays_without_codes(self):
+        self.decoder.decay_frames = 5
+        self.decoder.decode(self.frame(100, 100, 100))
+        self.assertEqual(self.decoder.scale, 1)
+        empty = np.full((1080, 1920, 3), 128, np.uint8)
+        for i in range(5):
+            self.decoder.decode(empty)
+        self.assertEqual(self.decoder.scale, 1)
+        self.scanned.clear()
+        self.decoder.decode(empty)
+        self.assertEqual(self.decoder.scale, self.decoder._quantize(640 / 1920))
+        self.assertEqual(len(self.scanned), 1)
+        self.assertLess(self.scanned[0][1], 1920)
+
+    def test_pool_keeps_decoders_per_camera(self):
+        pool = DecoderPool(workers=2, decode=self.fake_decode)
+        futures = [pool.submit(camera_id, self.frame(100, 100, 100)) for camera_id in (0, 1)]
+        futures.append(pool.submit(2, self.frame(800, 400, 300)))
+        self.assertEqual([len(future.result()) for future in futures], [1, 1, 1])
+        pool.shutdown()
+        self.assertEqual(sorted(pool.decoders), [0, 1, 2])
+        self.assertEqual(pool.decoder(0).scale, 1)
+        self.assertLess(pool.decoder(2).scale, 1)
+
+    def test_process_pool(self):
+        pool = ProcessDecoderPool(workers=2, decode=fake_zbar, max_resolution=(1920, 1080), slots=2)
+        try:
+            expected = AdaptiveDecoder(fake_zbar).decode(self.frame(800, 400, 300))
+            futures = [pool.submit(0, self.frame(800, 400, 300)) for i in range(4)] # waits for free slots
+            for future in futures:
+                (type_, data, polygon), = future.result()
+                self.assertEqual((type_, data), expected[0][:2])
+                self.assertTrue(np.array_equal(polygon, expected[0][2]))
+            self.assertEqual(pool.decoder(0).frames, 4)
+            with self.assertRaises(ValueError):
+                pool.submit(0, np.zeros((1081, 1920), np.uint8))
+        finally:
+            pool.shutdown()
+
+    def test_process_pool_scale_per_camera(self):
+        pool = ProcessDecoderPool(workers=1, decode=fake_zbar, slots=1)
+        frame = np.ndarray((1080, 1920), np.uint8, buffer=pool.slots[0].buf)
+        try:
+            decoding._attach([pool.slots[0].name], fake_zbar) # play the workers in this process
+            cv2.cvtColor(self.frame(800, 400, 600), cv2.COLOR_BGR2GRAY, dst=frame)
+            scale = decoding._decode_slot(0, frame.shape, 0, None, 0)[2]
+            self.assertLess(scale, 1 / 3)
+            decoding._decoders.clear() # the next frame of the camera goes to another worker
+            frame[:] = 128
+            self.assertEqual(decoding._decode_slot(0, frame.shape, 0, scale, 0)[2], scale)
+        finally:
+            del frame
+            for slot in decoding._slots:
+                slot.close()
+            decoding._slots.clear()
+            decoding._decoders.clear()
+            pool.shutdown()
+
+
+class TestMotionGate(unittest.TestCase):
+    def test_static_scene_skipped(self):
+        now = [0.0]
+        gate = MotionGate(hold=1, clock=lambda: now[0])
+        rng = np.random.default_rng(0)
+        scene = cv2.GaussianBlur(rng.integers(0, 256, (360, 640, 3), np.uint8), (31, 31), 0)
+        passed = []
+        for i in range(90):
+            now[0] = i / 30
+            frame = cv2.add(scene, rng.integers(0, 12, scene.shape, np.uint8)) # sensor noise
+            if i == 60:
+                frame[100:200, 100:200] = 0
+            passed.append(gate.check(frame))
+        self.assertTrue(all(passed[:31])) # the first frame and hold seconds after it
+        self.assertFalse(any(passed[31:60]))
+        self.assertTrue(all(passed[60:]))
+        self.assertAlmostEqual(gate.decoded_fraction, 61 / 90)
+
+
+class TestFrameSources(unittest.TestCase):
+    def test_image_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(3):
+                cv2.imwrite(os.path.join(directory, f"{i}.png"), np.full((20, 30, 3), i, np.uint8))
+            with sources.ImageDirectorySource(directory, realtime=False) as source:
+                frames_ = [source.read() for i in range(4)]
+        self.assertEqual([frame[0, 0, 0] for success, frame in frames_[:3]], [0, 1, 2])
+        self.assertEqual(frames_[3], (False, None))
+
+    def test_realtime_pacing(self):
+        with sources.SyntheticSource(resolution=(64, 48), fps=50, count=6) as source:
+            start = perf_counter()
+            while source.read()[0]:
+                pass
+        self.assertGreaterEqual(perf_counter() - start, 5 / 50)
+        self.assertEqual(source.frames, 6)
+
+    def test_camera_reads_are_retried(self):
+        class Capture():
+            results = iter([(False, None), (False, None), (True, "frame")])
+            def read(self, image=None):
+                return next(self.results)
+        self.assertEqual(barcodereader.read_frame(barcodereader.Camera(), Capture(), retry_delay=0), "frame")
+        source = sources.SyntheticSource(resolution=(64, 48), count=0)
+        with source:
+            self.assertIsNone(barcodereader.read_frame(source, source))
+
+    def test_stream_ends_with_source(self):
+        source = sources.SyntheticSource(("42",), (640, 360), realtime=False, dwell=0.5, code_size=120, count=30)
+        stream = barcodereader.LazyVideoStream(source=source, decoder_pool=DecoderPool(1, fake_zbar))
+        code_stream = stream.subscribe_codes(maxsize=0)
+        stream.start()
+        stream.join(10)
+        self.assertFalse(stream.is_alive())
+        observations = [code_stream.get_nowait() for i in range(code_stream.qsize())]
+        self.assertEqual(len(observations), 30)
+        self.assertIn(("QRCODE", "42"), [code for timestamp, codes in observations for code in codes])
+        stream.decoder_pool.shutdown()
+
+
+class TestRecognition(unittest.TestCase):
+    class Stream():
+        camera_id = 0
+        subscribe_codes = queue.Queue
+
+    def test_cooldown_per_code(self):
+        sync = classes.VideoStreamUISync(None, self.Stream(), None, classes.CodeCooldown(10))
+        recognized = []
+        for i in range(60): # code a is shown for a second, then b until a is shown again
+            found = [("QRCODE", "a")] if i < 12 or i >= 48 else [("QRCODE", "b")]
+            recognized.extend(sync.observe(i / 30, found))
+        for i in range(12):
+            recognized.extend(sync.observe(10.5 + i / 30, [("QRCODE", "a")]))
+        self.assertEqual(recognized, [("QRCODE", "a"), ("QRCODE", "b"), ("QRCODE", "a")])
+
+    def confirmation_time(self, fps, hit_every=1, seconds=2):
+        voter = classes.CodeVoter(window=0.5, min_ratio=0.5)
+        for i in range(int(seconds * fps)):
+            if voter.observe(i / fps, ["a"] if i % hit_every == 0 else []):
+                return i / fps
+        return None
+
+    def test_voter_independent_of_frame_rate(self):
+        slow, fast = self.confirmation_time(10), self.confirmation_time(60)
+        self.assertAlmostEqual(slow, fast, delta=0.1)
+        self.assertIsNone(self.confirmation_time(30, hit_every=5)) # stray decodes never add up
+
+    def test_voter_reports_appearing_codes(self):
+        voter = classes.CodeVoter()
+        appeared = []
+        for i, found in enumerate((["a"], ["a", "b"], ["a", "b"], [], ["b"])):
+            voter.observe(i / 30, found)
+            appeared.append(voter.appeared)
+        self.assertEqual(appeared, [["a"], ["b"], [], [], []])
+
+    def test_voter_memory_bounded(self):
+        voter = classes.CodeVoter(window=0.5)
+        for i in range(3000):
+            voter.observe(i / 30, [str(i)])
+        self.assertLessEqual(len(voter.frames), 16)
+        self.assertLessEqual(len(voter.hits), 16)
+
+
+class TestDatabaseExecutor(unittest.TestCase):
+    def setUp(self):
+        self.app = QCoreApplication.instance() or QCoreApplication([])
+        engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        self.executor = DatabaseExecutor(classes.setup_context_session(engine))
+        self.results = []
+
+    def wait_for(self, count, timeout=5):
+        start = perf_counter()
+        while len(self.results) < count and perf_counter() - start < timeout:
+            self.app.processEvents()
+
+    def test_coalescing(self):
+        release = Event()
+        self.executor.submit(lambda session: release.wait(5), callback=self.results.append)
+        for i in range(3):
+            self.executor.submit(
+                lambda session, i: session.execute(f"SELECT {i}").scalar(), i,
+                key="query", callback=self.results.append)
+        release.set()
+        self.wait_for(2)
+        self.assertEqual(self.results, [True, 2])
+
+    def test_errback(self):
+        self.executor.submit(lambda session: 1 / 0, errback=self.results.append)
+        self.wait_for(1)
+        self.assertIsInstance(self.results[0], ZeroDivisionError)
+
+
 if __name__ == "__main__":
     try:
         unittest.main()
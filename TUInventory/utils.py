@@ -6,6 +6,8 @@ from queue import Queue
 import re
 from threading import Thread
 
+image_suffixes = {".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"} # readable by cv2.imread
+
 
 def absolute_path(relative_path):
     """Convert a path relative to the sourcefile to an absolute one"""